@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Memory used by a corpus of prepared reviews.
+
+Synthetic reviews are generated as in bench_suite.py and all of them are
+prepared with `snippets.prepare_document` and kept, as a worker keeping a
+`DocumentCache` or a `ReviewIndex` does. The growth of the process's peak
+resident set size while preparing them is reported, along with the bytes
+per review and per token.
+
+The vocabulary of the synthetic reviews is small, so by default this shows
+what repeated words cost rather than the size of a real corpus's vocabulary.
+With --unique, each review also gets that many tokens seen nowhere else, like
+prices and typos, which `snippets.VOCABULARY` keeps until it reaches
+`snippets.VOCABULARY_MAX_WORDS` and is reset. The vocabulary's size and the
+number of resets are reported.
+
+    python bench/bench_memory.py [--docs N] [--unique N]
+"""
+
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import snippets
+from bench_suite import make_reviews, peak_rss
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--docs', dest='docs', type='int', default=100000,
+                      help='Number of reviews to prepare (default 100000).')
+    parser.add_option('--unique', dest='unique', type='int', default=0,
+                      help='Number of tokens found in no other review to add '
+                           'to each review (default 0).')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Seed of the synthetic reviews.')
+    options, args = parser.parse_args(args)
+
+    docs = make_reviews(options.docs, (3, 12), (5, 20), options.seed)
+    if options.unique:
+        docs = ['%s %s.' % (doc, ' '.join('x%dy%d' % (number, token)
+                                          for token in xrange(options.unique)))
+                for (number, doc) in enumerate(docs)]
+    text_bytes = sum(len(doc) for doc in docs)
+
+    vocabulary = snippets.VOCABULARY
+    generation = vocabulary.generation
+    before = peak_rss()
+    start = time.time()
+    prepared = [snippets.prepare_document(doc) for doc in docs]
+    seconds = time.time() - start
+    growth = peak_rss() - before
+    tokens = sum(len(doc.starts) for doc in prepared)
+
+    print 'reviews:          %d' % len(prepared)
+    print 'text:             %.1f MB' % (text_bytes / 1e6)
+    print 'tokens:           %d' % tokens
+    print 'prepare time:     %.1f s' % seconds
+    print 'peak RSS growth:  %.1f MB' % (growth / 1e6)
+    print 'bytes per review: %.0f' % (float(growth) / len(prepared))
+    print 'bytes per token:  %.1f' % (float(growth) / tokens)
+    print 'vocabulary:       %d words, %.1f MB, %d resets' % (
+        len(vocabulary.words), vocabulary.nbytes / 1e6,
+        vocabulary.generation - generation)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
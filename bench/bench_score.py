@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""Benchmark of NumPy sentence scoring against `snippets._rank_sentences`.
+
+The reviews are prepared once up front, so only scoring is timed: ranking
+every sentence of every review for each query, one review at a time with
+`snippets._rank_sentences` and the whole batch at once with
+`snippet_vector.VectorScorer`. The two must give identical scores.
+
+    python bench/bench_score.py [--docs N] [--repeat N]
+"""
+
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import snippet_vector
+import snippets
+from bench_tokenize import make_docs
+
+
+QUERIES = ['pizza', 'deep dish pizza', 'friendly staff', 'sushi']
+
+
+def best_time(rank, repeat):
+    """Return the result of `rank` and its fastest time in ms."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = rank()
+        elapsed = (time.time() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--docs', dest='docs', type='int', default=5000,
+                      help='Number of synthetic reviews in the batch.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                      help='Number of timed runs; the best one is reported.')
+    options, args = parser.parse_args(args)
+
+    docs = [snippets.prepare_document(doc) for doc in make_docs(options.docs)]
+    scorer = snippet_vector.VectorScorer()
+    print '%d reviews, %d sentences' % (len(docs),
+                                        sum(len(doc) for doc in docs))
+    print '%-16s %10s %10s %8s' % ('query', 'python ms', 'numpy ms', 'speedup')
+    for query in [snippets.compile_query(query) for query in QUERIES]:
+        expected, python_ms = best_time(
+            lambda: [snippets._rank_sentences(doc, query) for doc in docs],
+            options.repeat)
+        ranked, numpy_ms = best_time(lambda: scorer.rank(docs, query),
+                                     options.repeat)
+        if ranked != expected:
+            print 'Scores differ for %r' % (query,)
+            return 1
+        print '%-16s %10.1f %10.1f %7.1fx' % (' '.join(query.words), python_ms,
+                                              numpy_ms, python_ms / numpy_ms)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
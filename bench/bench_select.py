@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Benchmark of the 'greedy' and 'optimal' sentence selection strategies.
+
+For each character budget this reports the mean and worst latency of
+`highlight_doc` per review under both strategies, and how much the total
+score of the selected sentences improves with 'optimal'. Use it to decide at
+which budgets the optimal strategy is worth enabling.
+
+    python bench/bench_select.py [--docs N] [--budgets 80,160,320]
+"""
+
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import snippets
+from bench_tokenize import make_docs
+
+
+QUERIES = ['pizza', 'deep dish pizza', 'friendly staff', 'sushi']
+
+
+def time_strategy(docs, budget, strategy):
+    """Return per-review latencies in ms and the total selected score."""
+    latencies = []
+    total_score = 0
+    for i, doc in enumerate(docs):
+        query = snippets.compile_query(QUERIES[i % len(QUERIES)])
+        start = time.time()
+        snippets.highlight_doc(doc, query, max_chars=budget, strategy=strategy)
+        latencies.append((time.time() - start) * 1000)
+
+        tokens = snippets._tokenize(doc)
+        scores = dict((sentence, score) for (sentence, score, length)
+                      in snippets._rank_sentences(tokens, query))
+        selected = snippets._select_snippet_sentences(
+            tokens, query, budget, snippets.INFINITY, strategy)
+        total_score += sum(scores[sentence] for sentence in selected)
+    return latencies, total_score
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--docs', dest='docs', type='int', default=500,
+                      help='Number of synthetic reviews to snippet.')
+    parser.add_option('--budgets', dest='budgets', default='80,160,320,640',
+                      help='Comma-separated max_chars values to try.')
+    options, args = parser.parse_args(args)
+
+    docs = make_docs(options.docs)
+    print '%d reviews; OPTIMAL_MAX_SENTENCES=%d, OPTIMAL_CHAR_BUCKETS=%d' % (
+        len(docs), snippets.OPTIMAL_MAX_SENTENCES,
+        snippets.OPTIMAL_CHAR_BUCKETS)
+    print '%8s %9s %10s %10s %10s' % ('budget', 'strategy', 'mean ms',
+                                      'max ms', 'score')
+    for budget in [int(budget) for budget in options.budgets.split(',')]:
+        for strategy in snippets.STRATEGIES:
+            latencies, score = time_strategy(docs, budget, strategy)
+            print '%8d %9s %10.3f %10.3f %10d' % (
+                budget, strategy, sum(latencies) / len(latencies),
+                max(latencies), score)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+"""Benchmark suite for the snippet pipeline with regression gating.
+
+Synthetic reviews are generated from a fixed seed, so runs are repeatable and
+need no data. Each scenario varies one of review length, sentence count,
+query length or snippet limits, and every stage of `highlight_doc` is timed
+on its own: tokenizing, scoring, selecting, finding the offsets of the
+highlights and writing the snippet with tags, and then the whole pipeline
+end to end. Throughput is reported in documents per second, along with the
+peak memory allocated by a pass over the corpus. That is traced with the
+`tracemalloc` module where it exists. Python 2 has none, so on Linux the pass
+runs in a forked process whose peak resident set size is reset first, and the
+growth of that peak is measured instead, which counts whole pages.
+
+Results can be saved as a JSON baseline and later runs compared against it.
+The comparison fails, with exit status 1, when any stage of any scenario is
+slower than the baseline by more than --threshold, or its peak memory grew
+by more than --memory-threshold. Baselines should be compared with runs that
+measured memory the same way.
+
+    python bench/bench_suite.py [--save BASELINE.json]
+    python bench/bench_suite.py --compare BASELINE.json [--threshold 0.2]
+        [--memory-threshold 0.5]
+"""
+
+
+import json
+from optparse import OptionParser
+import os
+import platform
+import random
+import resource
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import snippets
+from bench_tokenize import WORDS
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+INFINITY = snippets.INFINITY
+
+# Each scenario is (name, reviews, sentences per review, words per sentence,
+# query words, max_chars, max_sents). Sentences and words are (low, high)
+# ranges that are sampled uniformly.
+SCENARIOS = [
+    ('short', 2000, (1, 3), (3, 10), 2, INFINITY, INFINITY),
+    ('typical', 1000, (3, 12), (5, 20), 2, INFINITY, INFINITY),
+    ('long', 100, (80, 120), (5, 20), 2, INFINITY, INFINITY),
+    ('long-sentences', 500, (3, 12), (40, 80), 2, INFINITY, INFINITY),
+    ('long-query', 1000, (3, 12), (5, 20), 6, INFINITY, INFINITY),
+    ('tight-sents', 1000, (3, 12), (5, 20), 2, INFINITY, 1),
+    ('tight-chars', 1000, (3, 12), (5, 20), 2, 160, INFINITY),
+]
+
+STAGES = ('tokenize', 'score', 'select', 'highlight', 'join', 'end-to-end')
+
+# Peak memory growth smaller than this is not a regression, since resident
+# set sizes are only measured in whole pages.
+MEMORY_SLACK = 256 * 1024
+
+# Linux reports the peak resident set size as VmHWM in a process's status,
+# and resets it when "5" is written to its clear_refs.
+PROC_STATUS = '/proc/self/status'
+CLEAR_REFS = '/proc/self/clear_refs'
+
+
+def make_reviews(count, sentences, words, seed=0):
+    """Return `count` synthetic reviews.
+
+    Args:
+      count: Integer number of reviews.
+      sentences: (low, high) range of the number of sentences in a review.
+      words: (low, high) range of the number of words in a sentence.
+      seed: Integer seed of the random generator.
+    Returns:
+      List of Strings.
+    """
+    rand = random.Random(seed)
+    reviews = []
+    for _ in xrange(count):
+        review = []
+        for _ in xrange(rand.randint(*sentences)):
+            sentence = [rand.choice(WORDS) for _ in xrange(rand.randint(*words))]
+            review.append(' '.join(sentence).capitalize() +
+                          rand.choice(('.', '.', '!', '?', '...')))
+        reviews.append(' '.join(review))
+    return reviews
+
+
+def make_query(length, seed=0):
+    """Return a query of `length` consecutive words from the vocabulary."""
+    start = random.Random(seed).randint(0, len(WORDS) - length)
+    return ' '.join(WORDS[start: start + length])
+
+
+def stage_functions(docs, query, max_chars, max_sents):
+    """Return a function running each stage over `docs`, keyed by stage.
+
+    Each stage takes as input the output of the stage before it, which is
+    computed here once so that only the stage itself is timed. The stages
+    are those that `snippets._highlight_doc_timed` records.
+    """
+    query = snippets.compile_query(query)
+    indicators = query.opinion_indicators
+    prepared = [snippets.prepare_document(doc, indicators) for doc in docs]
+    ranked = [snippets._rank_sentences(doc, query) for doc in prepared]
+    selected = [snippets._select_snippet_sentences(doc, query, max_chars,
+                                                   max_sents, 'greedy', ranks)
+                for (doc, ranks) in zip(prepared, ranked)]
+    spans = [snippets._snippet_offsets(doc, sentences, query)
+             for (doc, sentences) in zip(prepared, selected)]
+
+    def tokenize():
+        for doc in docs:
+            snippets.prepare_document(doc, indicators)
+
+    def score():
+        for doc in prepared:
+            snippets._rank_sentences(doc, query)
+
+    def select():
+        for (doc, ranks) in zip(prepared, ranked):
+            snippets._select_snippet_sentences(doc, query, max_chars,
+                                               max_sents, 'greedy', ranks)
+
+    def highlight():
+        for (doc, sentences) in zip(prepared, selected):
+            snippets._snippet_offsets(doc, sentences, query)
+
+    def join():
+        for (doc, doc_spans) in zip(prepared, spans):
+            snippets.render_spans(doc, doc_spans)
+
+    def end_to_end():
+        for doc in docs:
+            snippets.highlight_doc(doc, query, max_chars, max_sents)
+
+    return {'tokenize': tokenize, 'score': score, 'select': select,
+            'highlight': highlight, 'join': join, 'end-to-end': end_to_end}
+
+
+def measure(function, repeat):
+    """Return the fastest time in seconds of `repeat` calls of `function`,
+    and the peak bytes allocated by one call or None."""
+    best = INFINITY
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best, peak_allocated(function)
+
+
+def peak_allocated(function):
+    """Return the peak bytes allocated by one call of `function`, or None if
+    it cannot be measured here."""
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    if not hasattr(os, 'fork') or not os.path.exists(CLEAR_REFS):
+        return None
+
+    # A forked child inherits this process's peak resident set size, which an
+    # earlier stage may have raised, so the child resets it to its current
+    # resident set first. The growth of its peak is then what the call
+    # allocated.
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        status = 1
+        try:
+            os.close(read_end)
+            if reset_peak_rss():
+                before = peak_rss()
+                function()
+                os.write(write_end, struct.pack('q', peak_rss() - before))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    try:
+        data = os.read(read_end, 8)
+    finally:
+        os.close(read_end)
+        os.waitpid(pid, 0)
+    return struct.unpack('q', data)[0] if len(data) == 8 else None
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    try:
+        with open(PROC_STATUS) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and OS X bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current
+    resident set size, and return whether that is supported here."""
+    try:
+        with open(CLEAR_REFS, 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def run(scenarios, repeat, seed=0):
+    """Benchmark every stage of every scenario.
+
+    Returns:
+      Dict mapping each scenario name to a Dict that maps each stage to a
+      Dict of its "docs_per_sec" and "peak_bytes".
+    """
+    results = {}
+    for (name, count, sentences, words, query_length,
+         max_chars, max_sents) in scenarios:
+        docs = make_reviews(count, sentences, words, seed)
+        query = make_query(query_length, seed)
+        functions = stage_functions(docs, query, max_chars, max_sents)
+        results[name] = {}
+        for stage in STAGES:
+            seconds, peak = measure(functions[stage], repeat)
+            results[name][stage] = {'docs_per_sec': count / seconds,
+                                    'peak_bytes': peak}
+    return results
+
+
+def compare(results, baseline, threshold, memory_threshold=None):
+    """Find the stages that are slower or use more memory than in `baseline`.
+
+    Args:
+      results: Dict as returned by `run`.
+      baseline: Dict as returned by `run`, for an earlier version.
+      threshold: Float that is the fraction of throughput a stage may lose.
+      memory_threshold: Float that is the fraction by which a stage's peak
+        memory may grow, beyond `MEMORY_SLACK`, or None to not compare it.
+    Returns:
+      List of (scenario, stage, metric, baseline value, value) tuples for the
+      stages that regressed, where metric is "docs_per_sec" or "peak_bytes".
+      Scenarios, stages and peaks missing from either are skipped.
+    """
+    regressions = []
+    for name in sorted(results):
+        for stage in STAGES:
+            old = baseline.get(name, {}).get(stage)
+            new = results[name].get(stage)
+            if old is None or new is None:
+                continue
+            if new['docs_per_sec'] < old['docs_per_sec'] * (1 - threshold):
+                regressions.append((name, stage, 'docs_per_sec',
+                                    old['docs_per_sec'], new['docs_per_sec']))
+            old_peak, new_peak = old.get('peak_bytes'), new.get('peak_bytes')
+            if (memory_threshold is not None and old_peak is not None and
+                    new_peak is not None and
+                    new_peak > old_peak * (1 + memory_threshold) +
+                    MEMORY_SLACK):
+                regressions.append((name, stage, 'peak_bytes', old_peak,
+                                    new_peak))
+    return regressions
+
+
+def report(results, baseline=None):
+    """Print a table of `results`, with the change from `baseline` if any."""
+    print '%-16s %-11s %12s %10s %8s' % ('scenario', 'stage', 'docs/s',
+                                         'peak KB', 'change')
+    for (name, _, _, _, _, _, _) in SCENARIOS:
+        if name not in results:
+            continue
+        for stage in STAGES:
+            result = results[name][stage]
+            peak = result['peak_bytes']
+            change = ''
+            old = (baseline or {}).get(name, {}).get(stage)
+            if old is not None:
+                change = '%+7.1f%%' % (
+                    100.0 * (result['docs_per_sec'] / old['docs_per_sec'] - 1))
+            print '%-16s %-11s %12.0f %10s %8s' % (
+                name, stage, result['docs_per_sec'],
+                '%.0f' % (peak / 1024.0) if peak is not None else '-', change)
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                      help='Number of timed runs; the best one is reported.')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Seed of the synthetic reviews and queries.')
+    parser.add_option('--scenarios', dest='scenarios',
+                      help='Comma-separated names of the scenarios to run '
+                           '(default all).')
+    parser.add_option('--save', dest='save',
+                      help='JSON file to save the results to as a baseline.')
+    parser.add_option('--compare', dest='compare',
+                      help='JSON baseline to compare the results with.')
+    parser.add_option('--threshold', dest='threshold', type='float',
+                      default=0.2,
+                      help='Fraction of a baseline\'s docs/s that a stage may '
+                           'lose before the comparison fails (default 0.2).')
+    parser.add_option('--memory-threshold', dest='memory_threshold',
+                      type='float', default=0.5,
+                      help='Fraction by which a stage\'s peak memory may grow '
+                           'over the baseline\'s before the comparison fails '
+                           '(default 0.5).')
+    options, args = parser.parse_args(args)
+
+    scenarios = SCENARIOS
+    if options.scenarios:
+        names = options.scenarios.split(',')
+        unknown = set(names) - set(scenario[0] for scenario in SCENARIOS)
+        if unknown:
+            parser.error('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        scenarios = [scenario for scenario in SCENARIOS if scenario[0] in names]
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as infile:
+            baseline = json.load(infile)['results']
+
+    if tracemalloc is not None:
+        allocations = 'traced'
+    elif hasattr(os, 'fork') and os.path.exists(CLEAR_REFS):
+        allocations = 'measured as peak RSS growth (no tracemalloc)'
+    else:
+        allocations = 'not measured'
+    print 'Python %s; allocations %s' % (platform.python_version(),
+                                         allocations)
+    results = run(scenarios, options.repeat, options.seed)
+    report(results, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as outfile:
+            json.dump({'python': platform.python_version(),
+                       'seed': options.seed, 'results': results},
+                      outfile, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, options.threshold,
+                              options.memory_threshold)
+        for (name, stage, metric, old, new) in regressions:
+            if metric == 'docs_per_sec':
+                print 'REGRESSION %s/%s: %.0f -> %.0f docs/s' % (
+                    name, stage, old, new)
+            else:
+                print 'REGRESSION %s/%s: %.0f -> %.0f peak KB' % (
+                    name, stage, old / 1024.0, new / 1024.0)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Benchmark of the single-pass scan against the old split path.
+
+The old path normalized whitespace, split the document into sentence strings
+with one regex and then split each sentence into word strings with another.
+`snippets._scan` splits the document into words once and finds its sentences
+and their offsets; it is timed on its own. `snippets._tokenize` is reported as
+well, since it also lowercases the words, assigns their ids and counts opinion
+words. Throughput is reported in MB of review text per second.
+
+    python bench/bench_tokenize.py [--docs N] [--repeat N]
+"""
+
+
+from optparse import OptionParser
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import snippets
+
+
+WORDS = """the pizza was great and I love their deep dish crust but service
+    was slow we paid $9.47 for a slice it's amazing horrible sushi Thai food
+    pepperoni olive happy hour friendly staff avoid the wings""".split()
+
+
+def _old_split_into_sentences(doc):
+    doc = re.sub(r'\s+', ' ', doc)
+    pat = re.compile(r"""([A-Za-z0-9 ,'"@#$%^&*()~=+-]+(\.{3}|[.?!]))""")
+    sentences = [sent[0].strip() for sent in pat.findall(doc)]
+    if not sentences:
+        return [doc]
+    else:
+        return sentences
+
+
+def _old_split_into_words(sentence):
+    pat = re.compile(r"""
+            ['"]?[-A-Za-z0-9@#$%^&*()'~=+_-]+['"]? # letters, optionally quoted
+            |
+            ,                      # comma
+            |
+            \.{3}                  # ellipsis
+            |
+            [.?!]                  # other punctuation
+            """, re.VERBOSE)
+    return pat.findall(sentence)
+
+
+def old_split(doc):
+    """Tokenize `doc` the way `highlight_doc` did before `_tokenize`."""
+    return [_old_split_into_words(sent) for sent in _old_split_into_sentences(doc)]
+
+
+def make_docs(count, seed=0):
+    """Return `count` synthetic reviews of 2 to 30 sentences each."""
+    rand = random.Random(seed)
+    docs = []
+    for _ in xrange(count):
+        sentences = []
+        for _ in xrange(rand.randint(2, 30)):
+            words = [rand.choice(WORDS) for _ in xrange(rand.randint(3, 25))]
+            sentences.append(' '.join(words).capitalize() +
+                             rand.choice(('.', '.', '!', '?', '...')))
+        docs.append(' '.join(sentences))
+    return docs
+
+
+def throughput(split, docs, repeat):
+    """Return the best MB/s of `split` over `docs` across `repeat` runs."""
+    size = sum(len(doc) for doc in docs) / 1e6
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for doc in docs:
+            split(doc)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return size / best
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--docs', dest='docs', type='int', default=2000,
+                      help='Number of synthetic reviews to tokenize.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Number of timed runs; the best one is reported.')
+    options, args = parser.parse_args(args)
+
+    docs = make_docs(options.docs)
+    print '%d reviews, %.2f MB' % (len(docs),
+                                   sum(len(doc) for doc in docs) / 1e6)
+    old = throughput(old_split, docs, options.repeat)
+    scan = throughput(snippets._scan, docs, options.repeat)
+    tokenize = throughput(snippets._tokenize, docs, options.repeat)
+    print 'old split path:   %6.2f MB/s' % old
+    print 'single-pass scan: %6.2f MB/s (%.2fx)' % (scan, scan / old)
+    print 'full tokenize:    %6.2f MB/s (%.2fx)' % (tokenize, tokenize / old)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
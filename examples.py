@@ -44,7 +44,7 @@ DATA = [
      INFINITY, INFINITY
     ),
 
-    ('But at the moment the sentence breaking is a little stupid!',
+    ('Prices and other decimals do not end sentences.',
      'It cost $9.47.',
      'cost',
      INFINITY, INFINITY
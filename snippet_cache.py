@@ -0,0 +1,370 @@
+"""Cache of snippet results.
+
+`highlight_doc` always gives the same snippet for the same document, query and
+limits, so popular queries against popular reviews need only be snippeted
+once. A `ResultCache` stores snippets under a canonical key and keeps them in
+a backend: a `MemoryBackend` for one process, or a `SqliteBackend` file that
+all the worker processes on a machine share.
+
+
+Example Usage
+>>> cache = ResultCache(SqliteBackend('snippets.db', max_bytes=2 ** 26))
+>>> print cache.highlight_doc('I love pizza. Meh.', 'Pizza')
+I love [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].
+>>> cache.stats()['hits']
+0
+>>> print cache.highlight_doc('I love pizza. Meh.', 'pizza')
+I love [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].
+>>> cache.stats()['hits']
+1
+"""
+
+__all__ = ['ResultCache', 'MemoryBackend', 'SqliteBackend']
+
+
+import collections
+import hashlib
+import json
+import marshal
+import os
+import sqlite3
+import sys
+import time
+import weakref
+
+import snippets
+
+
+class ResultCache(object):
+    """Memoizes `snippets.highlight_doc` in a backend.
+
+    Keys are canonical, so requests that must give the same snippet share an
+    entry: queries are split and lowercased as for matching, and limits of
+    `snippets.INFINITY` or None are the same. Documents are keyed by a
+    caller's id when one is given, and otherwise by a hash of their text or
+    the text itself. Queries compiled with opinion indicators other than
+    `snippets.OPINION_INDICATORS` are keyed by a digest of them.
+
+    Attributes:
+      backend: The backend holding the snippets.
+      hits: Integer count of snippets found in the backend.
+      misses: Integer count of snippets that had to be made.
+    """
+
+    def __init__(self, backend=None, content_hash=True):
+        """Create a cache.
+
+        Args:
+          backend: A `MemoryBackend`, a `SqliteBackend` or another object
+            with their get, put, clear and stats methods. Defaults to a
+            `MemoryBackend`.
+          content_hash: Boolean. Whether documents without an id are keyed by
+            the SHA-1 of their text rather than by the text itself.
+        """
+        self.backend = MemoryBackend() if backend is None else backend
+        self.content_hash = content_hash
+        self.hits = self.misses = 0
+
+    def key(self, doc, query, max_chars=snippets.INFINITY,
+            max_sents=snippets.INFINITY, strategy='greedy', doc_id=None):
+        """Return the canonical key of a request.
+
+        The arguments are as for `highlight_doc`.
+
+        Returns:
+          Tuple of Strings, Integers and None.
+        """
+        if doc_id is None:
+            if isinstance(doc, snippets.PreparedDocument):
+                doc = doc.text
+            if isinstance(doc, unicode):
+                doc = doc.encode('utf-8')
+            doc_key = ('sha1:' + hashlib.sha1(doc).hexdigest()
+                       if self.content_hash else 'text:' + doc)
+        else:
+            doc_key = 'id:%s' % (doc_id,)
+
+        indicators = None
+        if isinstance(query, snippets.CompiledQuery):
+            terms = query.terms
+            expansions = tuple(tuple(phrase) for phrase in query.expansions)
+            indicators = _indicators_key(query.opinion_indicators)
+        else:
+            terms = [word.lower() for word in snippets._split_into_words(query)]
+            expansions = ()
+        return (doc_key, ' '.join(terms), expansions, indicators,
+                _limit(max_chars), _limit(max_sents), strategy)
+
+    def highlight_doc(self, doc, query, max_chars=snippets.INFINITY,
+                      max_sents=snippets.INFINITY, strategy='greedy',
+                      doc_id=None):
+        """Return the snippet of `snippets.highlight_doc`, cached.
+
+        Args:
+          doc: String or `snippets.PreparedDocument` to be highlighted.
+          query: String of query words or a `snippets.CompiledQuery`.
+          max_chars: Integer indicating the max number of chars in the snippet.
+          max_sents: Integer indicating the max number of sentences in the
+            snippet.
+          strategy: String in `snippets.STRATEGIES`.
+          doc_id: Hashable id of the document, such as a review id, or None.
+            A document's text must not change while its id is cached.
+        Returns:
+          The snippet.
+        """
+        key = self.key(doc, query, max_chars, max_sents, strategy, doc_id)
+        snippet = self.backend.get(key)
+        if snippet is not None:
+            self.hits += 1
+            return snippet
+        self.misses += 1
+        snippet = snippets.highlight_doc(doc, query, max_chars, max_sents,
+                                         strategy)
+        self.backend.put(key, snippet)
+        return snippet
+
+    def clear(self):
+        """Remove all snippets from the backend. The counters are not reset."""
+        self.backend.clear()
+
+    def stats(self):
+        """Return a Dict of the cache's counters and its backend's stats."""
+        stats = self.backend.stats()
+        stats.update(hits=self.hits, misses=self.misses)
+        return stats
+
+
+def _indicators_key(indicators):
+    """Return the part of a key naming the opinion indicators of a query.
+
+    Returns:
+      None for `snippets.OPINION_INDICATORS`, and otherwise a String that is
+      the hex SHA-1 of a lexicon's entries or of a Set's sorted words.
+    """
+    if indicators is snippets.OPINION_INDICATORS:
+        return None
+    if isinstance(indicators, snippets.OpinionLexicon):
+        return 'lexicon:' + indicators.digest().encode('hex')
+
+    # Hashing a large Set for every request would cost more than the lookup,
+    # so digests are kept by id for as long as the Set lives.
+    key = id(indicators)
+    cached = _set_digests.get(key)
+    if cached is not None and cached[0]() is indicators:
+        return cached[1]
+    words = sorted(word.encode('utf-8') if isinstance(word, unicode) else word
+                   for word in indicators)
+    digest = 'set:' + hashlib.sha1('\n'.join(words)).hexdigest()
+
+    def forget(ref):
+        if _set_digests.get(key, (None,))[0] is ref:
+            del _set_digests[key]
+    try:
+        _set_digests[key] = (weakref.ref(indicators, forget), digest)
+    except TypeError:
+        pass
+    return digest
+
+# Maps the id of each Set of indicators keyed so far to a weak reference to
+# it and its digest.
+_set_digests = {}
+
+
+def _limit(value):
+    """Return a max_chars or max_sents value in canonical form."""
+    if value is None or value == snippets.INFINITY:
+        return None
+    return int(value)
+
+
+class MemoryBackend(object):
+    """A least-recently-used store of snippets in this process's memory.
+
+    Snippets are evicted, oldest use first, when their total size with their
+    keys goes over `max_bytes`, and are dropped when read after `ttl` seconds.
+
+    Attributes:
+      max_bytes: Integer that is the most memory the snippets may use.
+      ttl: Number of seconds a snippet is kept for, or None to keep it until
+        it is evicted.
+      nbytes: Integer that is the memory the snippets use now.
+      evictions: Integer count of snippets evicted to stay under max_bytes.
+      expirations: Integer count of snippets dropped after `ttl`.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.evictions = self.expirations = 0
+        # Maps keys to (snippet, size, expiry time) triples, least recently
+        # used first.
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the snippet for `key`, or None if there is none."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] <= time.time():
+            self.nbytes -= entry[1]
+            self.expirations += 1
+            return None
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, snippet):
+        """Store `snippet` under `key`, evicting old snippets to make room."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+        size = (sys.getsizeof(snippet) + sys.getsizeof(key) +
+                sum(sys.getsizeof(part) for part in key))
+        if size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else time.time() + self.ttl
+        self._entries[key] = (snippet, size, expires)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            old_key, old = self._entries.popitem(last=False)
+            self.nbytes -= old[1]
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all snippets."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Return a Dict of the backend's size and counters."""
+        return {'entries': len(self._entries), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+class SqliteBackend(object):
+    """A least-recently-used store of snippets in a SQLite file.
+
+    Any number of processes may open the same file and share its snippets.
+    The size of the snippets and their keys is kept under `max_bytes` by
+    evicting the least recently used, and snippets read after `ttl` seconds
+    are dropped.
+
+    Attributes:
+      path: String that is the database file.
+      max_bytes: Integer that is the most bytes of snippets to store.
+      ttl: Number of seconds a snippet is kept for, or None to keep it until
+        it is evicted.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snippets (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires REAL,
+            used REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS snippets_used ON snippets (used);
+        CREATE TABLE IF NOT EXISTS totals (nbytes INTEGER NOT NULL);
+        INSERT INTO totals SELECT 0 WHERE NOT EXISTS (SELECT * FROM totals);
+        CREATE TRIGGER IF NOT EXISTS snippets_insert AFTER INSERT ON snippets
+            BEGIN UPDATE totals SET nbytes = nbytes + new.size; END;
+        CREATE TRIGGER IF NOT EXISTS snippets_delete AFTER DELETE ON snippets
+            BEGIN UPDATE totals SET nbytes = nbytes - old.size; END;
+        """
+
+    # Number of least recently used snippets evicted at a time.
+    _EVICT_BATCH = 64
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, ttl=None,
+                 timeout=10.0):
+        """Open or create the store at `path`.
+
+        Args:
+          path: String that is the database file.
+          max_bytes: Integer that is the most bytes of snippets to store.
+          ttl: Number of seconds a snippet is kept for, or None.
+          timeout: Number of seconds to wait for another process's write.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+        with self._connect() as connection:
+            connection.executescript(self._SCHEMA)
+
+    def _connect(self):
+        """Return this process's connection, opening it if needed.
+
+        Connections are not shared with forked worker processes.
+        """
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, self.timeout)
+            self._pid = os.getpid()
+        return self._connection
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM snippets').fetchone()[0]
+
+    def get(self, key):
+        """Return the snippet for `key`, or None if there is none."""
+        key = json.dumps(key)
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            row = connection.execute(
+                'SELECT value, expires FROM snippets WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] <= now:
+                connection.execute('DELETE FROM snippets WHERE key = ?', (key,))
+                return None
+            connection.execute('UPDATE snippets SET used = ? WHERE key = ?',
+                               (now, key))
+        return marshal.loads(str(row[0]))
+
+    def put(self, key, snippet):
+        """Store `snippet` under `key`, evicting old snippets to make room."""
+        key = json.dumps(key)
+        value = marshal.dumps(snippet)
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        connection = self._connect()
+        with connection:
+            connection.execute('DELETE FROM snippets WHERE key = ?', (key,))
+            connection.execute(
+                'INSERT INTO snippets VALUES (?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(value), size, expires, now))
+            while connection.execute(
+                    'SELECT nbytes FROM totals').fetchone()[0] > self.max_bytes:
+                connection.execute(
+                    'DELETE FROM snippets WHERE key IN (SELECT key FROM '
+                    'snippets ORDER BY used LIMIT ?)', (self._EVICT_BATCH,))
+
+    def clear(self):
+        """Remove all snippets."""
+        with self._connect() as connection:
+            connection.execute('DELETE FROM snippets')
+
+    def stats(self):
+        """Return a Dict of the store's size."""
+        connection = self._connect()
+        nbytes = connection.execute('SELECT nbytes FROM totals').fetchone()[0]
+        return {'entries': len(self), 'nbytes': nbytes,
+                'max_bytes': self.max_bytes}
+
+    def close(self):
+        """Close this process's connection."""
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = self._pid = None
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+
+"""HTTP/JSON snippet service.
+
+A `SnippetService` takes snippet requests from many threads, coalesces
+identical requests that are in flight at the same time and groups the rest
+into small batches, which are snippeted by a pool of worker processes. Reviews
+are named by their id in a `snippet_store` or sent as text.
+
+`main` serves a `SnippetService` over HTTP on one port:
+
+  POST /snippet  {"id": "r1", "query": "pizza", "max_chars": 200}
+                 -> {"snippet": "I love [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]]."}
+  GET /stats     -> {"requests": 1, "p50_ms": 1.2, "p99_ms": 1.2, ...}
+
+A request holds "query" and either "id" or "text", and optionally
+"max_chars", "max_sents" and "strategy" as for `snippets.highlight_doc`. With
+"spans": true the reply holds the offsets of `snippets.snippet_spans` in
+place of the tagged snippet:
+
+  POST /snippet  {"id": "r1", "query": "pizza", "spans": true}
+                 -> {"sentences": [[0, 13]], "highlights": [[7, 12]]}
+
+
+Example Usage
+>>> service = SnippetService('reviews.store', workers=4)
+>>> print service.snippet('pizza', doc_id='r1')
+I love [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].
+>>> service.close()
+"""
+
+__all__ = ['SnippetService', 'Overloaded', 'TimedOut', 'SnippetHTTPServer']
+
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import collections
+import json
+import math
+import multiprocessing
+from optparse import OptionParser
+import Queue
+from SocketServer import ThreadingMixIn
+import sys
+import threading
+import time
+
+import snippet_store
+import snippets
+
+
+# Number of recent request latencies that percentiles are computed from.
+LATENCY_WINDOW = 10000
+
+
+class Overloaded(Exception):
+    """Raised when a `SnippetService` already has its max pending requests."""
+
+
+class TimedOut(RuntimeError):
+    """Raised when a request's snippet is not done within its timeout."""
+
+
+class _Pending(object):
+    """A request that has been submitted but not yet snippeted."""
+    __slots__ = ('key', 'done', 'snippet', 'error')
+
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.snippet = None
+        self.error = None
+
+
+class SnippetService(object):
+    """Snippets requests from many threads in batches on a process pool.
+
+    Identical requests made while the first of them is pending share its
+    result. Other requests wait in a queue until `max_batch` of them have
+    arrived or the first has waited `max_delay` seconds, and are then sent to
+    a worker together. When `max_pending` distinct requests are already
+    pending new ones are refused with `Overloaded` rather than queued.
+    """
+
+    def __init__(self, store=None, workers=None, max_batch=32, max_delay=0.002,
+                 max_pending=1024):
+        """Start the service.
+
+        Args:
+          store: String that is the path of a `snippet_store` file that
+            requests may name reviews from, or None.
+          workers: Integer number of worker processes. Defaults to the number
+            of CPUs. With 1, batches are snippeted in a thread of this process.
+          max_batch: Integer that is the max number of requests in a batch.
+          max_delay: Float that is the max number of seconds a request waits
+            for others to batch with.
+          max_pending: Integer that is the max number of distinct requests
+            queued or being snippeted at once.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queue = Queue.Queue()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.batches = 0
+
+        if workers > 1:
+            self._pool = multiprocessing.Pool(workers, _init_worker, (store,))
+            self._store = None
+        else:
+            self._pool = None
+            self._store = _open_store(store)
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, query, doc_id=None, text=None, max_chars=snippets.INFINITY,
+               max_sents=snippets.INFINITY, strategy='greedy', spans=False):
+        """Queue a request without waiting for its snippet.
+
+        Args:
+          query: String of query words.
+          doc_id: String that is the id of a review in the store.
+          text: String that is the review itself, used if `doc_id` is None.
+          max_chars: Integer indicating the max number of chars in the snippet.
+          max_sents: Integer indicating the max number of sentences in the
+            snippet.
+          strategy: String in `snippets.STRATEGIES`.
+          spans: Boolean. Whether the result is the (sentences, highlights)
+            offsets of `snippets.snippet_spans` rather than the snippet.
+        Returns:
+          A pending request to pass to `result`.
+        Raises:
+          Overloaded: `max_pending` requests are already pending.
+        """
+        if doc_id is not None:
+            key = (True, doc_id, query, max_chars, max_sents, strategy,
+                   spans)
+        else:
+            key = (False, text, query, max_chars, max_sents, strategy, spans)
+
+        with self._lock:
+            self.requests += 1
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                return pending
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded('%d requests are pending' % self.max_pending)
+            pending = self._pending[key] = _Pending(key)
+        self._queue.put(pending)
+        return pending
+
+    def result(self, pending, timeout=None):
+        """Wait for and return the snippet of a request from `submit`.
+
+        A request that times out is no longer pending, so it stops counting
+        against `max_pending` even if its worker never answers, and the next
+        identical request is snippeted anew.
+
+        Raises:
+          KeyError: The request named a review that is not in the store.
+          ValueError: The request had an invalid option.
+          TimedOut: The snippet was not done within `timeout` seconds.
+          Exception: Snippeting the request failed in another way.
+        """
+        if not pending.done.wait(timeout):
+            self._discard(pending)
+            raise TimedOut('Timed out waiting for a snippet')
+        if pending.error is not None:
+            raise pending.error
+        return pending.snippet
+
+    def snippet(self, query, doc_id=None, text=None,
+                max_chars=snippets.INFINITY, max_sents=snippets.INFINITY,
+                strategy='greedy', timeout=None, spans=False):
+        """Return the snippet for one request, waiting until it is done.
+
+        The arguments are as for `submit` and the errors as for `submit` and
+        `result`.
+        """
+        start = time.time()
+        pending = self.submit(query, doc_id, text, max_chars, max_sents,
+                              strategy, spans)
+        snippet = self.result(pending, timeout)
+        latency = time.time() - start
+        with self._lock:
+            self._latencies.append(latency)
+        return snippet
+
+    def stats(self):
+        """Return a Dictionary of request counts and latency percentiles.
+
+        Latencies are of requests made with `snippet`, in milliseconds, over
+        the last `LATENCY_WINDOW` of them.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {'requests': self.requests, 'coalesced': self.coalesced,
+                     'rejected': self.rejected, 'batches': self.batches,
+                     'pending': len(self._pending)}
+        stats['p50_ms'] = _percentile(latencies, 50) * 1000
+        stats['p99_ms'] = _percentile(latencies, 99) * 1000
+        return stats
+
+    def close(self):
+        """Stop the service once the queued requests are done."""
+        self._queue.put(None)
+        self._dispatcher.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        elif self._store is not None:
+            self._store.close()
+
+    def _dispatch(self):
+        """Gather queued requests into batches. This runs in its own thread."""
+        stopping = False
+        while not stopping:
+            pending = self._queue.get()
+            if pending is None:
+                break
+            batch = [pending]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+
+            with self._lock:
+                self.batches += 1
+            keys = [pending.key for pending in batch]
+            if self._pool is None:
+                # An error here must not stop the thread, or no request
+                # would be answered again.
+                try:
+                    results = _snippet_chunk(keys, self._store)
+                except Exception as error:
+                    results = [(None, error)] * len(batch)
+                self._finish(batch, results)
+            else:
+                # A worker that dies never calls back, so its requests are
+                # only cleared when their callers time out.
+                self._pool.apply_async(
+                    _snippet_chunk, (keys,),
+                    callback=lambda results, batch=batch: self._finish(batch,
+                                                                       results))
+
+    def _discard(self, pending):
+        """Stop counting `pending` as pending, if it still is."""
+        with self._lock:
+            if self._pending.get(pending.key) is pending:
+                del self._pending[pending.key]
+
+    def _finish(self, batch, results):
+        """Hand the results of a batch to the requests waiting for them."""
+        for (pending, (snippet, error)) in zip(batch, results):
+            self._discard(pending)
+            pending.snippet = snippet
+            pending.error = error
+            pending.done.set()
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank `percent` percentile of sorted `values`."""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+# The store opened in a worker by `_init_worker`.
+_store = None
+
+
+def _open_store(path):
+    """Return the `snippet_store.PreparedStore` at `path`, or None."""
+    if path is None:
+        return None
+    return snippet_store.PreparedStore(path)
+
+
+def _init_worker(path):
+    """Open the store at `path` for `_snippet_chunk` in a worker process."""
+    global _store
+    _store = _open_store(path)
+
+
+def _snippet_chunk(batch, store=None):
+    """Snippet a batch of requests. This runs in `SnippetService` workers.
+
+    Args:
+      batch: List of request keys built by `SnippetService.submit`.
+      store: The `snippet_store.PreparedStore` to look up reviews in. Defaults
+        to the one opened by `_init_worker`.
+    Returns:
+      List of (snippet, error) pairs in the same order as `batch`. Either the
+      snippet or the error is None. An error snippeting one request does not
+      affect the others.
+    """
+    # Batches tend to repeat queries so each is only compiled once.
+    if store is None:
+        store = _store
+    compiled = {}
+    results = []
+    for (by_id, doc, query, max_chars, max_sents, strategy, spans) in batch:
+        try:
+            if by_id:
+                if store is None:
+                    raise KeyError(doc)
+                doc = store[doc]
+            if query not in compiled:
+                compiled[query] = snippets.compile_query(query)
+            snippet = snippets.snippet_spans if spans else \
+                snippets.highlight_doc
+            results.append((snippet(doc, compiled[query], max_chars,
+                                    max_sents, strategy), None))
+        except Exception as error:
+            results.append((None, error))
+    return results
+
+
+class SnippetHTTPServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server answering snippet requests from a `SnippetService`."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, timeout=30.0):
+        """Listen on `address`, a (host, port) pair, and serve `service`.
+
+        A request whose snippet takes longer than `timeout` seconds is
+        answered with 504.
+        """
+        HTTPServer.__init__(self, address, _SnippetHandler)
+        self.service = service
+        self.request_timeout = timeout
+
+
+class _SnippetHandler(BaseHTTPRequestHandler):
+    """Handles the requests of a `SnippetHTTPServer`."""
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'Not found: %s' % self.path})
+        self._reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/snippet':
+            return self._reply(404, {'error': 'Not found: %s' % self.path})
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            query = request['query']
+        except (ValueError, KeyError, TypeError):
+            return self._reply(400, {'error': 'Expected a JSON object with '
+                                              'a "query"'})
+        if 'id' not in request and 'text' not in request:
+            return self._reply(400, {'error': 'Expected an "id" or a "text"'})
+
+        try:
+            snippet = self.server.service.snippet(
+                query, request.get('id'), request.get('text'),
+                request.get('max_chars', snippets.INFINITY),
+                request.get('max_sents', snippets.INFINITY),
+                request.get('strategy', 'greedy'),
+                timeout=self.server.request_timeout,
+                spans=bool(request.get('spans')))
+        except Overloaded as error:
+            return self._reply(503, {'error': str(error)})
+        except TimedOut as error:
+            return self._reply(504, {'error': str(error)})
+        except KeyError as error:
+            return self._reply(404, {'error': 'Unknown review: %s' % error})
+        except (ValueError, TypeError, AttributeError) as error:
+            return self._reply(400, {'error': str(error)})
+        except Exception as error:
+            return self._reply(500, {'error': 'Snippeting failed: %r' % error})
+        if request.get('spans'):
+            sentences, highlights = snippet
+            return self._reply(200, {'sentences': sentences,
+                                     'highlights': highlights})
+        self._reply(200, {'snippet': snippet})
+
+    def _reply(self, status, body):
+        """Send `body` as JSON with the HTTP `status`."""
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Skip logging each request to stderr."""
+
+
+def main(args):
+    """Serve snippets over HTTP/JSON.
+
+    Reviews are named by id from the --store written by snippet_store.py, or
+    sent as text in each request.
+    """
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, description=main.__doc__.split('\n')[0])
+    parser.add_option('--store', dest='store',
+        help='Store of prepared reviews written by snippet_store.py.')
+    parser.add_option('--host', dest='host', default='127.0.0.1',
+        help='Address to listen on (default 127.0.0.1).')
+    parser.add_option('-p', '--port', dest='port', default=8000, type='int',
+        help='Port to listen on (default 8000).')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        help='Number of worker processes (default the number of CPUs).')
+    parser.add_option('--max-batch', dest='max_batch', default=32, type='int',
+        help='Max number of requests sent to a worker at once (default 32).')
+    parser.add_option('--max-delay', dest='max_delay', default=2.0,
+        type='float',
+        help='Max milliseconds a request waits to be batched (default 2).')
+    parser.add_option('--max-pending', dest='max_pending', default=1024,
+        type='int',
+        help='Max number of pending requests before new ones are refused '
+             'with 503 (default 1024).')
+    parser.add_option('--timeout', dest='timeout', default=30.0,
+        type='float',
+        help='Seconds a request may wait for its snippet before it is '
+             'answered with 504 (default 30).')
+    options, args = parser.parse_args(args)
+
+    if args:
+        parser.error('Incorrect number of arguments.')
+
+    service = SnippetService(options.store, options.workers, options.max_batch,
+                             options.max_delay / 1000.0, options.max_pending)
+    server = SnippetHTTPServer((options.host, options.port), service,
+                               options.timeout)
+    print >> sys.stderr, 'Serving snippets on http://%s:%d' % (
+        server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""On-disk store of prepared reviews for snippet workers.
+
+A store holds the tokenization and opinion features of a whole review corpus,
+computed offline by `write_store`. Workers open it with `PreparedStore`, which
+memory-maps the file so that any number of worker processes share one copy in
+the page cache, and snippet a review by id without tokenizing it again.
+
+
+Example Usage
+>>> write_store('reviews.store', [('r1', 'I love pizza. Meh.')])
+>>> store = PreparedStore('reviews.store')
+>>> print snippets.highlight_doc(store['r1'], 'pizza')
+I love [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].
+
+
+File Layout
+All integers are little-endian.
+  * A header: magic, format version, review count, offset of the index and a
+    digest of the opinion lexicon the features were computed with.
+  * One record per review: a small header giving the text encoding and the
+    text, token and sentence sizes, then the UTF-8 text and the int32 arrays
+    of word starts, word ends, sentence bounds, per-sentence opinion counts
+    and per-sentence word character counts.
+  * The index: for each review its id and the offset of its record.
+"""
+
+__all__ = ['write_store', 'PreparedStore']
+
+
+from array import array
+import hashlib
+import mmap
+import struct
+import sys
+
+import snippets
+
+
+MAGIC = 'SNIPSTOR'
+VERSION = 1
+
+# magic, version, review count, index offset, lexicon digest
+_HEADER = struct.Struct('<8sIIQ20s')
+# is unicode, text bytes, tokens, sentences
+_RECORD = struct.Struct('<BIII')
+# id bytes, record offset
+_INDEX_ENTRY = struct.Struct('<IQ')
+
+_ARRAY_ITEMSIZE = 4
+assert array('i').itemsize == _ARRAY_ITEMSIZE
+
+
+def _lexicon_digest(opinion_indicators):
+    """Return a digest identifying a set of opinion-indicating words or a
+    `snippets.OpinionLexicon`."""
+    if isinstance(opinion_indicators, snippets.OpinionLexicon):
+        return opinion_indicators.digest()
+    return hashlib.sha1('\n'.join(sorted(opinion_indicators))).digest()
+
+
+def _to_bytes(values):
+    """Return the little-endian bytes of an int32 array."""
+    if sys.byteorder == 'big':
+        values = array('i', values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _from_bytes(data):
+    """Return the int32 array stored little-endian in `data`."""
+    values = array('i')
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def write_store(path, documents, opinion_indicators=snippets.OPINION_INDICATORS):
+    """Prepare `documents` and write them to a store at `path`.
+
+    Documents are written as they are read, so only the index is held in
+    memory.
+
+    Args:
+      path: String that is the file to write.
+      documents: Iterable of (id, document) pairs. Ids are Strings, or
+        values such as Integers that are stored as their String form, and
+        documents are Strings or `snippets.PreparedDocument`s.
+      opinion_indicators: Set of opinion-indicating words or a
+        `snippets.OpinionLexicon` to count.
+    Returns:
+      Integer that is the number of documents written.
+    """
+    index = []
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, 0, '\0' * 20))
+        for (doc_id, doc) in documents:
+            prepared = snippets.prepare_document(doc, opinion_indicators)
+            if prepared.opinion_indicators is not opinion_indicators:
+                prepared = snippets.prepare_document(prepared.text,
+                                                     opinion_indicators)
+            index.append((doc_id, f.tell()))
+            _write_record(f, prepared)
+
+        index_offset = f.tell()
+        for (doc_id, offset) in index:
+            doc_id = _key(doc_id)
+            f.write(_INDEX_ENTRY.pack(len(doc_id), offset))
+            f.write(doc_id)
+
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, len(index), index_offset,
+                             _lexicon_digest(opinion_indicators)))
+    return len(index)
+
+
+def _write_record(f, prepared):
+    """Write one prepared document at the current position of `f`."""
+    is_unicode = isinstance(prepared.text, unicode)
+    text = prepared.text.encode('utf-8') if is_unicode else prepared.text
+    f.write(_RECORD.pack(is_unicode, len(text), len(prepared.starts),
+                         len(prepared)))
+    f.write(text)
+    for values in (prepared.starts, prepared.ends, prepared.bounds,
+                   prepared.opinion_counts, prepared.word_chars):
+        f.write(_to_bytes(values))
+
+
+class PreparedStore(object):
+    """A read-only, memory-mapped store written by `write_store`.
+
+    The index of ids is read when the store is opened. Reviews are read from
+    the mapped file on demand.
+    """
+
+    def __init__(self, path, opinion_indicators=snippets.OPINION_INDICATORS):
+        """Open the store at `path`.
+
+        Args:
+          path: String that is the file to open.
+          opinion_indicators: Set of opinion-indicating words or a
+            `snippets.OpinionLexicon`. It must be the one the store was
+            written with.
+        Raises:
+          ValueError: The file is not a store, or was written with a
+            different version or opinion lexicon.
+        """
+        self.path = path
+        self.opinion_indicators = opinion_indicators
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, index_offset, digest = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a snippet store: %s' % path)
+        if version != VERSION:
+            raise ValueError('Unsupported store version %d: %s' % (version,
+                                                                   path))
+        if digest != _lexicon_digest(opinion_indicators):
+            raise ValueError('Store was written with a different opinion '
+                             'lexicon: %s' % path)
+
+        self._offsets = {}
+        pos = index_offset
+        for _ in xrange(count):
+            id_length, offset = _INDEX_ENTRY.unpack_from(self._map, pos)
+            pos += _INDEX_ENTRY.size
+            self._offsets[self._map[pos: pos + id_length]] = offset
+            pos += id_length
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, doc_id):
+        return _key(doc_id) in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __getitem__(self, doc_id):
+        prepared = self.get(doc_id)
+        if prepared is None:
+            raise KeyError(doc_id)
+        return prepared
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, doc_id):
+        """Return the `snippets.PreparedDocument` for `doc_id`, or None."""
+        offset = self._offsets.get(_key(doc_id))
+        if offset is None:
+            return None
+
+        mapped = self._map
+        is_unicode, text_length, tokens, sentences = _RECORD.unpack_from(
+            mapped, offset)
+        pos = offset + _RECORD.size
+        text = mapped[pos: pos + text_length]
+        if is_unicode:
+            text = text.decode('utf-8')
+        pos += text_length
+
+        values = []
+        for length in (tokens, tokens, sentences + 1, sentences, sentences):
+            end = pos + length * _ARRAY_ITEMSIZE
+            values.append(_from_bytes(mapped[pos: end]))
+            pos = end
+        starts, ends, bounds, opinion_counts, word_chars = values
+        return snippets.PreparedDocument(text, starts, ends, bounds,
+                                         self.opinion_indicators,
+                                         opinion_counts, word_chars)
+
+    def close(self):
+        """Unmap the file."""
+        self._map.close()
+
+
+def _key(doc_id):
+    """Return `doc_id` as it is stored in the index, a UTF-8 String."""
+    if isinstance(doc_id, unicode):
+        return doc_id.encode('utf-8')
+    return str(doc_id)
+
+
+def main(args):
+    """Build a store from a JSON-lines file of reviews.
+
+    Each line holds one review, with its id under --id-field and its text
+    under --text-field.
+    """
+    from optparse import OptionParser
+    usage = '%prog <REVIEWS.jsonl> <OUTPUT.store> [options]'
+    parser = OptionParser(usage=usage, description=main.__doc__.split('\n')[0])
+    parser.add_option('--text-field', dest='text_field', default='text',
+        help='Field holding the review text (default "text").')
+    parser.add_option('--id-field', dest='id_field', default='review_id',
+        help='Field holding the review id (default "review_id").')
+    parser.add_option('--lexicon', dest='lexicon',
+        help='Weighted opinion lexicon to count instead of the built-in '
+             'indicator words.')
+    options, args = parser.parse_args(args)
+
+    if len(args) != 2:
+        parser.error('Incorrect number of arguments.')
+
+    opinion_indicators = snippets.OPINION_INDICATORS
+    if options.lexicon is not None:
+        opinion_indicators = snippets.load_lexicon(options.lexicon)
+
+    infile = sys.stdin if args[0] == '-' else open(args[0])
+    try:
+        records = snippets._read_jsonl(infile)
+        count = write_store(args[1], ((record[options.id_field],
+                                       record[options.text_field])
+                                      for record in records),
+                            opinion_indicators)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+    print >> sys.stderr, 'Wrote %d reviews to %s' % (count, args[1])
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
@@ -4,12 +4,24 @@
 
 Author: Colin Pollock ~ colin@colinpollock.net
 
-This module's only public function is `highlight_doc`, which takes a document 
+This module's main public function is `highlight_doc`, which takes a document 
 and a query and produces a snippet that is composed of sentences from the
 document with terms from the query highlighted. The number of characters and
 sentences in the snippet can be constrained by passing in integers for the 
 optional parameters `max_sents` and `max_chars`.
 
+When the same query is run against many documents it can be compiled once with
+`compile_query` and the resulting `CompiledQuery` passed to `highlight_doc` or
+`highlight_many` in place of the query string.
+
+Likewise a document that will be snippeted for many queries can be tokenized
+once with `prepare_document`, and a `DocumentCache` keeps the most recently
+used `PreparedDocument`s by id within a memory budget.
+
+Callers that mark up snippets themselves can get the snippet from
+`snippet_spans` as offsets into the document instead, and `render_spans` turns
+those into the String that `highlight_doc` returns.
+
 
 Example Usage
 >>> doc = 'The only good pizza is a pepperoni pizza.'
@@ -20,16 +32,34 @@ The only good [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]] is a [[HIGHLIGHT]]pepperoni \
 pizza[[ENDHIGHLIGHT]].
 """
 
-__all__ = ['highlight_doc']
+__all__ = ['highlight_doc', 'highlight_many', 'highlight_batch', 'compile_query',
+           'CompiledQuery', 'prepare_document', 'PreparedDocument',
+           'DocumentCache', 'ReviewIndex', 'best_snippets', 'PipelineStats',
+           'OpinionLexicon', 'load_lexicon', 'Scorer', 'LinearScorer',
+           'Vocabulary', 'VOCABULARY', 'write_snippet', 'Tags',
+           'snippet_spans', 'render_spans']
 
 
+from array import array
+import bisect
+import collections
+import heapq
+import itertools
+import marshal
 import operator
-from optparse import OptionParser
 import re
 import sys
+import threading
+import timeit
+import weakref
+
+# Modules that only the command line, process pools or lexicon digests need,
+# such as multiprocessing, optparse and json, are imported where they are
+# used so that importing this module for `highlight_doc` stays fast.
 
 
-# Words that are likely to be included in opinion-indicating sentences.
+# Words that are likely to be included in opinion-indicating sentences. A
+# weighted `OpinionLexicon` can be used in their place.
 OPINION_INDICATORS = set("""
     nice good better best beautiful great awesome amazing
     delicious favorite wonderful 
@@ -43,215 +73,2316 @@ PUNCTUATION = set(('.', '?', '!', '...'))
 
 OPENTAG, CLOSETAG = '[[HIGHLIGHT]]', '[[ENDHIGHLIGHT]]'
 
+# Tokens are found in a single scan of a document. A sentence ends after its
+# last punctuation mark; characters that are in no token are skipped.
+_WORD = r"""
+        ['"]?                   # a word, optionally quoted
+          (?:[-A-Za-z0-9@#$%^&*()'~=+_]+   # letters
+             (?:(?<=[0-9])\.[0-9]+)*       # and decimal places, as in $9.47
+          |\.[0-9]+                        # or decimals like .47
+          )['"]?"""
+TOKEN_PATTERN = re.compile(r"""
+        (%s)                    # 1: a word
+        |
+        (,)                     # 2: comma
+        |
+        (\.{3}|[.?!])           # 3: ellipsis or other punctuation
+        """ % _WORD, re.VERBOSE)
+# The same tokens in one group, so that splitting a document on them gives
+# the text between tokens and the tokens, alternately, as Strings.
+_SPLIT_PATTERN = re.compile(r"""
+        (%s|,|\.{3}|[.?!])
+        """ % _WORD, re.VERBOSE)
+_SPAN = operator.methodcaller('span')
+_KIND = operator.attrgetter('lastindex')
+# Matches a run of punctuation in a bytearray of token kinds (group numbers).
+_SENTENCE_END = re.compile('\x03+(?=[^\x03])')
+# Matches a run of punctuation in a bytearray of whether each token is in
+# `PUNCTUATION`.
+_PUNCTUATION_RUN = re.compile('\x01+(?=\x00)')
+
 INFINITY = float('infinity')
 
+# Matches anywhere an opinion indicator might be, so that sentences without
+# one can be skipped. It also matches some words that are not indicators, such
+# as "-like", which is harmless. Only long documents need it, so it is
+# compiled by `_opinion_prefilter` on first use rather than on import.
+_OPINION_PREFILTER = None
+
+# The first bytes of a compiled lexicon written by `OpinionLexicon.save`.
+LEXICON_MAGIC = 'SNIPLEX1'
+
+# The most precise wall clock, used to time the stages of `highlight_doc`.
+_timer = timeit.default_timer
+
+# The snippet selection strategies. 'greedy' takes sentences from the highest
+# score down while they fit; 'optimal' maximizes the total score that fits in
+# `max_chars` and `max_sents`.
+STRATEGIES = ('greedy', 'optimal')
+
+# The 'optimal' strategy falls back to 'greedy' when more sentences than this
+# could be selected, and it measures sentences in units of max_chars divided
+# by this many buckets. Both bound its time and memory per document.
+OPTIMAL_MAX_SENTENCES = 32
+OPTIMAL_CHAR_BUCKETS = 128
+
+# Batches smaller than this are snippeted in-process by `highlight_batch`
+# since starting worker processes would cost more than it saves.
+MIN_PARALLEL_BATCH = 64
+
+# The number of functions listed in the cProfile report of --profile.
+PROFILE_LINES = 25
+
+# Greedy snippets of documents of at least LAZY_MIN_CHARS characters only
+# tokenize the sentences around possible query words and opinion indicators,
+# unless there is one every LAZY_HIT_SPACING characters or more often. Those
+# sentences are found by tokenizing from LAZY_BACKOFF characters before each.
+LAZY_MIN_CHARS = 2000
+LAZY_HIT_SPACING = 400
+LAZY_BACKOFF = 120
+
+# `VOCABULARY` is emptied when a document is prepared after it reaches this
+# many words, so that one-off texts, prices and typos cannot grow it forever.
+# Each word costs about its size plus VOCABULARY_ENTRY_BYTES.
+VOCABULARY_MAX_WORDS = 1 << 18
+VOCABULARY_ENTRY_BYTES = 80
+
+
+class Vocabulary(dict):
+    """A mapping from lowercased words to Integer ids, assigned on first use.
+
+    Documents and queries store their words as ids from the shared
+    `VOCABULARY`, so each distinct word is kept once however many times it
+    occurs, and words are matched by comparing Integers. Ids are only
+    meaningful within one process.
+
+    Every word seen is kept, so the vocabulary is bounded by `max_words`:
+    once it has that many, preparing another document starts it again empty
+    and increments `generation`. Documents and queries note the generation
+    of their ids and assign them again when they are next used.
+
+    Attributes:
+      words: List of the words, indexed by id.
+      max_words: Integer number of words after which the vocabulary is reset.
+      generation: Integer number of times the vocabulary has been reset.
+      nbytes: Integer that is the approximate memory the words use.
+    """
+
+    def __init__(self, max_words=VOCABULARY_MAX_WORDS):
+        dict.__init__(self)
+        self.words = []
+        self.max_words = max_words
+        self.generation = 0
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def __missing__(self, word):
+        # Threads preparing documents at once must not give two words one id.
+        with self._lock:
+            word_id = self.get(word)
+            if word_id is None:
+                word_id = len(self.words)
+                self.words.append(word)
+                self[word] = word_id
+                self.nbytes += sys.getsizeof(word) + VOCABULARY_ENTRY_BYTES
+        return word_id
+
+    def ids(self, words):
+        """Return an array('I') of the ids of `words`, adding new ones."""
+        return array('I', itertools.imap(self.__getitem__, words))
+
+    def make_room(self):
+        """Reset the vocabulary if it has `max_words` words.
+
+        This is only called before a new document's words are added, so that
+        the ids used while ranking one document for one query are all of the
+        same generation.
+        """
+        if len(self.words) >= self.max_words:
+            self.reset()
+
+    def reset(self):
+        """Remove every word, invalidating the ids given out so far."""
+        with self._lock:
+            self.clear()
+            self.words = []
+            self.nbytes = 0
+            self.generation += 1
+
+
+# The vocabulary shared by every document and query in the process.
+VOCABULARY = Vocabulary()
+
+
+class Tags(object):
+    """How highlighted spans are marked when a snippet is written.
+
+    A snippet's sentences are selected the same whatever tags it is written
+    with: max_chars counts the text as written plus `OPENTAG` and `CLOSETAG`
+    around each span.
+
+    Attributes:
+      open_tag: String written before each highlighted span.
+      close_tag: String written after each highlighted span.
+      escape: Function applied to the text of the document as it is written,
+        such as `escape_html`, or None to write it unchanged.
+    """
+    __slots__ = ('open_tag', 'close_tag', 'escape')
+
+    def __init__(self, open_tag, close_tag, escape=None):
+        self.open_tag = open_tag
+        self.close_tag = close_tag
+        self.escape = escape
+
+    def __repr__(self):
+        return 'Tags(%r, %r, %r)' % (self.open_tag, self.close_tag,
+                                     self.escape)
+
+
+def escape_html(text):
+    """Return `text` with the characters special in HTML escaped, including
+    quotes, so that it can also be written inside an attribute value."""
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;')
+            .replace("'", '&#39;'))
+
+
+HIGHLIGHT_TAGS = Tags(OPENTAG, CLOSETAG)
+HTML_TAGS = Tags('<mark>', '</mark>', escape_html)
+ANSI_TAGS = Tags('\x1b[1;33m', '\x1b[0m')
+# The tags that the command line's --tags option names.
+TAG_STYLES = {'highlight': HIGHLIGHT_TAGS, 'html': HTML_TAGS,
+              'ansi': ANSI_TAGS}
+
+
+class CompiledQuery(object):
+    """A query that has been split and normalized once for reuse.
+
+    Attributes:
+      words: List of Strings that are the query words as written.
+      terms: List of Strings that are the lowercased query words.
+      expansions: List of Lists of lowercased words. Each is an extra phrase,
+        such as a synonym or a dish name, that is matched as a whole.
+      matcher: A `_PhraseMatcher` for the `VOCABULARY` ids of every run of
+        consecutive `terms` and of each of `expansions`.
+      ids: Frozenset of the ids of the words in `vocabulary`.
+      generation: The `VOCABULARY.generation` of `matcher` and `ids`, which
+        are built again when they are read after the vocabulary is reset.
+      opinion_indicators: Set of Strings that are opinion-indicating words, or
+        an `OpinionLexicon`.
+      prefilter: A regular expression matching any of the query's words in
+        any case, built by `_query_prefilter` when first needed, or None.
+    """
+    __slots__ = ('words', 'terms', 'expansions', '_matcher', '_ids',
+                 'generation', 'opinion_indicators', 'prefilter')
+
+    def __init__(self, words, opinion_indicators=OPINION_INDICATORS,
+                 expansions=()):
+        self.words = list(words)
+        self.terms = [word.lower() for word in self.words]
+        self.expansions = [[word.lower() for word in phrase]
+                           for phrase in expansions]
+        self._build_matcher()
+        self.opinion_indicators = opinion_indicators
+        self.prefilter = None
+
+    def _build_matcher(self):
+        """Set `matcher` and `ids` from the current `VOCABULARY`."""
+        generation = VOCABULARY.generation
+        # Any run of consecutive query words matches, so every suffix of the
+        # query is added along with all of its prefixes.
+        term_ids = VOCABULARY.ids(self.terms)
+        suffixes = [term_ids[i:] for i in xrange(len(term_ids))]
+        matcher = _PhraseMatcher(suffixes, prefixes=True)
+        matcher.add_phrases(VOCABULARY.ids(phrase)
+                            for phrase in self.expansions)
+        self._matcher = matcher
+        self._ids = frozenset(VOCABULARY.ids(self.vocabulary()))
+        self.generation = generation
+
+    @property
+    def matcher(self):
+        if self.generation != VOCABULARY.generation:
+            self._build_matcher()
+        return self._matcher
+
+    @property
+    def ids(self):
+        if self.generation != VOCABULARY.generation:
+            self._build_matcher()
+        return self._ids
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __reduce__(self):
+        # Ids differ between processes, so a query sent to a worker is
+        # compiled again from its words there.
+        return (_unpickle, (CompiledQuery, (self.words,), dict(
+            opinion_indicators=_pickled_indicators(self.opinion_indicators),
+            expansions=self.expansions)))
+
+    def vocabulary(self):
+        """Return the Set of lowercased words that can start or be in a span."""
+        return set(self.terms).union(*self.expansions)
+
+    def __repr__(self):
+        if self.expansions:
+            return 'CompiledQuery(%r, expansions=%r)' % (self.words,
+                                                         self.expansions)
+        return 'CompiledQuery(%r)' % (self.words,)
+
+
+def _pickled_indicators(opinion_indicators):
+    """Return `opinion_indicators` as pickled, None for the defaults."""
+    if opinion_indicators is OPINION_INDICATORS:
+        return None
+    return opinion_indicators
+
+
+def _unpickle(cls, args, kwargs):
+    """Build a pickled `CompiledQuery` or `PreparedDocument`.
+
+    The default `OPINION_INDICATORS` are pickled as None and restored here,
+    since the lazy path and the snippet cache tell them apart by identity.
+    """
+    if kwargs['opinion_indicators'] is None:
+        kwargs['opinion_indicators'] = OPINION_INDICATORS
+    return cls(*args, **kwargs)
+
+
+class _PhraseMatcher(object):
+    """An Aho-Corasick automaton that finds phrases in a sequence of words.
+
+    The automaton is built once and then finds every phrase occurring in a
+    sentence in a single pass over its words, however many phrases there are.
+    """
+    __slots__ = ('_goto', '_lengths', '_fail', '_outputs')
+
+    def __init__(self, phrases=(), prefixes=False):
+        """Build a matcher for `phrases`.
+
+        Args:
+          phrases: Iterable of sequences of words, such as lowercased Strings
+            or their `VOCABULARY` ids.
+          prefixes: Boolean. Whether every prefix of each phrase matches too.
+        """
+        # Node 0 is the root. `_lengths[node]` is the length of the phrase
+        # ending at that node, or 0 if none does.
+        self._goto = [{}]
+        self._lengths = [0]
+        self._fail = self._outputs = None
+        self.add_phrases(phrases, prefixes)
+
+    def add_phrases(self, phrases, prefixes=False):
+        """Add `phrases` to the matcher.
+
+        Args:
+          phrases: Iterable of sequences of words.
+          prefixes: Boolean. Whether every prefix of each phrase matches too.
+        """
+        goto, lengths = self._goto, self._lengths
+        for phrase in phrases:
+            node = 0
+            for depth, word in enumerate(phrase):
+                child = goto[node].get(word)
+                if child is None:
+                    child = goto[node][word] = len(goto)
+                    goto.append({})
+                    lengths.append(0)
+                node = child
+                if prefixes:
+                    lengths[node] = depth + 1
+            if phrase:
+                lengths[node] = len(phrase)
+        self._build_links()
+
+    def _build_links(self):
+        """Compute failure links and outputs breadth first from the root."""
+        goto, lengths = self._goto, self._lengths
+        fail = [0] * len(goto)
+        # The lengths of all phrases that end at each node, longest first.
+        outputs = [()] * len(goto)
+        queue = collections.deque(goto[0].itervalues())
+        while queue:
+            node = queue.popleft()
+            own = (lengths[node],) if lengths[node] else ()
+            outputs[node] = own + outputs[fail[node]]
+            for word, child in goto[node].iteritems():
+                state = fail[node]
+                while state and word not in goto[state]:
+                    state = fail[state]
+                if node:
+                    fail[child] = goto[state].get(word, 0)
+                queue.append(child)
+        self._fail, self._outputs = fail, outputs
+
+    def find_spans(self, words):
+        """Find the leftmost-longest non-overlapping phrases in `words`.
+
+        Args:
+          words: Iterable of words of the kind the phrases are made of.
+        Returns:
+          List of (start, end) word indices of the phrases found, in order.
+        """
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        longest = {}
+        node = 0
+        for i, word in enumerate(words):
+            while node and word not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(word, 0)
+            for length in outputs[node]:
+                start = i + 1 - length
+                if length > longest.get(start, 0):
+                    longest[start] = length
+
+        spans = []
+        end = 0
+        for start in sorted(longest):
+            if start >= end:
+                end = start + longest[start]
+                spans.append((start, end))
+        return spans
+
+
+class OpinionLexicon(object):
+    """Weighted opinion-indicating words and phrases compiled for scoring.
+
+    A lexicon can be used wherever a Set of opinion indicators is taken. A
+    sentence's opinion count is then the sum of the weights of the entries in
+    it rather than the number of indicator words. Like indicators, entries
+    are matched against words as written.
+
+    Attributes:
+      weights: Dict mapping each single-word entry to its Integer weight.
+      phrases: Dict mapping each multi-word entry, as a Tuple of words, to its
+        Integer weight.
+      matcher: A `_PhraseMatcher` for all of the entries when there are
+        phrases, so that "not good" is matched in place of "good", or None.
+    """
+    __slots__ = ('weights', 'phrases', 'matcher', '_id_weights', '_digest')
+
+    def __init__(self, entries):
+        """Compile a lexicon.
+
+        Args:
+          entries: Dict or iterable of (String, weight) pairs. Strings of
+            several words are phrases, split as queries are.
+        Raises:
+          ValueError: A weight is not an Integer. Opinion counts are stored as
+            Integers, so fractional weights have to be scaled first.
+        """
+        self.weights = {}
+        self.phrases = {}
+        if isinstance(entries, dict):
+            entries = entries.iteritems()
+        for (phrase, weight) in entries:
+            if weight != int(weight):
+                raise ValueError('Weight of %r is not an integer: %r' %
+                                 (phrase, weight))
+            words = tuple(_split_into_words(phrase))
+            if len(words) == 1:
+                self.weights[words[0]] = int(weight)
+            elif words:
+                self.phrases[words] = int(weight)
+        self._build_matcher()
+
+    def _build_matcher(self):
+        """Set `matcher` for the entries, if any of them are phrases."""
+        self._id_weights = None
+        self._digest = None
+        self.matcher = None
+        if self.phrases:
+            self.matcher = _PhraseMatcher(self.phrases)
+            self.matcher.add_phrases([word] for word in self.weights)
+
+    def __getstate__(self):
+        # The id weight table holds `VOCABULARY` ids, which differ between
+        # processes, so only the entries are pickled.
+        return (self.weights, self.phrases)
+
+    def __setstate__(self, state):
+        self.weights, self.phrases = state
+        self._build_matcher()
+
+    def __len__(self):
+        return len(self.weights) + len(self.phrases)
+
+    def __contains__(self, word):
+        return word in self.weights
+
+    def score(self, words):
+        """Return the sum of the weights of the entries in `words`.
+
+        Args:
+          words: Iterable of Strings that are a sentence's words as written.
+        """
+        if self.matcher is None:
+            return sum(itertools.imap(self.weights.get, words,
+                                      itertools.repeat(0)))
+        words = list(words)
+        total = 0
+        for (start, end) in self.matcher.find_spans(words):
+            if end - start == 1:
+                total += self.weights[words[start]]
+            else:
+                total += self.phrases[tuple(words[start: end])]
+        return total
+
+    def digest(self):
+        """Return a SHA-1 digest of the entries and their weights."""
+        if self._digest is None:
+            entries = ['%s\t%d' % (word, weight)
+                       for (word, weight) in self.weights.iteritems()]
+            entries.extend('%s\t%d' % (' '.join(phrase), weight)
+                           for (phrase, weight) in self.phrases.iteritems())
+            import hashlib
+            self._digest = hashlib.sha1('\n'.join(sorted(entries))).digest()
+        return self._digest
+
+    def save(self, path):
+        """Write the compiled lexicon to `path` for `load_lexicon`."""
+        with open(path, 'wb') as f:
+            f.write(LEXICON_MAGIC)
+            marshal.dump((self.weights, self.phrases.items()), f)
+
+    def __repr__(self):
+        return '<OpinionLexicon of %d words and %d phrases>' % (
+            len(self.weights), len(self.phrases))
+
+
+def load_lexicon(path):
+    """Load an `OpinionLexicon` from a file.
+
+    Args:
+      path: String naming a file written by `OpinionLexicon.save`, or a text
+        file with one entry per line: a word or phrase, a tab and an Integer
+        weight. Blank lines and lines starting with '#' are skipped.
+    Returns:
+      An `OpinionLexicon`.
+    Raises:
+      ValueError: A line of a text file is not an entry.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(LEXICON_MAGIC)) == LEXICON_MAGIC:
+            weights, phrases = marshal.load(f)
+            lexicon = OpinionLexicon.__new__(OpinionLexicon)
+            lexicon.weights = weights
+            lexicon.phrases = dict(phrases)
+            lexicon._build_matcher()
+            return lexicon
+
+        f.seek(0)
+        entries = []
+        for (number, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                phrase, weight = line.rsplit('\t', 1)
+                entries.append((phrase, int(weight)))
+            except ValueError:
+                raise ValueError('Line %d of %s is not an entry: %r' %
+                                 (number, path, line))
+        return OpinionLexicon(entries)
+
+
+def compile_query(query, expansions=(), opinion_indicators=OPINION_INDICATORS):
+    """Split and normalize `query` so it can be matched against many documents.
+
+    Args:
+      query: String of words representing the query terms. A `CompiledQuery`
+        is returned unchanged.
+      expansions: Iterable of Strings that are extra phrases to match, such as
+        synonyms or multi-word dish names. Each is highlighted and scored as
+        a whole, like a run of query words.
+      opinion_indicators: Set of opinion-indicating words or an
+        `OpinionLexicon` that sentences are scored with.
+    Returns:
+      A `CompiledQuery`.
+    """
+    if isinstance(query, CompiledQuery):
+        return query
+    return CompiledQuery(_split_into_words(query),
+                         opinion_indicators=opinion_indicators,
+                         expansions=[_split_into_words(phrase)
+                                     for phrase in expansions])
+
+
+def _as_compiled(query_words):
+    """Return `query_words` as a `CompiledQuery`.
+
+    Args:
+      query_words: A `CompiledQuery`, a query String or a List of Strings.
+    Returns:
+      A `CompiledQuery`.
+    """
+    if isinstance(query_words, CompiledQuery):
+        return query_words
+    elif isinstance(query_words, basestring):
+        return compile_query(query_words)
+    else:
+        return CompiledQuery(query_words)
+
 
-def highlight_doc(doc, query, max_chars=INFINITY, max_sents=INFINITY):
+def highlight_many(docs, query, max_chars=INFINITY, max_sents=INFINITY,
+                   strategy='greedy', stats=None, scorer=None,
+                   tags=HIGHLIGHT_TAGS):
+    """Return a snippet for each of `docs`, compiling `query` only once.
+
+    Args:
+      docs: Iterable of Strings that are documents to be highlighted.
+      query: String of query words or a `CompiledQuery`.
+      max_chars: Integer indicating the max number of chars in each snippet.
+      max_sents: Integer indicating the max number of sentences in each snippet.
+      strategy: String in `STRATEGIES` naming how sentences are selected.
+      stats: Optional `PipelineStats` that every snippet is recorded in.
+      scorer: `Scorer` that sentences are scored with. Defaults to
+        `DEFAULT_SCORER`.
+      tags: `Tags` that highlighted spans are marked with.
+    Returns:
+      List of highlighted snippets in the same order as `docs`.
+    """
+    query = compile_query(query)
+    return [highlight_doc(doc, query, max_chars, max_sents, strategy, stats,
+                          scorer, tags)
+            for doc in docs]
+
+
+def highlight_batch(pairs, max_chars=INFINITY, max_sents=INFINITY, workers=None,
+                    chunksize=None, min_parallel=MIN_PARALLEL_BATCH,
+                    strategy='greedy', tags=HIGHLIGHT_TAGS):
+    """Return a snippet for each (document, query) pair using a process pool.
+
+    Args:
+      pairs: Iterable of (document, query) pairs. Queries may be Strings or
+        `CompiledQuery` objects.
+      max_chars: Integer indicating the max number of chars in each snippet.
+      max_sents: Integer indicating the max number of sentences in each snippet.
+      workers: Integer number of worker processes. Defaults to the number of
+        CPUs.
+      chunksize: Integer number of pairs sent to a worker at a time. Defaults
+        to splitting the batch into about four chunks per worker.
+      min_parallel: Integer. Batches with fewer pairs than this, or a
+        `workers` value of 1, are snippeted in the calling process.
+      strategy: String in `STRATEGIES` naming how sentences are selected.
+      tags: `Tags` that highlighted spans are marked with.
+    Returns:
+      List of highlighted snippets in the same order as `pairs`. These are
+      identical to calling `highlight_doc` on each pair.
+    """
+    import multiprocessing
+    pairs = list(pairs)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if workers <= 1 or not pairs or len(pairs) < min_parallel:
+        return _highlight_chunk((pairs, max_chars, max_sents, strategy, None,
+                                 tags))
+
+    if chunksize is None:
+        chunksize, extra = divmod(len(pairs), workers * 4)
+        if extra:
+            chunksize += 1
+    chunks = [(pairs[i: i + chunksize], max_chars, max_sents, strategy, None,
+               tags)
+              for i in xrange(0, len(pairs), chunksize)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_highlight_chunk, chunks, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    snippets = []
+    for chunk_snippets in results:
+        snippets.extend(chunk_snippets)
+    return snippets
+
+
+def _highlight_chunk(job):
+    """Snippet one chunk of a batch. This runs in `highlight_batch` workers.
+
+    Args:
+      job: Tuple of a List of (document, query) pairs, max_chars, max_sents,
+        strategy, a `PipelineStats` or None and `Tags`. Stats are only
+        recorded when the chunk is snippeted in the calling process.
+    Returns:
+      List of highlighted snippets in the same order as the pairs.
+    """
+    pairs, max_chars, max_sents, strategy, stats, tags = job
+    # Batches tend to repeat queries so each is only compiled once per chunk.
+    compiled = {}
+    snippets = []
+    for doc, query in pairs:
+        if not isinstance(query, CompiledQuery):
+            if query not in compiled:
+                compiled[query] = compile_query(query)
+            query = compiled[query]
+        snippets.append(highlight_doc(doc, query, max_chars, max_sents,
+                                      strategy, stats, tags=tags))
+    return snippets
+
+
+def best_snippets(docs, query, k=1, max_chars=INFINITY, max_per_doc=1,
+                  unique=True):
+    """Find the best sentences for `query` across many documents.
+
+    Documents are read one at a time and only the best `k` candidate
+    sentences are kept, so memory use does not grow with the number of
+    documents. Only sentences containing a query span are candidates.
+
+    Args:
+      docs: Iterable of Strings or `PreparedDocument`s, such as all of a
+        business's reviews.
+      query: String of query words or a `CompiledQuery`.
+      k: Integer that is the max number of sentences to return.
+      max_chars: Integer that is the max number of characters, counted as in
+        `highlight_doc`, of all the returned sentences together. The best of
+        the `k` candidates are kept while they fit.
+      max_per_doc: Integer that is the max number of sentences to take from
+        one document, or None for no limit.
+      unique: Boolean. Whether to keep only the best of the sentences whose
+        lowercased words are the same, as when a review is posted twice.
+    Returns:
+      List of (doc index, sentence index, score, highlighted sentence) tuples,
+      best first. Ties go to the earlier document and sentence. Empty if `k`
+      is not positive.
+    """
+    if k <= 0:
+        return []
+    query = compile_query(query)
+    # A min-heap of the best candidates so far. Its first entry is the worst,
+    # with ties broken against later documents and sentences.
+    heap = []
+    # Maps the key of each candidate in `heap` to its entry.
+    entries = {}
+    for (number, doc) in enumerate(docs):
+        prepared = prepare_document(doc, query.opinion_indicators)
+        candidates = []
+        for sentence in xrange(len(prepared)):
+            spans = _sentence_spans(prepared, sentence, query)
+            if spans:
+                score = _score_sentence(prepared, sentence, spans, query)
+                length = _highlighted_length(prepared, sentence, spans)
+                if length <= max_chars:
+                    candidates.append((score, -number, -sentence, length,
+                                       prepared))
+        if max_per_doc is not None:
+            candidates = heapq.nlargest(max_per_doc, candidates,
+                                        key=operator.itemgetter(0, 2))
+
+        for candidate in candidates:
+            key = ' '.join(itertools.imap(
+                VOCABULARY.words.__getitem__,
+                _sentence_ids(prepared, -candidate[2])))
+            entry = candidate[:4] + (key, prepared)
+            duplicate = entries.get(key) if unique else None
+            if duplicate is not None:
+                # Only the better of two duplicates is kept.
+                if entry[:3] <= duplicate[:3]:
+                    continue
+                heap[heap.index(duplicate)] = entry
+                heapq.heapify(heap)
+            elif len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry[:3] > heap[0][:3]:
+                worst = heapq.heapreplace(heap, entry)
+                if entries.get(worst[4]) is worst:
+                    del entries[worst[4]]
+            else:
+                continue
+            entries[key] = entry
+
+    results = []
+    char_count = 0
+    for (score, neg_number, neg_sentence, length, key, prepared) in sorted(
+            heap, reverse=True):
+        if char_count + length > max_chars:
+            continue
+        char_count += length
+        results.append((-neg_number, -neg_sentence, score,
+                        ''.join(_insert_highlights(prepared, -neg_sentence,
+                                                   query))))
+    return results
+
+
+def highlight_doc(doc, query, max_chars=INFINITY, max_sents=INFINITY,
+                  strategy='greedy', stats=None, scorer=None,
+                  tags=HIGHLIGHT_TAGS):
     """Return snippets from `doc` with `query` words tagged.
     
     Args:
-      doc: String that is document to be highlighted.
-      query: String of words representing the query terms.
+      doc: String that is document to be highlighted, or a `PreparedDocument`
+        returned by `prepare_document`.
+      query: String of words representing the query terms, or a
+        `CompiledQuery` returned by `compile_query`.
       max_chars: Integer indicating the max number of chars in the snippet.
       max_sents: Integer indicating the max number of sentences in the snippet.
+      strategy: String in `STRATEGIES`. With 'optimal' the snippet is the set
+        of sentences with the highest total score that fits the limits,
+        rather than the greedy choice of the best sentences one at a time.
+      stats: Optional `PipelineStats`, or any object with its `record`
+        method, that is given the time taken and the counts of each stage.
+      scorer: `Scorer` that sentences are scored with. Defaults to
+        `DEFAULT_SCORER`.
+      tags: `Tags` that highlighted spans are marked with.
     Returns:
-      The most relevant snippet with all query terms highlighted.
+      The most relevant snippet with all query terms highlighted. Each
+      sentence is copied from `doc` as written and sentences are separated by
+      a single space.
+    """
+    if stats is not None:
+        return _highlight_doc_timed(doc, query, max_chars, max_sents, strategy,
+                                    stats, scorer, tags)
+
+    strings = []
+    _write_doc(strings.append, doc, query, max_chars, max_sents, strategy,
+               scorer, tags)
+    return ''.join(strings)
+
+
+def write_snippet(sink, doc, query, max_chars=INFINITY, max_sents=INFINITY,
+                  strategy='greedy', stats=None, scorer=None,
+                  tags=HIGHLIGHT_TAGS):
+    """Write the snippet of `doc` that `highlight_doc` returns to `sink`.
+
+    The snippet is written a piece at a time as it is rendered, so no list of
+    its pieces or copy of the whole snippet is built.
+
+    Args:
+      sink: File-like object, such as an open file or a `StringIO`, that
+        the snippet is passed to in pieces through its `write` method.
+      tags: `Tags` that highlighted spans are marked with. The other
+        arguments are as for `highlight_doc`.
     """
-    # Break document and query into lists of sentences and words.
-    sentences = [_split_into_words(sent) for sent in _split_into_sentences(doc)]
-    query = _split_into_words(query)
+    if stats is not None:
+        sink.write(_highlight_doc_timed(doc, query, max_chars, max_sents,
+                                        strategy, stats, scorer, tags))
+        return
+    _write_doc(sink.write, doc, query, max_chars, max_sents, strategy, scorer,
+               tags)
+
+
+def snippet_spans(doc, query, max_chars=INFINITY, max_sents=INFINITY,
+                  strategy='greedy', scorer=None):
+    """Find the snippet that `highlight_doc` returns as offsets into `doc`.
+
+    This is for callers that mark up snippets themselves, such as a web
+    frontend, which would otherwise parse the tags back out of the String
+    that `highlight_doc` returns. The result holds only Integers, so it can be
+    passed to `json.dumps` as it is. `render_spans` turns it into the String.
+
+    Args:
+      doc: String that is document to be highlighted, or a `PreparedDocument`
+        returned by `prepare_document`.
+      query: String of words representing the query terms, or a
+        `CompiledQuery` returned by `compile_query`.
+      max_chars: Integer indicating the max number of chars in the snippet,
+        counted as in `highlight_doc`.
+      max_sents: Integer indicating the max number of sentences in the snippet.
+      strategy: String in `STRATEGIES`.
+      scorer: `Scorer` that sentences are scored with. Defaults to
+        `DEFAULT_SCORER`.
+    Returns:
+      (sentences, highlights) pair of Lists of (start, end) offsets into the
+      text of `doc`, in the order they appear. `sentences` runs from the
+      start of each selected sentence's first word to the end of its last,
+      and `highlights` from the start to the end of each query span in them.
+    """
+    query = compile_query(query)
+    if (strategy == 'greedy' and scorer is None and
+            isinstance(doc, basestring) and len(doc) >= LAZY_MIN_CHARS and
+            query.opinion_indicators is OPINION_INDICATORS):
+        spans = _lazy_spans(doc, query, max_chars, max_sents)
+        if spans is not None:
+            return spans
+
+    # Find sentences and words as offsets into the document, counting the
+    # opinion indicators that the query is scored with.
+    tokens = prepare_document(doc, query.opinion_indicators)
 
     # Select the best sentences given the constraints.
-    snippet_sents = _select_snippet_sentences(sentences, query, max_chars, 
-                                              max_sents)
+    snippet_sents = _select_snippet_sentences(tokens, query, max_chars,
+                                              max_sents, strategy,
+                                              scorer=scorer)
 
-    snippet_words = []
-    for sent in snippet_sents:
-        snippet_words += sent
+    # Find the query spans in the selected sentences.
+    return _snippet_offsets(tokens, snippet_sents, query)
 
-    # Surround spans from `query` in the highlighted snippet with tags.
-    highlighted_snippet = _insert_highlights(snippet_words, query)
-    
 
-    if not highlighted_snippet:
-        return ''
-    else:
-        return _join_words(highlighted_snippet)
-    
+def render_spans(doc, spans, tags=HIGHLIGHT_TAGS):
+    """Return the snippet of `doc` described by `spans` as a String.
+
+    Args:
+      doc: String or `PreparedDocument` that `spans` was found in.
+      spans: (sentences, highlights) pair as returned by `snippet_spans`.
+      tags: `Tags` that highlighted spans are marked with.
+    Returns:
+      The sentences as written in `doc`, separated by a single space, with
+      each highlight surrounded by tags. With the same arguments this is the
+      String that `highlight_doc` returns.
+    """
+    strings = []
+    _write_spans(strings.append, doc, spans, tags)
+    return ''.join(strings)
+
+
+def _write_doc(write, doc, query, max_chars, max_sents, strategy, scorer,
+               tags):
+    """Pass the pieces of `highlight_doc`'s snippet to `write` in order."""
+    _write_spans(write, doc, snippet_spans(doc, query, max_chars, max_sents,
+                                           strategy, scorer), tags)
+
+
+def _write_spans(write, doc, spans, tags):
+    """Pass the pieces of the snippet that `render_spans` returns to `write`
+    in order."""
+    text = doc.text if isinstance(doc, PreparedDocument) else doc
+    sentences, highlights = spans
+    open_tag, close_tag, escape = (tags.open_tag, tags.close_tag,
+                                   tags.escape)
+    highlight = 0
+    for (number, (pos, end)) in enumerate(sentences):
+        if number:
+            write(' ')
+        while highlight < len(highlights) and highlights[highlight][0] < end:
+            start, stop = highlights[highlight]
+            if escape is None:
+                write(text[pos: start])
+                write(open_tag)
+                write(text[start: stop])
+            else:
+                write(escape(text[pos: start]))
+                write(open_tag)
+                write(escape(text[start: stop]))
+            write(close_tag)
+            pos = stop
+            highlight += 1
+        rest = text[pos: end]
+        write(rest if escape is None else escape(rest))
+
 
-def _insert_highlights(snippet_words, query_words):
-    """Highlight all query_words in snippet_words.
+def _snippet_offsets(tokens, sentences, query_words):
+    """Find the offsets of `sentences` and their query spans.
 
     Args:
-      snippet_words: List of Strings representing a snippet.
-      query_words: List of Strings representing query terms.
+      tokens: A `PreparedDocument`.
+      sentences: List of Integer indices of sentences in `tokens`, in order.
+      query_words: A `CompiledQuery`.
+    Returns:
+      (sentences, highlights) pair as returned by `snippet_spans`.
+    """
+    sentence_offsets, highlights = [], []
+    for sentence in sentences:
+        sentence_offsets.append(tokens.sentence_span(sentence))
+        spans = _sentence_spans(tokens, sentence, query_words)
+        # The offsets of a sentence's words are only found if it has spans.
+        if spans:
+            starts, ends = tokens.word_offsets(sentence)
+            first = tokens.bounds[sentence]
+            highlights.extend((starts[span_start - first],
+                               ends[span_end - 1 - first])
+                              for (span_start, span_end) in spans)
+    return sentence_offsets, highlights
+
+
+def _lazy_spans(doc, query, max_chars, max_sents):
+    """Find `snippet_spans`'s greedy snippet of a String, doing only the work
+    the snippet needs.
+
+    Only sentences containing a query word or an opinion indicator can score
+    above zero. Places where one might be are found by searching the whole
+    text with regular expressions, and only the sentences around them are
+    tokenized and scored. When no sentence scores above zero the snippet is
+    the first sentences that fit, which are tokenized one at a time until the
+    limits are reached.
+
+    Args:
+      doc: String that is the document.
+      query: A `CompiledQuery` using `OPINION_INDICATORS`.
+    Returns:
+      (sentences, highlights) pair, the same as with `snippet_spans`'s
+      'greedy' strategy, or None if the places found are too many for
+      tokenizing around them to pay off.
+    """
+    # The search stops as soon as the hits are too many.
+    limit = len(doc) // LAZY_HIT_SPACING if LAZY_HIT_SPACING else len(doc)
+    hits = [match.start() for match in itertools.islice(
+        _opinion_prefilter().finditer(doc), limit + 1)]
+    prefilter = _query_prefilter(query)
+    if prefilter is not None and len(hits) <= limit:
+        hits.extend(match.start() for match in itertools.islice(
+            prefilter.finditer(doc), limit + 1 - len(hits)))
+    if len(hits) > limit:
+        return None
+    if not hits:
+        return _first_sentences(_iter_sentences(doc), max_chars, max_sents)
+
+    # A document made of only the sentences around the hits scores and
+    # highlights them as the whole document would, in the same order.
+    starts, ends, bounds = array('i'), array('i'), array('i', [0])
+    end = -1
+    for hit in sorted(hits):
+        if hit < end:
+            continue
+        sentence = _sentence_around(doc, hit)
+        if sentence is None:
+            break
+        for (start, end) in sentence:
+            starts.append(start)
+            ends.append(end)
+        bounds.append(len(starts))
+    tokens = PreparedDocument(doc, starts, ends, bounds)
+    positive = [ranked for ranked in _rank_sentences(tokens, query)
+                if ranked[1] > 0]
+    # The greedy selection only takes sentences scoring zero when none
+    # scoring more fit.
+    keep = _select_greedy(positive, max_chars, max_sents)
+    if keep:
+        return _snippet_offsets(tokens, [ranked[0] for ranked in sorted(keep)],
+                                query)
+
+    skip = set(starts[bounds[ranked[0]]] for ranked in positive)
+    return _first_sentences((sentence for sentence in _iter_sentences(doc)
+                             if sentence[0] not in skip),
+                            max_chars, max_sents)
+
+
+def _sentence_around(doc, position):
+    """Tokenize the sentence of `doc` that `position` falls in.
+
+    Whitespace is in no token, so tokenizing from a whitespace character
+    finds the same tokens as tokenizing the whole document. A sentence is only
+    known to start after a punctuation mark that is followed by a word, so the
+    tokenizing starts further back until one is found before `position`.
+
+    Args:
+      doc: String that is the document.
+      position: Integer offset into `doc`. Between sentences it falls in the
+        next one.
+    Returns:
+      List of the (start, end) offsets of the sentence's tokens, or None if
+      `position` is after the last token.
+    """
+    back = LAZY_BACKOFF
+    while True:
+        begin = 0
+        if position > back:
+            begin = max(doc.rfind(' ', 0, position - back), 0)
+        sentence = []
+        known = not begin
+        after_punctuation = False
+        for match in TOKEN_PATTERN.finditer(doc, begin):
+            is_punctuation = match.lastindex == 3
+            if after_punctuation and not is_punctuation:
+                if sentence[-1][1] > position:
+                    break
+                sentence = []
+                known = True
+            sentence.append(match.span())
+            after_punctuation = is_punctuation
+        if known:
+            if not sentence or sentence[-1][1] <= position:
+                return None
+            return sentence
+        back *= 2
+
+
+def _first_sentences(sentences, max_chars, max_sents):
+    """Take the first of `sentences` that fit the limits, as the greedy
+    selection does when no sentence scores above zero.
+
+    Args:
+      sentences: Iterable of (start, end, length) triples of the offsets of
+        each sentence in the document and the number of characters in its
+        words. It is only read until the limits are reached.
+    Returns:
+      (sentences, highlights) pair as returned by `snippet_spans`, with no
+      highlights.
+    """
+    taken = []
+    char_count = 0
+    for (start, end, length) in sentences:
+        if len(taken) >= max_sents or char_count >= max_chars:
+            break
+        if char_count + length <= max_chars:
+            taken.append((start, end))
+            char_count += length
+    return taken, []
+
+
+def _iter_sentences(doc):
+    """Tokenize `doc` one sentence at a time, as `_tokenize` splits it.
+
+    Returns:
+      Generator of (start, end, length) triples as taken by
+      `_first_sentences`.
+    """
+    start = end = length = 0
+    after_punctuation = False
+    for match in TOKEN_PATTERN.finditer(doc):
+        is_punctuation = match.lastindex == 3
+        if after_punctuation and not is_punctuation:
+            yield start, end, length
+            length = 0
+        if not length:
+            start = match.start()
+        end = match.end()
+        length += end - match.start()
+        after_punctuation = is_punctuation
+    if length:
+        yield start, end, length
+
+
+def _opinion_prefilter():
+    """Return `_OPINION_PREFILTER`, compiling it if needed."""
+    global _OPINION_PREFILTER
+    if _OPINION_PREFILTER is None:
+        _OPINION_PREFILTER = re.compile(
+            '(?<![A-Za-z])(?:%s)(?![A-Za-z0-9])' % '|'.join(
+                re.escape(word) for word in sorted(OPINION_INDICATORS,
+                                                   key=len, reverse=True)))
+    return _OPINION_PREFILTER
+
+
+def _query_prefilter(query):
+    """Return the `prefilter` of a `CompiledQuery`, building it if needed.
+
+    Returns:
+      A compiled regular expression, or None if the query has no words.
+    """
+    if query.prefilter is None:
+        vocabulary = sorted(query.vocabulary(), key=len, reverse=True)
+        if not vocabulary:
+            return None
+        query.prefilter = re.compile(
+            '|'.join(re.escape(word) for word in vocabulary),
+            re.IGNORECASE | re.UNICODE)
+    return query.prefilter
+
+
+def _highlight_doc_timed(doc, query, max_chars, max_sents, strategy, stats,
+                         scorer=None, tags=HIGHLIGHT_TAGS):
+    """Run `highlight_doc`'s stages one at a time, recording each in `stats`.
+
+    This is kept apart from `highlight_doc` so that snippeting without stats
+    pays for nothing but one comparison.
+    """
+    start = _timer()
+    query = compile_query(query)
+    tokens = prepare_document(doc, query.opinion_indicators)
+    end = _timer()
+    stats.record('prepare', end - start, sentences=len(tokens),
+                 tokens=len(tokens.ids))
+
+    start = end
+    ranked_sentences = _rank_sentences(tokens, query, scorer)
+    end = _timer()
+    tags_length = len(OPENTAG) + len(CLOSETAG)
+    stats.record('rank', end - start, spans=sum(
+        (length - tokens.word_chars[sentence]) // tags_length
+        for (sentence, score, length) in ranked_sentences))
+
+    start = end
+    snippet_sents = _select_snippet_sentences(tokens, query, max_chars,
+                                              max_sents, strategy,
+                                              ranked_sentences)
+    end = _timer()
+    stats.record('select', end - start, selected=len(snippet_sents))
+
+    start = end
+    spans = _snippet_offsets(tokens, snippet_sents, query)
+    end = _timer()
+    stats.record('highlight', end - start, highlights=len(spans[1]))
+
+    start = end
+    snippet = render_spans(tokens, spans, tags)
+    stats.record('join', _timer() - start, chars=len(snippet))
+    return snippet
+
+
+class PipelineStats(object):
+    """Wall time and counts of each stage of `highlight_doc`, summed over
+    every snippet it is passed to.
+
+    The stages are, in order, 'prepare' (tokenizing the document and
+    compiling the query), 'rank' (finding spans and scoring sentences),
+    'select', 'highlight' (finding the offsets of the selected sentences'
+    spans) and 'join' (writing the sentences with tags).
+
+    Attributes:
+      seconds: Dict mapping each stage to its total wall time in seconds.
+      calls: Dict mapping each stage to the number of times it ran.
+      counts: Dict mapping each stage to a Dict of its summed counts, such as
+        sentences and tokens for 'prepare' or spans for 'rank'.
+    """
+    STAGES = ('prepare', 'rank', 'select', 'highlight', 'join')
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def record(self, stage, seconds, **counts):
+        """Add one run of `stage` that took `seconds` and counted `counts`."""
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+        self.counts[stage].update(counts)
+
+    def report(self):
+        """Return a table of the stages as a String."""
+        total = sum(self.seconds.itervalues()) or 1.0
+        stages = [stage for stage in self.STAGES if stage in self.calls]
+        stages.extend(sorted(set(self.calls) - set(self.STAGES)))
+        lines = ['%-10s %8s %10s %7s %10s  %s' % (
+            'stage', 'calls', 'total ms', 'share', 'mean us', 'counts')]
+        for stage in stages:
+            seconds, calls = self.seconds[stage], self.calls[stage]
+            lines.append('%-10s %8d %10.1f %6.1f%% %10.1f  %s' % (
+                stage, calls, seconds * 1000, 100 * seconds / total,
+                seconds * 1e6 / calls,
+                ' '.join('%s=%d' % item
+                         for item in sorted(self.counts[stage].items()))))
+        return '\n'.join(lines)
+
+
+class PreparedDocument(object):
+    """A document split into sentences and words along with the features that
+    do not depend on the query, so it can be snippeted for many queries.
+
+    Words are stored as the `VOCABULARY` ids of their lowercased forms, which
+    queries and opinion indicators are matched against, and sentences as
+    offsets into the text, which is only sliced when a snippet is built. The
+    offsets of each word are only found when they are first read, and those
+    of the words of one sentence when a snippet highlights it.
+
+    Attributes:
+      text: String that is the document as written.
+      starts: array of the offset in `text` where each word starts.
+      ends: array of the offset in `text` just past the end of each word.
+      sentence_offsets: array of the offset in `text` where each sentence's
+        first word starts followed by the offset just past its last word's
+        end, for every sentence in turn, or None if they are found from
+        `starts` and `ends`.
+      bounds: array of word indices. Sentence i is made of words bounds[i] up
+        to but not including bounds[i + 1].
+      ids: array('I') of the id of each word lowercased. They are assigned
+        again when read after `VOCABULARY` is reset.
+      generation: The `VOCABULARY.generation` of `ids`.
+      opinion_counts: array of the number of opinion-indicating words in each
+        sentence, or the sum of their weights for an `OpinionLexicon`.
+      word_chars: array of the number of characters in each sentence's words.
+      opinion_indicators: Set of Strings or `OpinionLexicon` that
+        `opinion_counts` counts.
+      static_scores: Tuple of the `Scorer` and lexicon last used to rank the
+        document and the query-independent scores they gave, or None.
+    """
+    __slots__ = ('text', '_starts', '_ends', 'bounds', 'sentence_offsets',
+                 '_ids', 'generation', 'opinion_counts', 'word_chars',
+                 'opinion_indicators', 'static_scores')
+
+    def __init__(self, text, starts, ends, bounds,
+                 opinion_indicators=OPINION_INDICATORS, opinion_counts=None,
+                 word_chars=None, ids=None, sentence_offsets=None, words=None):
+        """Prepare a tokenized document.
+
+        The word ids and sentence features are computed unless they are
+        passed in, as they are when a document is loaded from a
+        `snippet_store` or edited. `starts` and `ends` may be None when
+        `sentence_offsets` is passed, and `words`, the List of words as
+        written, then saves slicing them from the text.
+        """
+        self.text = text
+        self._starts = starts
+        self._ends = ends
+        self.bounds = bounds
+        self.sentence_offsets = sentence_offsets
+        if ids is None:
+            VOCABULARY.make_room()
+            self._assign_ids(words)
+        else:
+            self._ids = ids
+            self.generation = VOCABULARY.generation
+        self.opinion_indicators = opinion_indicators
+        if opinion_counts is None:
+            opinion_counts = _opinion_counts(self, opinion_indicators, words)
+        self.opinion_counts = opinion_counts
+        if word_chars is None:
+            starts, ends = self.starts, self.ends
+            word_chars = array('i', (
+                sum(ends[i] - starts[i]
+                    for i in xrange(bounds[j], bounds[j + 1]))
+                for j in xrange(len(self))))
+        self.word_chars = word_chars
+        self.static_scores = None
+
+    def __len__(self):
+        """Return the number of sentences."""
+        return len(self.bounds) - 1
+
+    def _assign_ids(self, words=None):
+        """Set `ids` from the current `VOCABULARY`."""
+        generation = VOCABULARY.generation
+        if words is not None:
+            self._ids = VOCABULARY.ids(_lowered(words))
+        elif self._starts is not None:
+            lowered = self.text.lower()
+            self._ids = VOCABULARY.ids(
+                lowered[start: end]
+                for (start, end) in itertools.izip(self._starts, self._ends))
+        else:
+            self._ids = VOCABULARY.ids(
+                _lowered(_SPLIT_PATTERN.split(self.text)[1::2]))
+        self.generation = generation
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            self._starts, self._ends = _find_word_offsets(self.text)
+        return self._starts
+
+    @property
+    def ends(self):
+        if self._ends is None:
+            self._starts, self._ends = _find_word_offsets(self.text)
+        return self._ends
+
+    def sentence_span(self, sentence):
+        """Return the (start, end) offsets in `text` of a sentence's words.
+
+        Args:
+          sentence: Integer index of a sentence.
+        """
+        if self.sentence_offsets is not None:
+            return (self.sentence_offsets[2 * sentence],
+                    self.sentence_offsets[2 * sentence + 1])
+        return (self.starts[self.bounds[sentence]],
+                self.ends[self.bounds[sentence + 1] - 1])
+
+    def word_offsets(self, sentence):
+        """Return the starts and ends arrays of the words of a sentence.
+
+        Args:
+          sentence: Integer index of a sentence.
+        """
+        first, last = self.bounds[sentence], self.bounds[sentence + 1]
+        if self._starts is not None:
+            return self._starts[first: last], self._ends[first: last]
+        return _find_word_offsets(self.text, *self.sentence_span(sentence))
+
+    @property
+    def ids(self):
+        if self.generation != VOCABULARY.generation:
+            self._assign_ids()
+        return self._ids
+
+    @property
+    def words(self):
+        """List of each word lowercased."""
+        return [VOCABULARY.words[word_id] for word_id in self.ids]
+
+    def __reduce__(self):
+        # Ids differ between processes, so they are not pickled.
+        return (_unpickle, (
+            PreparedDocument,
+            (self.text, self._starts, self._ends, self.bounds),
+            dict(opinion_indicators=_pickled_indicators(
+                     self.opinion_indicators),
+                 opinion_counts=self.opinion_counts,
+                 word_chars=self.word_chars,
+                 sentence_offsets=self.sentence_offsets)))
+
+    def edit(self, start, end, replacement):
+        """Return the document with text[start:end] replaced by `replacement`.
+
+        Only the sentences around the edit are tokenized again. The words and
+        sentence features of the others are copied, so the work done in
+        Python grows with the size of the edit rather than of the document.
+        The result is the same as preparing the edited text.
+
+        Args:
+          start: Integer offset in `text` where the replaced text starts.
+          end: Integer offset in `text` just past the replaced text.
+          replacement: String to put in its place.
+        Returns:
+          A new `PreparedDocument`. This one is not changed.
+        Raises:
+          ValueError: The range is not within `text`.
+        """
+        if not 0 <= start <= end <= len(self.text):
+            raise ValueError('Edit range out of bounds: %r' % ((start, end),))
+        return _edit_document(self, start, end, replacement)
+
+    def append(self, text):
+        """Return the document with `text`, such as an owner's reply, added
+        to its end. See `edit`."""
+        return self.edit(len(self.text), len(self.text), text)
+
+    def __sizeof__(self):
+        """Return the approximate number of bytes used, including contents."""
+        size = object.__sizeof__(self) + sys.getsizeof(self.text)
+        for values in (self._starts, self._ends, self.bounds,
+                       self.sentence_offsets, self._ids, self.opinion_counts,
+                       self.word_chars):
+            if values is not None:
+                size += sys.getsizeof(values)
+        return size
+
+
+def prepare_document(doc, opinion_indicators=OPINION_INDICATORS):
+    """Tokenize `doc` once so that it can be snippeted for many queries.
+
+    Args:
+      doc: String representing a review document. A `PreparedDocument` is
+        returned unchanged.
+      opinion_indicators: Set of opinion-indicating words or an
+        `OpinionLexicon` to count.
+    Returns:
+      A `PreparedDocument`.
+    """
+    if isinstance(doc, PreparedDocument):
+        return doc
+    return _tokenize(doc, opinion_indicators)
+
+
+class DocumentCache(object):
+    """A least-recently-used cache of `PreparedDocument`s keyed by id.
+
+    Documents are evicted, oldest use first, when their total size plus the
+    size of `VOCABULARY`, which holds their words, goes over `max_bytes`. The
+    most recently cached document is kept even if the vocabulary alone is
+    over it.
+
+    Attributes:
+      max_bytes: Integer that is the most memory the cached documents and
+        the vocabulary may use.
+      nbytes: Integer that is the memory the cached documents use now.
+      hits: Integer count of lookups that found a document.
+      misses: Integer count of lookups that had to prepare a document.
+      evictions: Integer count of documents evicted to stay under max_bytes.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024,
+                 opinion_indicators=OPINION_INDICATORS):
+        self.max_bytes = max_bytes
+        self.opinion_indicators = opinion_indicators
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        # Maps ids to (document, size) pairs, least recently used first.
+        self._docs = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, key):
+        return key in self._docs
+
+    def get(self, key):
+        """Return the cached document for `key`, or None if there is none."""
+        entry = self._docs.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._docs[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def prepare(self, key, text):
+        """Return the document for `key`, preparing and caching it if needed.
+
+        Args:
+          key: Hashable id of the document, such as a review id.
+          text: String that is the document. If it differs from the cached
+            text for `key`, as when a review is edited, only the sentences
+            around the changed text are prepared again.
+        Returns:
+          A `PreparedDocument`.
+        """
+        entry = self._docs.pop(key, None)
+        if entry is not None:
+            if entry[0].text is text or entry[0].text == text:
+                self._docs[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.nbytes -= entry[1]
+
+        self.misses += 1
+        if entry is not None and type(entry[0].text) is type(text):
+            start, old_end, new_end = _changed_range(entry[0].text, text)
+            prepared = entry[0].edit(start, old_end, text[start: new_end])
+        else:
+            prepared = _tokenize(text, self.opinion_indicators)
+        self.put(key, prepared)
+        return prepared
+
+    def put(self, key, prepared):
+        """Cache `prepared` under `key`, evicting old documents to make room.
+
+        A document larger than `max_bytes` on its own is not cached.
+        """
+        self.discard(key)
+        size = sys.getsizeof(prepared)
+        if size > self.max_bytes:
+            return
+        self._docs[key] = (prepared, size)
+        self.nbytes += size
+        while (len(self._docs) > 1 and
+               self.nbytes + VOCABULARY.nbytes > self.max_bytes):
+            old_key, (old, old_size) = self._docs.popitem(last=False)
+            self.nbytes -= old_size
+            self.evictions += 1
+
+    def discard(self, key):
+        """Remove the document for `key` from the cache if it is there."""
+        entry = self._docs.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def clear(self):
+        """Remove all documents. The counters are not reset."""
+        self._docs.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Return a Dict of the cache's size and counters."""
+        return {'documents': len(self._docs), 'nbytes': self.nbytes,
+                'vocabulary_bytes': VOCABULARY.nbytes,
+                'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class ReviewIndex(object):
+    """An inverted index from words to the review sentences containing them.
+
+    Reviews are prepared once when they are added. For a query, only the
+    sentences that contain one of its words are scored, so reviews that would
+    get nothing but the no-match fallback snippet are never looked at.
+    """
+
+    def __init__(self, opinion_indicators=OPINION_INDICATORS):
+        self.opinion_indicators = opinion_indicators
+        self._keys = []
+        self._docs = []
+        self._numbers = {}
+        # Maps each lowercased word to an array of (review, sentence) number
+        # pairs, flattened, with one entry per sentence the word is in. Words
+        # rather than ids are kept, since ids change when `VOCABULARY` is
+        # reset.
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, key):
+        return key in self._numbers
+
+    def add(self, key, doc):
+        """Add a review to the index.
+
+        Args:
+          key: Hashable id of the review.
+          doc: String that is the review, or a `PreparedDocument`.
+        Raises:
+          ValueError: A review with the same key was already added.
+        """
+        if key in self._numbers:
+            raise ValueError('Review already in index: %r' % (key,))
+        prepared = prepare_document(doc, self.opinion_indicators)
+        number = len(self._docs)
+        self._numbers[key] = number
+        self._keys.append(key)
+        self._docs.append(prepared)
+
+        postings = self._postings
+        words = VOCABULARY.words
+        for sentence in xrange(len(prepared)):
+            for word in itertools.imap(words.__getitem__,
+                                       set(_sentence_ids(prepared, sentence))):
+                posting = postings.get(word)
+                if posting is None:
+                    posting = postings[word] = array('i')
+                posting.append(number)
+                posting.append(sentence)
+
+    def get(self, key):
+        """Return the `PreparedDocument` for `key`, or None."""
+        number = self._numbers.get(key)
+        return self._docs[number] if number is not None else None
+
+    def search(self, query, n=10):
+        """Find the `n` reviews that best match `query`.
+
+        A review's score is the sum, over its sentences containing query
+        words, of the sentence's span score plus its opinion-indicator count,
+        as computed by `_score_sentence`.
+
+        Args:
+          query: String of query words or a `CompiledQuery`.
+          n: Integer number of reviews to return.
+        Returns:
+          List of up to `n` (key, score) pairs for reviews with positive
+          scores, best first. Ties go to the review added first.
+        """
+        query = compile_query(query)
+        sentences = set()
+        for word in query.vocabulary():
+            posting = self._postings.get(word, ())
+            sentences.update(itertools.izip(posting[::2], posting[1::2]))
+
+        scores = collections.defaultdict(int)
+        for (number, sentence) in sentences:
+            prepared = self._docs[number]
+            spans = _sentence_spans(prepared, sentence, query)
+            if spans:
+                scores[number] += _score_sentence(prepared, sentence, spans,
+                                                  query)
+
+        best = heapq.nlargest(n, scores.iteritems(),
+                              key=lambda item: (item[1], -item[0]))
+        return [(self._keys[number], score) for (number, score) in best]
+
+    def highlight(self, query, n=10, max_chars=INFINITY, max_sents=INFINITY,
+                  strategy='greedy'):
+        """Snippet the `n` reviews that best match `query`.
+
+        Args:
+          query: String of query words or a `CompiledQuery`.
+          n: Integer number of reviews to snippet.
+          max_chars: Integer indicating the max number of chars in a snippet.
+          max_sents: Integer indicating the max number of sentences in a
+            snippet.
+          strategy: String in `STRATEGIES` naming how sentences are selected.
+        Returns:
+          List of (key, score, snippet) triples, best first, as ranked by
+          `search`.
+        """
+        query = compile_query(query)
+        return [(key, score,
+                 highlight_doc(self._docs[self._numbers[key]], query,
+                               max_chars, max_sents, strategy))
+                for (key, score) in self.search(query, n)]
+
+
+def _tokenize(doc, opinion_indicators=OPINION_INDICATORS):
+    """Split `doc` into sentences and words in one scan.
+
+    Args:
+      doc: String representing a review document.
+      opinion_indicators: Set of opinion-indicating words or an
+        `OpinionLexicon` to count.
+    Returns:
+      A `PreparedDocument`.
+    """
+    words, bounds, sentence_offsets, word_chars = _scan(doc)
+    return PreparedDocument(doc, None, None, bounds, opinion_indicators,
+                            word_chars=word_chars,
+                            sentence_offsets=sentence_offsets, words=words)
+
+
+def _scan(doc):
+    """Find the words and sentences of `doc`.
+
     Returns:
-      List of Strings that are in snippet_words with all words that are in
-      query_words surrounded by highlight tags. When a string of query words
-      is matched the whole span is enclosed in tags.
+      Tuple of the List of words as written, and the bounds, sentence_offsets
+      and word_chars arrays of a `PreparedDocument`.
+    """
+    # Looping over the tokens in Python is what makes tokenizing slow. A
+    # match object for each token costs as much again as finding it, so the
+    # document is split into Strings instead and only the sentences are
+    # looped over.
+    parts = _SPLIT_PATTERN.split(doc)
+    words = parts[1::2]
+    kinds = bytearray(itertools.imap(PUNCTUATION.__contains__, words))
+
+    # A sentence ends after a run of punctuation marks that is followed by
+    # another token, or at the end of the document.
+    bounds = array('i', [0])
+    bounds.extend(match.end() for match in _PUNCTUATION_RUN.finditer(kinds))
+    if words:
+        bounds.append(len(words))
+
+    # Word i is part 2 * i + 1, so sentence j is parts 2 * bounds[j] + 1 up
+    # to 2 * bounds[j + 1], after the text before it in part 2 * bounds[j].
+    # Joining the parts measures them without a call for each.
+    sentence_offsets, word_chars = array('i'), array('i')
+    end = 0
+    for (first, last) in itertools.izip(bounds, itertools.islice(bounds, 1,
+                                                                 None)):
+        start = end + len(parts[2 * first])
+        end = start + len(''.join(parts[2 * first + 1: 2 * last]))
+        sentence_offsets.append(start)
+        sentence_offsets.append(end)
+        word_chars.append(len(''.join(words[first: last])))
+    return words, bounds, sentence_offsets, word_chars
+
+
+def _lowered(words):
+    """Return a List of `words` lowercased."""
+    if not words:
+        return []
+    # Words never contain NUL, so they are lowercased in one call.
+    return '\x00'.join(words).lower().split('\x00')
+
+
+def _find_word_offsets(text, start=0, end=None):
+    """Find the offsets of the words of `text` between `start` and `end`.
+
+    Returns:
+      Tuple of the starts and ends arrays of the words.
+    """
+    matches = TOKEN_PATTERN.finditer(text, start,
+                                     len(text) if end is None else end)
+    offsets = array('i', itertools.chain.from_iterable(
+        itertools.imap(_SPAN, matches)))
+    return offsets[::2], offsets[1::2]
+
+
+def _edit_document(tokens, start, end, replacement):
+    """Apply an edit to a `PreparedDocument` as described by its `edit`."""
+    text = tokens.text[:start] + replacement + tokens.text[end:]
+    count = len(tokens)
+    if not count:
+        return _tokenize(text, tokens.opinion_indicators)
+    starts, ends, bounds = tokens.starts, tokens.ends, tokens.bounds
+    delta = len(replacement) - (end - start)
+
+    # The sentences the edit touches are tokenized again along with one more
+    # sentence on either side, since punctuation added or removed at their
+    # edges can join or split the sentences next to them.
+    first = max(_sentence_at(tokens, start) - 1, 0)
+    last = min(_sentence_at(tokens, end) + 2, count)
+    first_word, last_word = bounds[first], bounds[last]
+    region_start = ends[first_word - 1] if first else 0
+    region_end = ends[last_word - 1] + delta if last < count else len(text)
+
+    matches = list(TOKEN_PATTERN.finditer(text, region_start, region_end))
+    kinds = bytearray(itertools.imap(_KIND, matches))
+    # The region must still start and end on sentence boundaries: it starts
+    # after a punctuation mark, so it must start with a word, and the words
+    # after it must follow the same punctuation mark as before the edit.
+    # Otherwise the whole document is tokenized again.
+    if first and kinds[:1] == '\x03':
+        return _tokenize(text, tokens.opinion_indicators)
+    if last < count and not (
+            matches and kinds[-1] == 3 and
+            matches[-1].span() == (starts[last_word - 1] + delta,
+                                   region_end)):
+        return _tokenize(text, tokens.opinion_indicators)
+
+    offsets = array('i', itertools.chain.from_iterable(
+        itertools.imap(_SPAN, matches)))
+    region_bounds = array('i', [0] if matches else [])
+    region_bounds.extend(match.end() for match in _SENTENCE_END.finditer(kinds))
+    lowered = text[region_start: region_end].lower()
+    VOCABULARY.make_room()
+    region = PreparedDocument(
+        text, offsets[::2], offsets[1::2], region_bounds + array('i', [len(matches)]),
+        tokens.opinion_indicators,
+        ids=VOCABULARY.ids(
+            lowered[match.start() - region_start: match.end() - region_start]
+            for match in matches))
+
+    shift = len(matches) - (last_word - first_word)
+    return PreparedDocument(
+        text,
+        starts[:first_word] + region.starts + _shifted(starts[last_word:], delta),
+        ends[:first_word] + region.ends + _shifted(ends[last_word:], delta),
+        bounds[:first] + _shifted(region_bounds, first_word) +
+        _shifted(bounds[last:], shift),
+        tokens.opinion_indicators,
+        tokens.opinion_counts[:first] + region.opinion_counts +
+        tokens.opinion_counts[last:],
+        tokens.word_chars[:first] + region.word_chars +
+        tokens.word_chars[last:],
+        tokens.ids[:first_word] + region.ids + tokens.ids[last_word:])
+
+
+def _changed_range(old, new):
+    """Find the part of `old` that was replaced to make `new`.
+
+    Returns:
+      Tuple of the Integer offset where the Strings first differ and the
+      offsets in `old` and in `new` just past their last difference.
+    """
+    # Slices are compared by binary search so that the characters are
+    # compared in C rather than one at a time.
+    low, high = 0, min(len(old), len(new))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[:middle] == new[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    start = low
+
+    low, high = 0, min(len(old), len(new)) - start
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[len(old) - middle:] == new[len(new) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return start, len(old) - low, len(new) - low
+
+
+def _sentence_at(tokens, pos):
+    """Return the index of the last sentence starting at or before `pos`, or
+    0 if there is none."""
+    word = bisect.bisect_right(tokens.starts, pos) - 1
+    return max(bisect.bisect_right(tokens.bounds, word) - 1, 0)
+
+
+def _shifted(values, delta):
+    """Return an int array of `values` with `delta` added to each."""
+    if not delta:
+        return array('i', values)
+    return array('i', itertools.imap(operator.add, values,
+                                     itertools.repeat(delta)))
+
+
+def _sentence_words(tokens, sentence):
+    """Return a generator of the words of a sentence as written.
+
+    Args:
+      tokens: A `PreparedDocument`.
+      sentence: Integer index of a sentence in `tokens`.
+    """
+    text = tokens.text
+    return (text[start: end]
+            for (start, end) in itertools.izip(*tokens.word_offsets(sentence)))
+
+
+def _sentence_ids(tokens, sentence):
+    """Return an array of the ids of the lowercased words of a sentence."""
+    return tokens.ids[tokens.bounds[sentence]: tokens.bounds[sentence + 1]]
+
+
+def _sentence_spans(tokens, sentence, query_words):
+    """Find the query spans in a sentence.
+
+    Args:
+      tokens: A `PreparedDocument`.
+      sentence: Integer index of a sentence in `tokens`.
+      query_words: A `CompiledQuery`.
+    Returns:
+      List of (start, end) word indices into `tokens` as returned by
+      `_find_query_spans`.
+    """
+    first = tokens.bounds[sentence]
+    spans = query_words.matcher.find_spans(_sentence_ids(tokens, sentence))
+    return [(first + start, first + end) for (start, end) in spans]
+
+
+def _insert_highlights(tokens, sentence, query_words, tags=HIGHLIGHT_TAGS):
+    """Highlight all query_words in a sentence.
+
+    Args:
+      tokens: A `PreparedDocument`.
+      sentence: Integer index of a sentence in `tokens`.
+      query_words: A `CompiledQuery`.
+      tags: `Tags` that highlighted spans are marked with.
+    Returns:
+      List of Strings that, joined, are the sentence as written in the
+      document with all words that are in query_words surrounded by highlight
+      tags. When a string of query words is matched the whole span is enclosed
+      in tags.
     """
-    spans = dict(_find_query_spans(snippet_words, query_words))
     strings = []
-    i = 0
-    while i < len(snippet_words):
-        if spans.has_key(i):
-            start, end = i, spans[i]
-            strings.append(OPENTAG)
-            strings.extend(snippet_words[start: end])
-            strings.append(CLOSETAG)
-            i = end
+    _write_highlights(strings.append, tokens, sentence, query_words, tags)
+    return strings
+
+
+def _write_highlights(write, tokens, sentence, query_words,
+                      tags=HIGHLIGHT_TAGS):
+    """Pass the pieces of a highlighted sentence, as returned by
+    `_insert_highlights`, to `write` in order."""
+    text = tokens.text
+    pos, sentence_end = tokens.sentence_span(sentence)
+    spans = _sentence_spans(tokens, sentence, query_words)
+    if spans:
+        starts, ends = tokens.word_offsets(sentence)
+        first = tokens.bounds[sentence]
+    open_tag, close_tag, escape = (tags.open_tag, tags.close_tag,
+                                   tags.escape)
+    for (span_start, span_end) in spans:
+        start, end = starts[span_start - first], ends[span_end - 1 - first]
+        if escape is None:
+            write(text[pos: start])
+            write(open_tag)
+            write(text[start: end])
         else:
-            strings.append(snippet_words[i])
-            i += 1
-    return strings 
+            write(escape(text[pos: start]))
+            write(open_tag)
+            write(escape(text[start: end]))
+        write(close_tag)
+        pos = end
+    rest = text[pos: sentence_end]
+    write(rest if escape is None else escape(rest))
+
 
-def _select_snippet_sentences(sentences, query_words, max_chars, max_sents):
+def _highlighted_length(tokens, sentence, spans):
+    """Count the characters in a highlighted sentence's words and tags.
+
+    Args:
+      tokens: A `PreparedDocument`.
+      sentence: Integer index of a sentence in `tokens`.
+      spans: List of the query spans in the sentence.
+    Returns:
+      Integer that is the length of the sentence's words and highlight tags
+      without the spaces between them.
+    """
+    return (tokens.word_chars[sentence] +
+            len(spans) * (len(OPENTAG) + len(CLOSETAG)))
+
+
+def _select_snippet_sentences(tokens, query_words, max_chars, max_sents,
+                              strategy='greedy', ranked_sentences=None,
+                              scorer=None):
     """Select a relevant sublist of sentences.
 
     Args:
-      sentences: List of Lists of Strings (words) in a review.
-      query_words: List of strings representing query terms.
+      tokens: A `PreparedDocument`.
+      query_words: List of strings representing query terms or a
+        `CompiledQuery`.
+      strategy: String in `STRATEGIES`.
+      ranked_sentences: List of the triples `_rank_sentences` returns for
+        `tokens` and `query_words`, if they have already been computed.
+      scorer: `Scorer` that sentences are ranked with when `ranked_sentences`
+        is not given.
     Returns:
-      List of sentences taken from `sentences` not containing more sentences
-      than `max_sents` nor more characters than `max_chars`. If there are
-      more sentences or characters than the max value then sentences containing
-      the most query term matches and opinion-indicating words are selected.
+      List of sentence indices taken from `tokens` not containing more
+      sentences than `max_sents` nor more characters than `max_chars`. If there
+      are more sentences or characters than the max value then sentences
+      containing the most query term matches and opinion-indicating words are
+      selected.
     """
-    ranked_sentences = [(pos, sent, score) for (pos, (sent, score)) 
-                        in enumerate(_rank_sentences(sentences, query_words))]
+    if strategy not in STRATEGIES:
+        raise ValueError('Unknown strategy: %r' % (strategy,))
+
+    if ranked_sentences is None:
+        ranked_sentences = _rank_sentences(tokens, _as_compiled(query_words),
+                                           scorer)
+    greedy = _select_greedy(ranked_sentences, max_chars, max_sents)
+    if strategy == 'optimal':
+        optimal = _select_optimal(ranked_sentences, max_chars, max_sents)
+        # Rounding lengths up to whole buckets can hide sets that the greedy
+        # selection finds, so keep whichever scores higher.
+        if optimal is not None and (_total_score(optimal) >
+                                    _total_score(greedy)):
+            greedy = optimal
+
+    return sorted(ranked[0] for ranked in greedy)
 
-    ranked_sentences.sort(key=operator.itemgetter(2), reverse=True)
+
+def _total_score(ranked_sentences):
+    """Return the sum of the scores of (sentence, score, length) triples."""
+    return sum(ranked[1] for ranked in ranked_sentences)
+
+
+def _select_greedy(ranked_sentences, max_chars, max_sents):
+    """Select sentences from the highest score down while they fit.
+
+    Sentences that would go over `max_chars` are skipped. They are popped off
+    a heap so that only as many sentences as fit in the snippet need to be
+    ordered.
+
+    Args:
+      ranked_sentences: List of (sentence, score, length) triples as returned
+        by `_rank_sentences`.
+    Returns:
+      List of the selected triples. Sentences without a positive score are
+      only included if none with a positive score are.
+    """
+    # Ties in score are broken by position, as a stable sort by score would.
+    heap = [(-score, sentence, length)
+            for (sentence, score, length) in ranked_sentences]
+    heapq.heapify(heap)
 
     char_count = sent_count = 0
     keep = []
-    for (pos, sentence, score) in ranked_sentences:
-        length = len(''.join(_insert_highlights(sentence, query_words)))
+    # Every sentence has at least one character, so nothing more fits once
+    # either limit is reached.
+    while heap and sent_count < max_sents and char_count < max_chars:
+        neg_score, sentence, length = heapq.heappop(heap)
 
-        if char_count + length > max_chars or sent_count + 1 > max_sents:
+        # Sentences without a positive score are only included when no
+        # sentence with one is, so stop at the first.
+        if neg_score >= 0 and keep and keep[0][1] > 0:
+            break
+
+        if char_count + length > max_chars:
             continue
         else:
-            keep.append((pos, sentence, score))
+            keep.append((sentence, -neg_score, length))
             char_count += length
             sent_count += 1
 
-    keep.sort(key=operator.itemgetter(0))
+    return keep
 
-    # Only include sentences in the snippet if they have query or indicator
-    # word matches unless there aren't any-- then include all.
-    positive_scores = [triplet for triplet in keep if triplet[2] > 0]
-    if positive_scores:
-        return [triplet[1] for triplet in positive_scores]
-    else:
-        return [triplet[1] for triplet in keep]
 
+def _select_optimal(ranked_sentences, max_chars, max_sents):
+    """Select the sentences with the highest total score that fit the limits.
 
-def _rank_sentences(sentences, query_words):
-    """Compute each sentence's score.
+    This is a 0/1 knapsack over sentence lengths, solved by dynamic
+    programming. To bound its cost, lengths are rounded up to units of
+    `max_chars / OPTIMAL_CHAR_BUCKETS`, which never lets a selection go over
+    `max_chars`, and documents with more than `OPTIMAL_MAX_SENTENCES`
+    candidate sentences are not attempted.
+
+    Args:
+      ranked_sentences: List of (sentence, score, length) triples as returned
+        by `_rank_sentences`.
+    Returns:
+      List of the selected triples, or None if there is no character limit,
+      too many candidates, or no sentence with a positive score fits.
+    """
+    candidates = [ranked for ranked in ranked_sentences
+                  if ranked[1] > 0 and ranked[2] <= max_chars]
+    # Without a character limit the greedy selection is already optimal.
+    if (max_chars == INFINITY or not candidates or
+            len(candidates) > OPTIMAL_MAX_SENTENCES or max_sents < 1):
+        return None
+
+    unit = max(1, -(-int(max_chars) // OPTIMAL_CHAR_BUCKETS))
+    capacity = int(max_chars) // unit
+    # Counting sentences is only needed when max_sents could be exceeded.
+    count_sentences = max_sents < len(candidates)
+
+    # Maps (sentence count, units used) to the best (score, selection).
+    states = {(0, 0): (0, ())}
+    for ranked in candidates:
+        weight = -(-ranked[2] // unit)
+        for (count, used), (score, selection) in states.items():
+            if used + weight > capacity or count + 1 > max_sents:
+                continue
+            key = (count + 1 if count_sentences else 0, used + weight)
+            best = states.get(key)
+            if best is None or score + ranked[1] > best[0]:
+                states[key] = (score + ranked[1], selection + (ranked,))
+
+    # Of equally good selections prefer the shortest, then the fewest
+    # sentences. Each (count, units) key is unique, so this is deterministic.
+    (count, used), (score, selection) = max(
+        states.iteritems(),
+        key=lambda item: (item[1][0], -item[0][1], -item[0][0]))
+    return list(selection) if score > 0 else None
+
+
+def _rank_sentences(tokens, query_words, scorer=None):
+    """Compute each sentence's score and highlighted length.
+
+    The query-independent part of the scores is cached in `tokens`, and
+    query spans are only looked for in sentences with a word of the query.
 
     Args:
-      sentences: List of List (sentence) of Strings (words).
-      query_words: List of Strings that are words in the input query.
+      tokens: A `PreparedDocument`.
+      query_words: List of Strings that are words in the input query or a
+        `CompiledQuery`.
+      scorer: `Scorer` that sentences are scored with. Defaults to
+        `DEFAULT_SCORER`.
     Returns:
-      List of (sentence, score) pairs.
+      List of (sentence index, score, length) triples, where length is given
+      by `_highlighted_length`.
     """
+    query_words = _as_compiled(query_words)
+    if scorer is None:
+        scorer = DEFAULT_SCORER
+    static_scores = _static_scores(tokens, scorer,
+                                   query_words.opinion_indicators)
+    vocabulary = query_words.ids
+    ids, bounds, word_chars = tokens.ids, tokens.bounds, tokens.word_chars
     scores = []
-    for sentence in sentences:
-        score = _score_sentence(sentence, query_words)
-        scores.append((sentence, score))
+    for sentence in xrange(len(tokens)):
+        if vocabulary.isdisjoint(ids[bounds[sentence]: bounds[sentence + 1]]):
+            scores.append((sentence, static_scores[sentence],
+                           word_chars[sentence]))
+            continue
+        spans = _sentence_spans(tokens, sentence, query_words)
+        score = static_scores[sentence]
+        if spans:
+            score += scorer.match_score(tokens, sentence, spans, query_words)
+        length = _highlighted_length(tokens, sentence, spans)
+        scores.append((sentence, score, length))
 
     return scores
+
+
+def _static_scores(tokens, scorer, opinion_indicators):
+    """Return `scorer`'s query-independent sentence scores for `tokens`.
+
+    The scores of the last scorer and lexicon used with a document are kept
+    in it, so they are computed once however many queries it is ranked for.
+    """
+    cached = tokens.static_scores
+    if (cached is not None and cached[0] is scorer and
+            cached[1] is opinion_indicators):
+        return cached[2]
+    static_scores = scorer.static_scores(tokens, opinion_indicators)
+    tokens.static_scores = (scorer, opinion_indicators, static_scores)
+    return static_scores
+
+
+class Scorer(object):
+    """Scores sentences by their opinion count plus their query match score.
+
+    A sentence's score is split into a part that depends only on the
+    document, computed once per document by `static_scores`, and a part
+    that depends on the query, computed by `match_score` only for sentences
+    containing a query span. Subclasses can override either to score other
+    features.
+    """
+
+    def static_scores(self, tokens, opinion_indicators):
+        """Return the query-independent part of each sentence's score.
+
+        Args:
+          tokens: A `PreparedDocument`.
+          opinion_indicators: Set of opinion-indicating words or an
+            `OpinionLexicon` that the query is scored with.
+        Returns:
+          Sequence of numbers, one for each sentence in `tokens`.
+        """
+        if opinion_indicators is tokens.opinion_indicators:
+            return tokens.opinion_counts
+        return _opinion_counts(tokens, opinion_indicators)
+
+    def match_score(self, tokens, sentence, spans, query_words):
+        """Return the query-dependent part of a sentence's score.
+
+        Args:
+          tokens: A `PreparedDocument`.
+          sentence: Integer index of a sentence in `tokens`.
+          spans: Non-empty List of the query spans in the sentence.
+          query_words: A `CompiledQuery`.
+        Returns:
+          Number that is added to the sentence's static score.
+        """
+        return _compute_query_match_score(spans)
+
+
+class LinearScorer(Scorer):
+    """Scores sentences by a weighted sum of features.
+
+    The query-independent features are a sentence's opinion count, its
+    position, which is 1 for the first sentence, 1/2 for the second and so
+    on, and its number of words. The query-dependent feature is its query
+    match score. With the default weights the scores are those of `Scorer`.
+    """
+
+    def __init__(self, opinion=1, match=1, position=0, length=0):
+        self.opinion = opinion
+        self.match = match
+        self.position = position
+        self.length = length
+
+    def static_scores(self, tokens, opinion_indicators):
+        scores = Scorer.static_scores(self, tokens, opinion_indicators)
+        if self.opinion != 1:
+            scores = [self.opinion * score for score in scores]
+        if self.position or self.length:
+            bounds = tokens.bounds
+            scores = [score + self.position / (sentence + 1.0) +
+                      self.length * (bounds[sentence + 1] - bounds[sentence])
+                      for (sentence, score) in enumerate(scores)]
+        return scores
+
+    def match_score(self, tokens, sentence, spans, query_words):
+        return self.match * _compute_query_match_score(spans)
+
+    def __repr__(self):
+        return 'LinearScorer(opinion=%r, match=%r, position=%r, length=%r)' % (
+            self.opinion, self.match, self.position, self.length)
+
+
+# The scorer used when none is given.
+DEFAULT_SCORER = Scorer()
     
 
-def _count_opinion_indicators(sentence):
+def _count_opinion_indicators(sentence, indicators=OPINION_INDICATORS):
     """Count the number of words associated with opinions in `sentences`.
 
     Args:
-      sentence: List of Strings representing words.
+      sentence: Iterable of Strings representing words.
+      indicators: Set of opinion-indicating words or an `OpinionLexicon`.
     Returns:
-      Integer that is the number of `OPINION_INDICATORS` found in `sentence`.
+      Integer that is the number of `indicators` found in `sentence`, or the
+      sum of their weights for a lexicon.
     """
-    return sum(1 for word in sentence if word in OPINION_INDICATORS)
+    if isinstance(indicators, OpinionLexicon):
+        return indicators.score(sentence)
+    return sum(1 for word in sentence if word in indicators)
+
+
+def _opinion_counts(tokens, indicators, words=None):
+    """Count the opinion-indicating words in each sentence of a document.
+
+    Given the words as written, each is looked up in `indicators`. Otherwise
+    words are looked up by id, and only the few whose lowercased form is an
+    indicator are sliced from the text to check them as written.
 
+    Args:
+      tokens: A `PreparedDocument`.
+      indicators: Set of opinion-indicating words or an `OpinionLexicon`.
+      words: List of the words of `tokens` as written, or None.
+    Returns:
+      array of the `_count_opinion_indicators` of each sentence.
+    """
+    bounds = tokens.bounds
+    if isinstance(indicators, OpinionLexicon) and indicators.phrases:
+        return array('i', (
+            _count_opinion_indicators(
+                _sentence_words(tokens, sentence) if words is None else
+                words[bounds[sentence]: bounds[sentence + 1]], indicators)
+            for sentence in xrange(len(tokens))))
+
+    if words is not None and isinstance(indicators, OpinionLexicon):
+        weights = list(itertools.imap(indicators.weights.get, words,
+                                      itertools.repeat(0)))
+    elif words is not None and isinstance(indicators, (set, frozenset)):
+        weights = map(indicators.__contains__, words)
+    else:
+        weights = None
+    if weights is not None:
+        return array('i', itertools.imap(sum, itertools.imap(
+            weights.__getslice__, bounds, itertools.islice(bounds, 1, None))))
+
+    weights = _indicator_weights(indicators)
+    counts = array('i', [0]) * len(tokens)
+    text, starts, ends = tokens.text, tokens.starts, tokens.ends
+    ids = tokens.ids
+    for i in itertools.compress(itertools.count(),
+                                itertools.imap(weights.__contains__, ids)):
+        weight = weights[ids[i]].get(text[starts[i]: ends[i]])
+        if weight:
+            counts[bisect.bisect_right(bounds, i) - 1] += weight
+    return counts
+
+
+def _indicator_weights(indicators):
+    """Return the weight of each form of `indicators` by lowercased id.
+
+    The table is built once for each lexicon or Set of indicators and kept as
+    long as they are, so documents prepared with one and ranked with another
+    do not rebuild it for every document. It is built again after
+    `VOCABULARY` is reset.
 
-def _score_sentence(sentence, query_words):
+    Args:
+      indicators: Set of opinion-indicating words or an `OpinionLexicon`
+        without phrases.
+    Returns:
+      Dict mapping the `VOCABULARY` id of each indicator lowercased to a Dict
+      of the indicator's forms as written and their weights.
+    """
+    generation = VOCABULARY.generation
+    if isinstance(indicators, OpinionLexicon):
+        cached = indicators._id_weights
+        if cached is None or cached[0] != generation:
+            weights = _build_indicator_weights(indicators.weights.iteritems())
+            cached = indicators._id_weights = (generation, weights)
+        return cached[1]
+
+    # Sets cannot be hashed, so they are kept by id for as long as they live.
+    key = id(indicators)
+    cached = _set_indicator_weights.get(key)
+    if (cached is not None and cached[0]() is indicators and
+            cached[1] == generation):
+        return cached[2]
+    weights = _build_indicator_weights(
+        itertools.izip(indicators, itertools.repeat(1)))
+
+    def forget(ref):
+        if _set_indicator_weights.get(key, (None,))[0] is ref:
+            del _set_indicator_weights[key]
+    try:
+        _set_indicator_weights[key] = (weakref.ref(indicators, forget),
+                                       generation, weights)
+    except TypeError:
+        # Other iterables, such as Lists, cannot be referenced weakly.
+        pass
+    return weights
+
+
+def _build_indicator_weights(entries):
+    """Return `_indicator_weights`'s table for (word, weight) `entries`."""
+    weights = collections.defaultdict(dict)
+    for (word, weight) in entries:
+        weights[VOCABULARY[word.lower()]][word] = weight
+    return dict(weights)
+
+# Maps the id of each Set of indicators in use to a weak reference to it, the
+# `VOCABULARY.generation` and its `_indicator_weights`.
+_set_indicator_weights = {}
+
+
+def _score_sentence(tokens, sentence, spans, query_words):
     """Compute score for a sentence wrt `query_words` and `OPINION_INDICATORS`.
 
     Args:
-      sentence: List of Strings (words).
-      query_words: List of Strings that are words in the query.
+      tokens: A `PreparedDocument`.
+      sentence: Integer index of a sentence in `tokens`.
+      spans: List of the query spans in the sentence.
+      query_words: A `CompiledQuery`.
     Returns:
       Integer that is the score.
     """
-    opinion_indicator_count = _count_opinion_indicators(sentence)
-    query_match_score = _compute_query_match_score(sentence, query_words)
+    if query_words.opinion_indicators is tokens.opinion_indicators:
+        opinion_indicator_count = tokens.opinion_counts[sentence]
+    else:
+        opinion_indicator_count = _count_opinion_indicators(
+            _sentence_words(tokens, sentence), query_words.opinion_indicators)
+    query_match_score = _compute_query_match_score(spans)
     return opinion_indicator_count + query_match_score
     
 
-def _compute_query_match_score(sentence, query_words):
-    """Compute the extent to which `sentence` matches words in `query_words`.
+def _compute_query_match_score(spans):
+    """Compute the extent to which a sentence matches the query.
 
     To obtain a score:
-      * Find all subspans in `sentence` that are also in `query_words`.
+      * Find all subspans in the sentence that are also in the query.
       * The score is the sum of the squares of the lengths of each non-
         overlapping subspan.
     
     Args:
-      sentence: List of Strings, where each String is a word.
-      query_words: List of Strings representing words in the query.
+      spans: List of (start, end) pairs, as returned by `_find_query_spans`.
     Returns:
-      Integer representing the number of partial and whole `query_words` matches
-      in `sentence`.
+      Integer representing the number of partial and whole query matches
+      in the sentence.
     """
-    spans = _find_query_spans(sentence, query_words)
-    return sum((span[1] - span[0]) ** 2 for span in spans)
+    return sum((end - start) ** 2 for (start, end) in spans)
 
 
+# `_find_query_spans`, `_join_words`, `_split_into_sentences` and
+# `_split_into_words` work on Strings and Lists of words rather than on a
+# `PreparedDocument`. Snippets no longer go through them. They stay because
+# test.py states how documents are split, matched and joined through them on
+# plain Strings, and `_split_into_words` still splits queries and lexicon
+# phrases.
 def _find_query_spans(words, query_words):
     """Find all non-overlapping spans in `words` that are in `query_words`.
+
+    A span is a run of words that also appear consecutively in the query, or
+    one of the query's expansions.
+
     Args:
       words: List of Strings
-      query_words: List of strings
+      query_words: List of strings or a `CompiledQuery`.
     Returns:
       List of Integer pairs indicating the start and end indices of all non-
       overlapping `query_words` in `words`. Longer strings are preferred over
       short ones.
     """
-    spans = []
-    in_span = False
-    old_query_index = None
-    span_start = None
-
-    # Queries are considered case-insensitive.
-    words = [word.lower() for word in words]
-    query_words = [query_word.lower() for query_word in query_words]
-
-    for i, word in enumerate(words):
-        if word in query_words:
-            query_index = query_words.index(word)
-
-            if in_span:
-                if old_query_index + 1 != query_index:
-                    # Found end of span and beginning of new
-                    span_end = i
-                    spans.append((span_start, span_end))
-                    span_start = i
-            else:
-                # Found beginning of new span
-                in_span = True
-                span_start = i
-            old_query_index = query_index
-
-        elif word not in query_words and in_span:
-            # Found end of span
-            in_span = False
-            span_end = i
-            spans.append((span_start, span_end))
+    # Queries are considered case-insensitive. The query's terms are lowercased
+    # when it is compiled so only the words need to be lowercased here. A word
+    # with no id yet cannot be in the query.
+    return _as_compiled(query_words).matcher.find_spans(
+        VOCABULARY.get(word.lower()) for word in words)
 
-    if in_span:
-        # Add final span if one ends at the list list item
-        spans.append((span_start, len(words)))
-
-    return spans
 
 def _join_words(words):
     """Join `words` with spaces only where appropriate.
@@ -284,16 +2415,18 @@ def _split_into_sentences(doc):
     Args:
       doc: String representing a review document.
     Returns:
-      List of individual sentences (Strings) in `doc`.
+      List of individual sentences (Strings) in `doc` with runs of whitespace
+      replaced by single spaces.
     """
-    doc = re.sub(r'\s+', ' ', doc)
-    pat = re.compile(r"""([A-Za-z0-9 ,'"@#$%^&*()~=+-]+(\.{3}|[.?!]))""")
-    sentences = [sent[0].strip() for sent in pat.findall(doc)]
+    tokens = _tokenize(doc)
+    starts, ends, bounds = tokens.starts, tokens.ends, tokens.bounds
+    sentences = [re.sub(r'\s+', ' ', doc[starts[bounds[i]]: ends[bounds[i + 1] - 1]])
+                 for i in xrange(len(tokens))]
 
     # Return the doc itself as the sentence if there are no matches so that
-    # a document without punctuation will be considered a single sentence.
+    # a document without any words will be considered a single sentence.
     if not sentences:
-        return [doc]
+        return [re.sub(r'\s+', ' ', doc)]
     else:
         return sentences
 
@@ -305,16 +2438,98 @@ def _split_into_words(sentence):
     Returns:
       List of words and punctuation marks in `sentence`.
     """
-    pat = re.compile(r"""
-            ['"]?[-A-Za-z0-9@#$%^&*()'~=+_-]+['"]? # letters, optionally quoted
-            |
-            ,                      # comma
-            |
-            \.{3}                  # ellipsis
-            |
-            [.?!]                  # other punctuation
-            """, re.VERBOSE)
-    return pat.findall(sentence)
+    return [match.group() for match in TOKEN_PATTERN.finditer(sentence)]
+
+
+def _read_jsonl(lines):
+    """Lazily parse JSON records from an iterable of lines.
+
+    Args:
+      lines: Iterable of Strings, each holding one JSON object. Blank lines
+        are skipped.
+    Returns:
+      Generator of Dicts.
+    """
+    import json
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _windows(iterable, size):
+    """Split `iterable` into Lists of at most `size` items without reading ahead.
+
+    Args:
+      iterable: Any iterable.
+      size: Integer that is the max number of items in a window.
+    Returns:
+      Generator of non-empty Lists.
+    """
+    iterator = iter(iterable)
+    while True:
+        window = list(itertools.islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def _snippet_records(records, query, max_chars, max_sents, text_field='text',
+                     id_field='review_id', pool=None, chunksize=64,
+                     window_size=None, strategy='greedy', stats=None,
+                     tags=HIGHLIGHT_TAGS):
+    """Snippet a stream of review records.
+
+    Records are consumed a window at a time so memory use is bounded by the
+    window size no matter how long the stream is.
+
+    Args:
+      records: Iterable of Dicts. Each holds a document under `text_field` and
+        optionally a "query" that overrides `query` for that record.
+      query: Default query String, or None if every record has its own.
+      max_chars: Integer indicating the max number of chars in each snippet.
+      max_sents: Integer indicating the max number of sentences in each snippet.
+      text_field: String that is the key of the document in each record.
+      id_field: String that is the key copied from each record to its result.
+      pool: Optional `multiprocessing.Pool` that windows are mapped over.
+      chunksize: Integer number of records sent to a worker at a time.
+      window_size: Integer number of records read before they are snippeted.
+        Defaults to `chunksize`.
+      strategy: String in `STRATEGIES` naming how sentences are selected.
+      stats: Optional `PipelineStats` that every snippet is recorded in. It
+        cannot be used with `pool`.
+      tags: `Tags` that highlighted spans are marked with.
+    Returns:
+      Generator of result Dicts holding the record's `id_field` (when it has
+      one) and its "snippet", in the same order as `records`.
+    """
+    if stats is not None and pool is not None:
+        raise ValueError('Stats cannot be recorded in a process pool.')
+    default = compile_query(query) if query is not None else None
+    window_size = window_size or chunksize
+
+    for window in _windows(records, window_size):
+        pairs = []
+        for record in window:
+            record_query = record.get('query', default)
+            if record_query is None:
+                raise ValueError('Record has no query: %r' % (record,))
+            pairs.append((record[text_field], record_query))
+
+        chunks = [(pairs[i: i + chunksize], max_chars, max_sents, strategy,
+                   stats, tags)
+                  for i in xrange(0, len(pairs), chunksize)]
+        if pool is None:
+            results = map(_highlight_chunk, chunks)
+        else:
+            results = pool.map(_highlight_chunk, chunks, chunksize=1)
+
+        snippets = itertools.chain.from_iterable(results)
+        for record, snippet in itertools.izip(window, snippets):
+            result = {'snippet': snippet}
+            if id_field in record:
+                result[id_field] = record[id_field]
+            yield result
 
 
 def main(args):
@@ -329,28 +2544,153 @@ def main(args):
 
     The maximum number of characters or sentences to be included in the snippet
     can be specified using the --chars and --sents options.
+
+    With --input the program instead reads one JSON review per line from a
+    file ('-' for stdin) and writes one JSON result per line to --output
+    (stdout by default). Each review's text is snippeted with its own "query"
+    field if it has one and with --query otherwise. Reviews are streamed, so
+    memory use stays flat for arbitrarily large inputs, and --workers spreads
+    the work over several processes.
+
+    With --profile the time taken by each stage of snippeting, summed over all
+    the reviews, and a cProfile report of the run are written to stderr.
+
+    With 'serve' as the first argument the program instead serves snippets
+    over HTTP/JSON; see snippet_server.py for its options.
     """
+    if args[:1] == ['serve']:
+        import snippet_server
+        return snippet_server.main(args[1:])
+    from optparse import OptionParser
 
     description = 'Command-line interface to the snippet maker.'
-    usage = '%prog <DOCUMENT> <QUERY_STRING> [options]'
+    usage = ('%prog <DOCUMENT> <QUERY_STRING> [options]\n'
+             '       %prog --input <REVIEWS.jsonl> [--query <QUERY_STRING>] '
+             '[options]\n'
+             '       %prog serve [--store <REVIEWS.store>] [options]')
     parser = OptionParser(usage=usage, description=description)
 
     parser.add_option('-c', '--chars', dest='max_chars', default=INFINITY,
+        type='int',
         help='The maximum number of characters to include in the snippet.')
 
     parser.add_option('-s', '--sents', dest='max_sents', default=INFINITY,
+        type='int',
         help='The maximum number of sentences to include in the snippet.')
 
+    parser.add_option('--strategy', dest='strategy', default='greedy',
+        type='choice', choices=STRATEGIES,
+        help='How snippet sentences are selected: greedy (default) or '
+             'optimal.')
+
+    parser.add_option('--tags', dest='tags', default='highlight',
+        type='choice', choices=sorted(TAG_STYLES),
+        help='How highlighted words are marked: highlight (default, '
+             '[[HIGHLIGHT]] tags), html (<mark> tags, with the text escaped) '
+             'or ansi (bold terminal colors).')
+
+    parser.add_option('-i', '--input', dest='input',
+        help='JSON-lines file of reviews to snippet, or - for stdin.')
+
+    parser.add_option('-o', '--output', dest='output', default='-',
+        help='File that JSON-lines results are written to (default stdout).')
+
+    parser.add_option('-q', '--query', dest='query',
+        help='Query for reviews in --input that have no "query" field.')
+
+    parser.add_option('--text-field', dest='text_field', default='text',
+        help='Field holding the review text in --input (default "text").')
+
+    parser.add_option('--id-field', dest='id_field', default='review_id',
+        help='Field copied from each review to its result '
+             '(default "review_id").')
+
+    parser.add_option('-w', '--workers', dest='workers', default=1,
+        type='int', help='Number of processes to snippet --input with.')
+
+    parser.add_option('--chunksize', dest='chunksize', default=64, type='int',
+        help='Number of reviews sent to a worker process at a time.')
+
+    parser.add_option('--profile', dest='profile', action='store_true',
+        default=False,
+        help='Write per-stage timings and a cProfile report to stderr.')
 
     options, args = parser.parse_args(args)
 
+    stats = PipelineStats() if options.profile else None
+    if options.input is not None:
+        if args:
+            parser.error('Positional arguments cannot be used with --input.')
+        if options.profile and options.workers > 1:
+            parser.error('--profile cannot be used with more than one worker.')
+        return _profiled(_main_jsonl, stats, options, stats)
+
     if len(args) != 2:
         parser.error('Incorrect number of arguments.')
     doc = args[0]
     query = args[1]
 
-    snippet = highlight_doc(doc, query, options.max_chars, options.max_sents)
-    print snippet
+    _profiled(write_snippet, stats, sys.stdout, doc, query, options.max_chars,
+              options.max_sents, options.strategy, stats, None,
+              TAG_STYLES[options.tags])
+    sys.stdout.write('\n')
+    return 0
+
+
+def _profiled(function, stats, *args):
+    """Call `function` with `args`, profiling it if `stats` is given.
+
+    After the call the stage timings in `stats` and the functions that took
+    the most cumulative time are written to stderr.
+    """
+    if stats is None:
+        return function(*args)
+
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        sys.stderr.write(stats.report() + '\n\n')
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(PROFILE_LINES)
+
+
+def _main_jsonl(options, stats=None):
+    """Snippet the JSON-lines file named by `options.input`.
+
+    Args:
+      options: Options parsed by `main`.
+      stats: Optional `PipelineStats` that every snippet is recorded in.
+    Returns:
+      Integer exit status.
+    """
+    import json
+    import multiprocessing
+    infile = sys.stdin if options.input == '-' else open(options.input)
+    outfile = sys.stdout if options.output == '-' else open(options.output, 'w')
+    pool = multiprocessing.Pool(options.workers) if options.workers > 1 else None
+    try:
+        results = _snippet_records(_read_jsonl(infile), options.query,
+                                   options.max_chars, options.max_sents,
+                                   options.text_field, options.id_field, pool,
+                                   options.chunksize,
+                                   # Keep every worker busy with two chunks.
+                                   options.chunksize * options.workers * 2,
+                                   options.strategy, stats,
+                                   TAG_STYLES[options.tags])
+        for result in results:
+            outfile.write(json.dumps(result))
+            outfile.write('\n')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
     return 0
 
 
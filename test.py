@@ -5,8 +5,26 @@ These tests are meant to be run using nosetests.
 """
 
 
+import json
+import os
+import pickle
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+
+import snippet_cache
+import snippet_server
+import snippet_store
 import snippets
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench'))
+import bench_suite
+
 class TestFullMatch(object):
     def test_(self):
         doc = query = 'pepperoni pizza'
@@ -299,3 +317,1405 @@ class TestJoinWords(object):
         assert joined == 'Whatever... Hey there.'
 
 
+class TestCompiledQuery(object):
+    def test_compile(self):
+        query = snippets.compile_query('Deep DISH pizza')
+        assert query.words == ['Deep', 'DISH', 'pizza']
+        assert query.terms == ['deep', 'dish', 'pizza']
+
+    def test_compile_is_idempotent(self):
+        query = snippets.compile_query('pizza')
+        assert snippets.compile_query(query) is query
+
+    def test_repeated_term(self):
+        words = 'pizza and pizza and pizza'.split()
+        query = snippets.compile_query('pizza and pizza')
+        spans = snippets._find_query_spans(words, query)
+        assert spans == [(0, 3), (3, 5)]
+
+    def test_same_snippet_as_string(self):
+        doc = 'Their specialty pizza is deep dish pizza. I love it.'
+        query = 'deep dish pizza'
+        compiled = snippets.compile_query(query)
+        assert (snippets.highlight_doc(doc, compiled) ==
+                snippets.highlight_doc(doc, query))
+
+    def test_find_query_spans(self):
+        words = 'Pizza ? I love deep dish ! Deep dish pizza is great .'.split()
+        query = snippets.compile_query('deep dish pizza')
+        spans = snippets._find_query_spans(words, query)
+        assert spans == [(0, 1), (4, 6), (7, 10)]
+
+
+class TestHighlightMany(object):
+    def test_order(self):
+        docs = ['I love pizza.', 'Sushi is great. Pizza is not.']
+        snippets_ = snippets.highlight_many(docs, 'pizza')
+        assert snippets_ == [snippets.highlight_doc(doc, 'pizza')
+                             for doc in docs]
+
+    def test_limits(self):
+        docs = ['I love pepperoni. Pepperoni. Pepperoni.']
+        query = snippets.compile_query('pepperoni')
+        snippets_ = snippets.highlight_many(docs, query, max_sents=1)
+        assert snippets_[0].count('.') == 1
+
+class TestHighlightBatch(object):
+    PAIRS = [('I love pizza. The service was slow.', 'pizza'),
+             ('Sushi is great. Sushi again!', 'sushi'),
+             ('They have sushi. They also have Thai food.', 'burgers'),
+             ('I love pepperoni. Pepperoni. Pepperoni.',
+              snippets.compile_query('pepperoni'))]
+
+    def expected(self, max_chars=snippets.INFINITY,
+                 max_sents=snippets.INFINITY):
+        return [snippets.highlight_doc(doc, query, max_chars, max_sents)
+                for (doc, query) in self.PAIRS]
+
+    def test_serial(self):
+        results = snippets.highlight_batch(self.PAIRS, workers=1)
+        assert results == self.expected()
+
+    def test_parallel(self):
+        results = snippets.highlight_batch(self.PAIRS * 5, workers=2,
+                                           chunksize=3, min_parallel=0)
+        assert results == self.expected() * 5
+
+    def test_limits(self):
+        results = snippets.highlight_batch(self.PAIRS, max_sents=1, workers=2,
+                                           min_parallel=0)
+        assert results == self.expected(max_sents=1)
+
+    def test_empty(self):
+        assert snippets.highlight_batch([], workers=2, min_parallel=0) == []
+
+class TestJsonlMode(object):
+    RECORDS = [{'review_id': 'a', 'text': 'I love pizza. Meh.'},
+               {'review_id': 'b', 'text': 'Sushi! Pie is good.',
+                'query': 'pie'},
+               {'text': 'Nothing to see here.'}]
+
+    def setup(self):
+        fd, self.input = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            for record in self.RECORDS:
+                f.write(json.dumps(record) + '\n')
+        fd, self.output = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+
+    def teardown(self):
+        os.remove(self.input)
+        os.remove(self.output)
+
+    def read_output(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records(self):
+        results = list(snippets._snippet_records(
+            iter(self.RECORDS), 'pizza', snippets.INFINITY, snippets.INFINITY,
+            chunksize=2))
+        assert results == [
+            {'review_id': 'a',
+             'snippet': 'I love [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].'},
+            {'review_id': 'b',
+             'snippet': '[[HIGHLIGHT]]Pie[[ENDHIGHLIGHT]] is good.'},
+            {'snippet': 'Nothing to see here.'}]
+
+    def test_missing_query(self):
+        try:
+            list(snippets._snippet_records(self.RECORDS, None,
+                                           snippets.INFINITY,
+                                           snippets.INFINITY))
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+    def test_main(self):
+        status = snippets.main(['--input', self.input, '--output', self.output,
+                                '--query', 'pizza', '--sents', '1'])
+        assert status == 0
+        results = self.read_output()
+        assert [result.get('review_id') for result in results] == \
+            ['a', 'b', None]
+        assert results[0]['snippet'] == snippets.highlight_doc(
+            self.RECORDS[0]['text'], 'pizza', max_sents=1)
+
+    def test_main_workers(self):
+        snippets.main(['--input', self.input, '--output', self.output,
+                       '--query', 'pizza', '--workers', '2',
+                       '--chunksize', '1'])
+        results = self.read_output()
+        assert [result['snippet'] for result in results] == [
+            snippets.highlight_doc(record['text'],
+                                   record.get('query', 'pizza'))
+            for record in self.RECORDS]
+
+class TestImportTime(object):
+    # Modules that only the command line, process pools and lexicon digests
+    # use. Importing snippets for highlight_doc must not import them.
+    DEFERRED = ('cProfile', 'hashlib', 'json', 'multiprocessing', 'optparse',
+                'pstats')
+    # Generous, since the bytecode may have to be compiled; importing the
+    # deferred modules up front took about 12 ms more.
+    MAX_SECONDS = 0.1
+
+    def run(self, code):
+        directory = os.path.dirname(os.path.abspath(snippets.__file__))
+        return subprocess.check_output([sys.executable, '-c', code],
+                                       cwd=directory)
+
+    def test_deferred_imports(self):
+        modules = self.run('import sys, snippets\n'
+                           'snippets.highlight_doc("I love pizza.", "pizza")\n'
+                           'print " ".join(sys.modules)').split()
+        assert not set(self.DEFERRED).intersection(modules)
+
+    def test_import_time(self):
+        seconds = min(float(self.run('import timeit\n'
+                                     'start = timeit.default_timer()\n'
+                                     'import snippets\n'
+                                     'print timeit.default_timer() - start'))
+                      for _ in xrange(3))
+        assert seconds < self.MAX_SECONDS, seconds
+
+
+class TestPipelineStats(object):
+    DOC = 'I love deep dish pizza. Pizza and pasta! Meh.'
+
+    def test_same_snippet(self):
+        for max_sents in (1, snippets.INFINITY):
+            stats = snippets.PipelineStats()
+            assert snippets.highlight_doc(self.DOC, 'deep dish pizza',
+                                          max_sents=max_sents, stats=stats) == \
+                snippets.highlight_doc(self.DOC, 'deep dish pizza',
+                                       max_sents=max_sents)
+
+    def test_counts(self):
+        stats = snippets.PipelineStats()
+        snippets.highlight_many([self.DOC, 'Pizza.'], 'deep dish pizza',
+                                max_sents=1, stats=stats)
+        assert all(stats.calls[stage] == 2
+                   for stage in snippets.PipelineStats.STAGES)
+        assert stats.counts['prepare'] == {'sentences': 4, 'tokens': 14}
+        assert stats.counts['rank'] == {'spans': 3}
+        assert stats.counts['select'] == {'selected': 2}
+        assert stats.counts['highlight'] == {'highlights': 2}
+        assert 'rank' in stats.report()
+
+    def test_callback(self):
+        records = []
+
+        class Recorder(object):
+            def record(self, stage, seconds, **counts):
+                records.append(stage)
+
+        snippets.highlight_doc(self.DOC, 'pizza', stats=Recorder())
+        assert records == list(snippets.PipelineStats.STAGES)
+
+    def test_records(self):
+        stats = snippets.PipelineStats()
+        list(snippets._snippet_records(TestJsonlMode.RECORDS, 'pizza',
+                                       snippets.INFINITY, snippets.INFINITY,
+                                       stats=stats))
+        assert stats.calls['join'] == len(TestJsonlMode.RECORDS)
+
+
+class TestOriginalText(object):
+    def test_spacing_preserved(self):
+        doc = 'I love  pizza,pasta and\nsalad !'
+        snippet = snippets.highlight_doc(doc, 'pizza')
+        assert snippet == ('I love  [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]],pasta '
+                           'and\nsalad !')
+
+    def test_span_keeps_inner_spacing(self):
+        doc = 'Deep   dish pizza.'
+        snippet = snippets.highlight_doc(doc, 'deep dish')
+        assert snippet == '[[HIGHLIGHT]]Deep   dish[[ENDHIGHLIGHT]] pizza.'
+
+    def test_sentences_joined_with_space(self):
+        doc = 'Pizza!\n\nMeh.\n\nMore pizza.'
+        snippet = snippets.highlight_doc(doc, 'pizza')
+        assert snippet == ('[[HIGHLIGHT]]Pizza[[ENDHIGHLIGHT]]! More '
+                           '[[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].')
+
+    def test_empty(self):
+        assert snippets.highlight_doc('', 'pizza') == ''
+
+
+class TestTokenize(object):
+    def test_offsets(self):
+        doc = ' I like it.  Pizza! '
+        tokens = snippets._tokenize(doc)
+        words = [doc[start: end]
+                 for (start, end) in zip(tokens.starts, tokens.ends)]
+        assert words == ['I', 'like', 'it', '.', 'Pizza', '!']
+        assert list(tokens.bounds) == [0, 4, 6]
+        assert len(tokens) == 2
+
+    def test_no_punctuation(self):
+        tokens = snippets._tokenize('I want some Thai food')
+        assert list(tokens.bounds) == [0, 5]
+
+class TestSinglePassTokenizer(object):
+    def test_price_sentence_end(self):
+        doc = 'It cost $9.47. I love it.'
+        assert snippets._split_into_sentences(doc) == ['It cost $9.47.',
+                                                       'I love it.']
+
+    def test_decimal_needs_digit(self):
+        words = snippets._split_into_words('Great pizza.Best in town.')
+        assert words == ['Great', 'pizza', '.', 'Best', 'in', 'town', '.']
+
+    def test_ellipsis_before_number(self):
+        words = snippets._split_into_words('Wait...5 stars.')
+        assert words == ['Wait', '...', '5', 'stars', '.']
+
+    def test_punctuation_run(self):
+        doc = 'Really?! Yes.'
+        assert snippets._split_into_sentences(doc) == ['Really?!', 'Yes.']
+
+    def test_trailing_fragment(self):
+        doc = 'I love pizza. And sushi'
+        assert snippets._split_into_sentences(doc) == ['I love pizza.',
+                                                       'And sushi']
+
+    def test_other_characters_do_not_split(self):
+        doc = 'Great food: loved it.'
+        assert snippets._split_into_sentences(doc) == ['Great food: loved it.']
+        assert (snippets.highlight_doc(doc, 'food') ==
+                'Great [[HIGHLIGHT]]food[[ENDHIGHLIGHT]]: loved it.')
+
+    def test_price_query(self):
+        doc = 'It cost $9.47. Meh.'
+        assert (snippets.highlight_doc(doc, '$9.47') ==
+                'It cost [[HIGHLIGHT]]$9.47[[ENDHIGHLIGHT]].')
+
+class TestSelectSnippetSentences(object):
+    def select(self, doc, query, max_chars=snippets.INFINITY,
+               max_sents=snippets.INFINITY):
+        tokens = snippets._tokenize(doc)
+        return snippets._select_snippet_sentences(
+            tokens, snippets.compile_query(query), max_chars, max_sents)
+
+    def test_rank_lengths(self):
+        tokens = snippets._tokenize('I love pizza. Meh.')
+        ranked = snippets._rank_sentences(tokens, ['pizza'])
+        tags = len(snippets.OPENTAG) + len(snippets.CLOSETAG)
+        assert ranked == [(0, 2, len('Ilovepizza.') + tags), (1, 0, 4)]
+
+    def test_skips_long_sentence(self):
+        doc = 'Pizza pizza pizza is what I want. Meh. Pizza!'
+        assert self.select(doc, 'pizza', max_chars=40) == [2]
+
+    def test_ties_keep_position(self):
+        doc = 'Pizza one. Pizza two. Pizza three.'
+        assert self.select(doc, 'pizza', max_sents=2) == [0, 1]
+
+    def test_zero_scores_dropped(self):
+        doc = 'Meh. I love pizza. Whatever.'
+        assert self.select(doc, 'pizza') == [1]
+
+    def test_zero_scores_when_nothing_matches(self):
+        doc = 'Meh. Whatever.'
+        assert self.select(doc, 'pizza', max_sents=1) == [0]
+
+class TestWriteSnippet(object):
+    DOC = 'I <3 deep dish pizza & "pie". The pizza was great! Meh.'
+
+    def write(self, *args, **kwargs):
+        sink = StringIO.StringIO()
+        snippets.write_snippet(sink, *args, **kwargs)
+        return sink.getvalue()
+
+    def test_same_as_highlight_doc(self):
+        for query in ('pizza', 'deep dish pizza', 'sushi'):
+            for max_sents in (1, snippets.INFINITY):
+                assert self.write(self.DOC, query, max_sents=max_sents) == \
+                    snippets.highlight_doc(self.DOC, query,
+                                           max_sents=max_sents)
+
+    def test_html_tags(self):
+        assert self.write(self.DOC, 'deep dish', max_sents=1,
+                          tags=snippets.HTML_TAGS) == (
+            'I &lt;3 <mark>deep dish</mark> pizza &amp; &quot;pie&quot;.')
+
+    def test_escape_html_quotes(self):
+        # The output can be written inside attribute values of either quote.
+        assert snippets.escape_html('''Joe's "deep dish"''') == \
+            'Joe&#39;s &quot;deep dish&quot;'
+        assert snippets.highlight_doc("Joe's pizza.", 'pizza',
+                                      tags=snippets.HTML_TAGS) == \
+            'Joe&#39;s <mark>pizza</mark>.'
+
+    def test_tags_attributes(self):
+        tags = snippets.Tags(open_tag='<b>', close_tag='</b>')
+        assert (tags.open_tag, tags.close_tag, tags.escape) == \
+            ('<b>', '</b>', None)
+
+    def test_custom_tags(self):
+        tags = snippets.Tags('*', '*')
+        assert snippets.highlight_doc(self.DOC, 'pizza', max_sents=1,
+                                      tags=tags) == \
+            'The *pizza* was great!'
+        # The sentences are selected as with the default tags.
+        assert snippets.highlight_doc(self.DOC, 'pizza', max_chars=34,
+                                      tags=tags) == 'Meh.'
+
+    def test_lazy_pipeline(self):
+        doc = 'We waited by the <door> for a table. ' * 60
+        for query in ('door', 'sushi'):
+            assert self.write(doc, query, max_sents=2,
+                              tags=snippets.HTML_TAGS) == \
+                snippets.highlight_doc(doc, query, max_sents=2,
+                                       scorer=snippets.DEFAULT_SCORER,
+                                       tags=snippets.HTML_TAGS)
+
+    def test_stats(self):
+        stats = snippets.PipelineStats()
+        assert self.write(self.DOC, 'pizza', stats=stats,
+                          tags=snippets.ANSI_TAGS) == \
+            snippets.highlight_doc(self.DOC, 'pizza', tags=snippets.ANSI_TAGS)
+        assert stats.counts['highlight']['highlights'] == 2
+
+
+class TestSnippetSpans(object):
+    DOC = 'I <3 deep dish pizza & "pie". The pizza was great! Meh.'
+
+    def test_offsets(self):
+        sentences, highlights = snippets.snippet_spans(self.DOC, 'pizza',
+                                                       max_sents=2)
+        assert [self.DOC[start: end] for (start, end) in sentences] == \
+            ['I <3 deep dish pizza & "pie".', 'The pizza was great!']
+        assert [self.DOC[start: end] for (start, end) in highlights] == \
+            ['pizza', 'pizza']
+        assert snippets.snippet_spans(self.DOC, 'deep dish pizza',
+                                      max_sents=1)[1] == [(5, 20)]
+
+    def test_render_same_as_highlight_doc(self):
+        prepared = snippets.prepare_document(self.DOC)
+        for query in ('pizza', 'deep dish pizza', 'great', 'sushi', ''):
+            for (max_chars, max_sents) in ((snippets.INFINITY, 1), (40, 2),
+                                           (0, snippets.INFINITY)):
+                for doc in (self.DOC, prepared):
+                    spans = snippets.snippet_spans(doc, query, max_chars,
+                                                   max_sents)
+                    for tags in (snippets.HIGHLIGHT_TAGS, snippets.HTML_TAGS):
+                        assert snippets.render_spans(doc, spans, tags) == \
+                            snippets.highlight_doc(doc, query, max_chars,
+                                                   max_sents, tags=tags)
+
+    def test_lazy_pipeline(self):
+        doc = TestLazyPipeline.DOC
+        for query in ('pizza', 'sushi'):
+            assert snippets.snippet_spans(doc, query, max_sents=2) == \
+                snippets.snippet_spans(doc, query, max_sents=2,
+                                       scorer=snippets.DEFAULT_SCORER)
+
+    def test_json(self):
+        spans = snippets.snippet_spans(self.DOC, 'pizza')
+        assert json.loads(json.dumps(spans)) == \
+            [[list(span) for span in offsets] for offsets in spans]
+
+
+class TestLazyPipeline(object):
+    # Long enough for highlight_doc to only tokenize the sentences it needs.
+    FILLER = 'We sat at the table by the window and waited. ' * 60
+    DOC = (FILLER + 'The pizza was amazing! ' + FILLER +
+           'Wait... "Love" the $9.47 pizza.5 deal. ' + FILLER)
+    LIMITS = [(snippets.INFINITY, snippets.INFINITY), (snippets.INFINITY, 1),
+              (80, snippets.INFINITY), (30, 2), (1, 1)]
+
+    def check(self, doc, query):
+        assert len(doc) >= snippets.LAZY_MIN_CHARS
+        for (max_chars, max_sents) in self.LIMITS:
+            assert snippets.highlight_doc(doc, query, max_chars, max_sents) == \
+                snippets.highlight_doc(doc, query, max_chars, max_sents,
+                                       scorer=snippets.DEFAULT_SCORER)
+
+    def test_same_snippets(self):
+        for query in ('pizza', 'deal pizza', 'window', 'sushi', 'love', ''):
+            self.check(self.DOC, query)
+
+    def test_no_hits(self):
+        self.check(self.FILLER, 'sushi')
+        assert snippets.highlight_doc(self.FILLER, 'sushi', max_sents=2) == \
+            ' '.join([self.FILLER.split('. ')[0] + '.'] * 2)
+
+    def test_too_many_hits(self):
+        doc = 'I love pizza. ' * 200
+        query = snippets.compile_query('pizza')
+        assert snippets._lazy_spans(doc, query, snippets.INFINITY, 1) is None
+        self.check(doc, query)
+
+    def test_sentence_around(self):
+        tokens = snippets.prepare_document(self.DOC)
+        for sentence in (0, 1, 60, 61, len(tokens) - 1):
+            first, last = tokens.bounds[sentence], tokens.bounds[sentence + 1]
+            spans = zip(tokens.starts[first: last], tokens.ends[first: last])
+            assert snippets._sentence_around(self.DOC, spans[0][0]) == spans
+            assert snippets._sentence_around(self.DOC, spans[-1][1] - 1) == \
+                spans
+        assert snippets._sentence_around(self.DOC, len(self.DOC)) is None
+
+    def test_iter_sentences(self):
+        tokens = snippets.prepare_document(self.DOC)
+        bounds = tokens.bounds
+        assert [(start, end) for (start, end, length)
+                in snippets._iter_sentences(self.DOC)] == \
+            [(tokens.starts[bounds[i]], tokens.ends[bounds[i + 1] - 1])
+             for i in xrange(len(tokens))]
+
+
+class TestOptimalStrategy(object):
+    DOC = 'Pizza is great nice. So good pizza. So nice pizza.'
+
+    def test_greedy_leaves_budget_unused(self):
+        snippet = snippets.highlight_doc(self.DOC, 'pizza', max_chars=82)
+        assert snippet == '[[HIGHLIGHT]]Pizza[[ENDHIGHLIGHT]] is great nice.'
+
+    def test_optimal_fills_budget(self):
+        snippet = snippets.highlight_doc(self.DOC, 'pizza', max_chars=82,
+                                         strategy='optimal')
+        assert snippet == ('So good [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]]. '
+                           'So nice [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].')
+
+    def test_optimal_respects_max_sents(self):
+        snippet = snippets.highlight_doc(self.DOC, 'pizza', max_chars=82,
+                                         max_sents=1, strategy='optimal')
+        assert snippet == '[[HIGHLIGHT]]Pizza[[ENDHIGHLIGHT]] is great nice.'
+
+    def test_no_char_limit_is_greedy(self):
+        for max_sents in (1, 2, snippets.INFINITY):
+            assert (snippets.highlight_doc(self.DOC, 'pizza',
+                                           max_sents=max_sents,
+                                           strategy='optimal') ==
+                    snippets.highlight_doc(self.DOC, 'pizza',
+                                           max_sents=max_sents))
+
+    def test_too_many_sentences_is_greedy(self):
+        limit = snippets.OPTIMAL_MAX_SENTENCES
+        snippets.OPTIMAL_MAX_SENTENCES = 2
+        try:
+            snippet = snippets.highlight_doc(self.DOC, 'pizza', max_chars=82,
+                                             strategy='optimal')
+        finally:
+            snippets.OPTIMAL_MAX_SENTENCES = limit
+        assert snippet == '[[HIGHLIGHT]]Pizza[[ENDHIGHLIGHT]] is great nice.'
+
+    def test_nothing_matches(self):
+        doc = 'Meh. Whatever.'
+        assert (snippets.highlight_doc(doc, 'pizza', max_chars=5,
+                                       strategy='optimal') == 'Meh.')
+
+    def test_unknown_strategy(self):
+        try:
+            snippets.highlight_doc(self.DOC, 'pizza', strategy='best')
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+class TestScorer(object):
+    DOC = 'Meh. I love pizza! The pizza was good. Pizza, pizza and more pizza.'
+
+    def test_linear_default_weights(self):
+        scorer = snippets.LinearScorer()
+        for query in ('pizza', 'good pizza', 'sushi'):
+            tokens = snippets.prepare_document(self.DOC)
+            assert snippets._rank_sentences(tokens, query, scorer) == \
+                snippets._rank_sentences(tokens, query)
+
+    def test_features_cached(self):
+        calls = []
+
+        class CountingScorer(snippets.Scorer):
+            def static_scores(self, tokens, opinion_indicators):
+                calls.append('static')
+                return snippets.Scorer.static_scores(self, tokens,
+                                                     opinion_indicators)
+
+            def match_score(self, tokens, sentence, spans, query_words):
+                calls.append(sentence)
+                return snippets.Scorer.match_score(self, tokens, sentence,
+                                                   spans, query_words)
+
+        scorer = CountingScorer()
+        tokens = snippets.prepare_document(self.DOC)
+        for query in ('pizza', 'good', 'sushi'):
+            snippets.highlight_doc(tokens, query, scorer=scorer)
+        assert calls == ['static', 1, 2, 3, 2]
+
+    def test_position_and_length(self):
+        query = 'pizza'
+        assert snippets.highlight_doc(self.DOC, query, max_sents=1) == (
+            '[[HIGHLIGHT]]Pizza[[ENDHIGHLIGHT]], [[HIGHLIGHT]]pizza'
+            '[[ENDHIGHLIGHT]] and more [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].')
+        scorer = snippets.LinearScorer(position=10)
+        assert snippets.highlight_doc(self.DOC, query, max_sents=1,
+                                      scorer=scorer) == 'Meh.'
+        scorer = snippets.LinearScorer(match=0, opinion=0, length=1)
+        assert snippets.highlight_doc(self.DOC, query, max_sents=1,
+                                      scorer=scorer) == \
+            snippets.highlight_doc(self.DOC, query, max_sents=1)
+
+
+class TestPhraseMatcher(object):
+    def test_longest_match(self):
+        matcher = snippets._PhraseMatcher([['deep', 'dish'],
+                                           ['deep', 'dish', 'pizza'],
+                                           ['pizza']])
+        spans = matcher.find_spans('a deep dish pizza and pizza'.split())
+        assert spans == [(1, 4), (5, 6)]
+
+    def test_leftmost_match(self):
+        matcher = snippets._PhraseMatcher([['b', 'c', 'd'], ['a', 'b']])
+        assert matcher.find_spans('a b c d'.split()) == [(0, 2)]
+
+    def test_failure_links(self):
+        matcher = snippets._PhraseMatcher([['a', 'b', 'c'], ['b', 'd']])
+        assert matcher.find_spans('a b d'.split()) == [(1, 3)]
+
+    def test_prefixes(self):
+        matcher = snippets._PhraseMatcher([['a', 'b', 'c']], prefixes=True)
+        assert matcher.find_spans('a b x a'.split()) == [(0, 2), (3, 4)]
+
+    def test_no_phrases(self):
+        assert snippets._PhraseMatcher().find_spans(['a']) == []
+
+
+class TestQueryExpansion(object):
+    def test_phrase_expansion(self):
+        query = snippets.compile_query('noodles', expansions=['pad thai'])
+        snippet = snippets.highlight_doc('Their Pad Thai is good.', query)
+        assert snippet == 'Their [[HIGHLIGHT]]Pad Thai[[ENDHIGHLIGHT]] is good.'
+
+    def test_expansion_matched_whole(self):
+        query = snippets.compile_query('noodles', expansions=['pad thai'])
+        snippet = snippets.highlight_doc('Thai food. Noodles!', query)
+        assert snippet == '[[HIGHLIGHT]]Noodles[[ENDHIGHLIGHT]]!'
+
+    def test_expansion_score(self):
+        query = snippets.compile_query('pizza', expansions=['deep dish'])
+        tokens = snippets._tokenize('Deep dish here. Pizza here.')
+        scores = [score for (sentence, score, length)
+                  in snippets._rank_sentences(tokens, query)]
+        assert scores == [4, 1]
+
+    def test_synonym(self):
+        query = snippets.compile_query('soda', expansions=['pop', 'coke'])
+        snippet = snippets.highlight_doc('Free pop. No coke. Meh.', query)
+        assert snippet == ('Free [[HIGHLIGHT]]pop[[ENDHIGHLIGHT]]. '
+                           'No [[HIGHLIGHT]]coke[[ENDHIGHLIGHT]].')
+
+class TestPreparedDocument(object):
+    DOC = 'I love pizza. The Pizza was great! Meh.'
+
+    def test_features(self):
+        prepared = snippets.prepare_document(self.DOC)
+        assert prepared.words[:4] == ['i', 'love', 'pizza', '.']
+        assert list(prepared.opinion_counts) == [1, 1, 0]
+        assert list(prepared.word_chars) == [11, 17, 4]
+
+    def test_word_ids(self):
+        prepared = snippets.prepare_document(self.DOC)
+        ids = prepared.ids
+        assert ids.typecode == 'I'
+        # "pizza" and "Pizza" are one word, stored once.
+        assert ids[2] == ids[5] == snippets.VOCABULARY['pizza']
+        assert snippets.VOCABULARY.words[ids[5]] == 'pizza'
+        assert snippets.prepare_document('PIZZA').ids[0] == ids[2]
+
+    def test_vocabulary_reset(self):
+        vocabulary = snippets.VOCABULARY
+        prepared = snippets.prepare_document(self.DOC)
+        query = snippets.compile_query('great pizza')
+        lexicon = snippets.OpinionLexicon({'Meh': 4})
+        lexicon_query = snippets.compile_query('pizza',
+                                               opinion_indicators=lexicon)
+        index = snippets.ReviewIndex()
+        index.add('r1', self.DOC)
+        expected = [snippets.highlight_doc(prepared, query),
+                    snippets.highlight_doc(self.DOC, lexicon_query, max_sents=1)]
+        generation = vocabulary.generation
+        max_words = vocabulary.max_words
+        vocabulary.max_words = len(vocabulary.words)
+        try:
+            snippets.prepare_document('A brand new review.')
+        finally:
+            vocabulary.max_words = max_words
+        assert vocabulary.generation == generation + 1
+        assert 'review' in vocabulary and 'pizza' not in vocabulary
+        # Documents, queries and indexes made before still work.
+        assert [snippets.highlight_doc(prepared, query),
+                snippets.highlight_doc(self.DOC, lexicon_query,
+                                       max_sents=1)] == expected
+        assert prepared.generation == vocabulary.generation
+        assert index.search('pizza') == [('r1', 4)]
+
+    def test_opinion_indicators_as_written(self):
+        indicators = set(['Meh', 'LOL', 'great'])
+        prepared = snippets.prepare_document(
+            'Meh meh. LOL, lol and GREAT! Great great.', indicators)
+        assert list(prepared.opinion_counts) == [1, 1, 1]
+
+    def test_pickle(self):
+        prepared = snippets.prepare_document(self.DOC)
+        query = snippets.compile_query('great pizza', expansions=['meh'])
+        prepared2, query2 = pickle.loads(pickle.dumps((prepared, query), 2))
+        assert list(prepared2.ids) == list(prepared.ids)
+        assert query2.ids == query.ids
+        assert snippets.highlight_doc(prepared2, query2) == \
+            snippets.highlight_doc(prepared, query)
+
+    def test_pickle_keeps_default_indicators(self):
+        query = pickle.loads(pickle.dumps(snippets.compile_query('pizza'), 2))
+        prepared = pickle.loads(pickle.dumps(
+            snippets.prepare_document(self.DOC)))
+        assert query.opinion_indicators is snippets.OPINION_INDICATORS
+        assert prepared.opinion_indicators is snippets.OPINION_INDICATORS
+        lexicon = snippets.OpinionLexicon({'great': 2, 'not great': -1})
+        snippets._indicator_weights(lexicon)
+        query = pickle.loads(pickle.dumps(
+            snippets.compile_query('pizza', opinion_indicators=lexicon)))
+        assert query.opinion_indicators.digest() == lexicon.digest()
+        assert query.opinion_indicators._id_weights is None
+
+    def test_prepare_is_idempotent(self):
+        prepared = snippets.prepare_document(self.DOC)
+        assert snippets.prepare_document(prepared) is prepared
+
+    def test_same_snippet_as_string(self):
+        prepared = snippets.prepare_document(self.DOC)
+        for query in ('pizza', 'great pizza', 'sushi'):
+            for max_sents in (1, snippets.INFINITY):
+                assert (snippets.highlight_doc(prepared, query,
+                                               max_sents=max_sents) ==
+                        snippets.highlight_doc(self.DOC, query,
+                                               max_sents=max_sents))
+
+    def test_other_opinion_indicators(self):
+        prepared = snippets.prepare_document(self.DOC)
+        query = snippets.CompiledQuery(['sushi'], opinion_indicators=set(['Meh']))
+        assert snippets.highlight_doc(prepared, query) == 'Meh.'
+
+    def assert_same_as_prepared(self, prepared, text):
+        expected = snippets.prepare_document(text)
+        for name in ('text', 'starts', 'ends', 'bounds', 'ids', 'words',
+                     'opinion_counts', 'word_chars'):
+            assert getattr(prepared, name) == getattr(expected, name), name
+
+    def test_edit(self):
+        doc = 'Meh. ' + self.DOC + ' Sushi is good too. Bye.'
+        prepared = snippets.prepare_document(doc)
+        for (start, end, replacement) in [
+                (0, 0, 'Hi. '), (9, 13, 'hate'), (17, 18, ' and'),
+                (17, 18, '...'), (len(doc) - 5, len(doc), ''),
+                (len(doc), len(doc), ' Thanks!'), (0, len(doc), 'New.'),
+                (5, 5, '! ')]:
+            edited = prepared.edit(start, end, replacement)
+            self.assert_same_as_prepared(
+                edited, doc[:start] + replacement + doc[end:])
+        assert prepared.text == doc
+
+    def test_append(self):
+        prepared = snippets.prepare_document(self.DOC)
+        appended = prepared.append(' Owner: thanks, come again!')
+        self.assert_same_as_prepared(appended,
+                                     self.DOC + ' Owner: thanks, come again!')
+        self.assert_same_as_prepared(
+            snippets.prepare_document('').append('Pizza.'), 'Pizza.')
+
+    def test_edit_out_of_bounds(self):
+        prepared = snippets.prepare_document(self.DOC)
+        try:
+            prepared.edit(5, len(self.DOC) + 1, '')
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+    def test_sizeof(self):
+        small = snippets.prepare_document('Pizza.')
+        large = snippets.prepare_document(self.DOC * 10)
+        assert 0 < sys.getsizeof(small) < sys.getsizeof(large)
+
+
+class TestOpinionLexicon(object):
+    LEXICON = {'good': 2, 'not good': -3, 'love': 3, 'meh': -1}
+
+    def setup(self):
+        fd, self.path = tempfile.mkstemp(suffix='.lexicon')
+        os.close(fd)
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_weights(self):
+        lexicon = snippets.OpinionLexicon(self.LEXICON)
+        assert lexicon.score('i love it'.split()) == 3
+        assert lexicon.score('good and not good'.split()) == -1
+        prepared = snippets.prepare_document(
+            'Good food. It was good, not good. meh.', lexicon)
+        # Words are matched as written, as indicators are.
+        assert list(prepared.opinion_counts) == [0, -1, -1]
+
+    def test_unit_weights_match_indicators(self):
+        lexicon = snippets.OpinionLexicon(
+            (word, 1) for word in snippets.OPINION_INDICATORS)
+        doc = 'I love pizza. The Pizza was great! Meh. Bad bad pizza.'
+        for query in ('pizza', 'sushi'):
+            assert snippets.highlight_doc(doc, snippets.compile_query(
+                query, opinion_indicators=lexicon), max_sents=2) == \
+                snippets.highlight_doc(doc, query, max_sents=2)
+
+    def test_weight_tables_kept(self):
+        lexicon = snippets.OpinionLexicon({'fine': 5, 'ok': 1})
+        indicators = set(['nice'])
+        table = snippets._indicator_weights(lexicon)
+        assert snippets._indicator_weights(indicators) is \
+            snippets._indicator_weights(indicators)
+        assert snippets._indicator_weights(lexicon) is table
+        # A document is prepared with the lexicon its query is scored with.
+        query = snippets.compile_query('pizza', opinion_indicators=lexicon)
+        assert snippets.highlight_doc('I ate pizza here. It was fine.', query,
+                                      max_sents=1) == 'It was fine.'
+
+    def test_selects_by_weight(self):
+        lexicon = snippets.OpinionLexicon(self.LEXICON)
+        query = snippets.compile_query('pizza', opinion_indicators=lexicon)
+        snippet = snippets.highlight_doc(
+            'The pizza was not good. I love the pizza.', query, max_sents=1)
+        assert snippet == 'I love the [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].'
+
+    def test_negative_sentences_left_out(self):
+        lexicon = snippets.OpinionLexicon({'good': 1, 'bad': -2})
+        query = snippets.compile_query('pizza', opinion_indicators=lexicon)
+        for doc in ('bad food bad. I had pizza.',
+                    'bad food bad. Meh. I had pizza.'):
+            assert snippets.highlight_doc(doc, query) == \
+                'I had [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].'
+
+    def test_save_and_load(self):
+        lexicon = snippets.OpinionLexicon(self.LEXICON)
+        lexicon.save(self.path)
+        loaded = snippets.load_lexicon(self.path)
+        assert loaded.weights == lexicon.weights
+        assert loaded.phrases == lexicon.phrases
+        assert loaded.digest() == lexicon.digest()
+        assert loaded.score('not good'.split()) == -3
+
+    def test_load_text(self):
+        with open(self.path, 'w') as f:
+            f.write('# word\tweight\ngood\t2\n\nnot good\t-3\n')
+        lexicon = snippets.load_lexicon(self.path)
+        assert lexicon.weights == {'good': 2}
+        assert lexicon.phrases == {('not', 'good'): -3}
+
+        with open(self.path, 'w') as f:
+            f.write('good 2\n')
+        try:
+            snippets.load_lexicon(self.path)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+    def test_fractional_weight(self):
+        try:
+            snippets.OpinionLexicon({'good': 0.5})
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+    def test_store(self):
+        lexicon = snippets.OpinionLexicon(self.LEXICON)
+        doc = 'It was not good. I love pizza.'
+        snippet_store.write_store(self.path, [('r1', doc)], lexicon)
+        with snippet_store.PreparedStore(self.path, lexicon) as store:
+            assert store['r1'].opinion_counts == snippets.prepare_document(
+                doc, lexicon).opinion_counts
+        try:
+            snippet_store.PreparedStore(self.path)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+
+class TestDocumentCache(object):
+    def test_hits_and_misses(self):
+        cache = snippets.DocumentCache()
+        first = cache.prepare('a', 'I love pizza.')
+        assert cache.prepare('a', 'I love pizza.') is first
+        assert cache.get('b') is None
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert cache.get('a') is first
+        assert len(cache) == 1 and 'a' in cache
+
+    def test_changed_text(self):
+        cache = snippets.DocumentCache()
+        first = cache.prepare('a', 'I love pizza.')
+        second = cache.prepare('a', 'I love sushi.')
+        assert second is not first
+        assert second.text == 'I love sushi.'
+        assert cache.nbytes == sys.getsizeof(second)
+
+    def test_edited_text(self):
+        cache = snippets.DocumentCache()
+        cache.prepare('a', 'I love pizza. The crust was thin. Meh.')
+        edited = cache.prepare('a', 'I love pizza. The crust was great. Meh.')
+        expected = snippets.prepare_document(
+            'I love pizza. The crust was great. Meh.')
+        assert edited.words == expected.words
+        assert edited.opinion_counts == expected.opinion_counts
+        assert snippets.highlight_doc(edited, 'crust', max_sents=1) == \
+            'The [[HIGHLIGHT]]crust[[ENDHIGHLIGHT]] was great.'
+
+    def test_changed_range(self):
+        assert snippets._changed_range('abcdef', 'abXYef') == (2, 4, 4)
+        assert snippets._changed_range('abc', 'abcd') == (3, 3, 4)
+        assert snippets._changed_range('aaa', 'aa') == (2, 3, 2)
+        assert snippets._changed_range('', 'xy') == (0, 0, 2)
+
+    def test_eviction(self):
+        texts = ['Pizza number %d.' % number for number in (1, 2, 3)]
+        size = max(sys.getsizeof(snippets.prepare_document(text))
+                   for text in texts)
+        # The vocabulary, which already has the words, counts too.
+        cache = snippets.DocumentCache(
+            max_bytes=size * 2 + snippets.VOCABULARY.nbytes)
+        cache.prepare(1, 'Pizza number 1.')
+        cache.prepare(2, 'Pizza number 2.')
+        cache.get(1)
+        cache.prepare(3, 'Pizza number 3.')
+        assert 1 in cache and 2 not in cache and 3 in cache
+        assert cache.evictions == 1
+        assert cache.nbytes <= cache.max_bytes
+
+    def test_too_large(self):
+        cache = snippets.DocumentCache(max_bytes=10)
+        prepared = cache.prepare('a', 'I love pizza.')
+        assert prepared.text == 'I love pizza.'
+        assert len(cache) == 0 and cache.nbytes == 0
+
+    def test_stats(self):
+        cache = snippets.DocumentCache()
+        cache.prepare('a', 'Pizza.')
+        stats = cache.stats()
+        assert stats['documents'] == 1 and stats['misses'] == 1
+        assert stats['nbytes'] == cache.nbytes
+
+class TestPreparedStore(object):
+    DOCS = [('r1', 'I love pizza. The service was slow.'),
+            (u'r2', u'Caf\xe9 food is great. Pizza \u2013 $9.47!'),
+            (3, 'Nothing to see here')]
+
+    def setup(self):
+        fd, self.path = tempfile.mkstemp(suffix='.store')
+        os.close(fd)
+        snippet_store.write_store(self.path, self.DOCS)
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        with snippet_store.PreparedStore(self.path) as store:
+            assert len(store) == 3
+            assert sorted(store) == ['3', 'r1', 'r2']
+            for (doc_id, doc) in self.DOCS:
+                prepared = store[doc_id]
+                expected = snippets.prepare_document(doc)
+                assert prepared.text == doc
+                assert type(prepared.text) is type(doc)
+                for name in ('starts', 'ends', 'bounds', 'words',
+                             'opinion_counts', 'word_chars'):
+                    assert getattr(prepared, name) == getattr(expected, name)
+
+    def test_snippets(self):
+        with snippet_store.PreparedStore(self.path) as store:
+            for (doc_id, doc) in self.DOCS:
+                assert (snippets.highlight_doc(store[doc_id], 'pizza') ==
+                        snippets.highlight_doc(doc, 'pizza'))
+
+    def test_missing(self):
+        with snippet_store.PreparedStore(self.path) as store:
+            assert store.get('nope') is None
+            assert 'nope' not in store and 'r1' in store
+            try:
+                store['nope']
+            except KeyError:
+                pass
+            else:
+                assert False, 'Expected a KeyError.'
+
+    def test_other_lexicon(self):
+        try:
+            snippet_store.PreparedStore(self.path, set(['meh']))
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+    def test_not_a_store(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 100)
+        try:
+            snippet_store.PreparedStore(self.path)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+
+class TestSnippetService(object):
+    DOCS = [('r1', 'I love pizza. The service was slow.'),
+            ('r2', 'Deep dish pizza! Meh.')]
+
+    def setup(self):
+        fd, self.path = tempfile.mkstemp(suffix='.store')
+        os.close(fd)
+        snippet_store.write_store(self.path, self.DOCS)
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_snippet(self):
+        with snippet_server.SnippetService(self.path, workers=1) as service:
+            for (doc_id, doc) in self.DOCS:
+                assert (service.snippet('pizza', doc_id, max_chars=30) ==
+                        snippets.highlight_doc(doc, 'pizza', max_chars=30))
+            assert (service.snippet('meh', text='Meh. Fine.') ==
+                    '[[HIGHLIGHT]]Meh[[ENDHIGHLIGHT]].')
+            assert (service.snippet('meh', text='Meh. Fine.', spans=True) ==
+                    ([(0, 4)], [(0, 3)]))
+            stats = service.stats()
+            assert stats['requests'] == 4 and stats['pending'] == 0
+            assert 0 < stats['p50_ms'] <= stats['p99_ms']
+
+    def test_errors(self):
+        with snippet_server.SnippetService(self.path, workers=1) as service:
+            for (kwargs, error) in [({'doc_id': 'nope'}, KeyError),
+                                    ({'doc_id': 'r1', 'strategy': 'best'},
+                                     ValueError)]:
+                try:
+                    service.snippet('pizza', **kwargs)
+                except error:
+                    pass
+                else:
+                    assert False, 'Expected a %s.' % error.__name__
+
+    def test_unexpected_error(self):
+        def fail(*args):
+            raise RuntimeError('boom')
+        original = snippets.highlight_doc
+        snippets.highlight_doc = fail
+        try:
+            with snippet_server.SnippetService(self.path,
+                                               workers=1) as service:
+                try:
+                    service.snippet('pizza', 'r1', timeout=5)
+                except RuntimeError as error:
+                    assert str(error) == 'boom'
+                else:
+                    assert False, 'Expected a RuntimeError.'
+                snippets.highlight_doc = original
+                # The dispatcher still answers later requests.
+                assert service.snippet('pizza', 'r1', timeout=5) == \
+                    snippets.highlight_doc(self.DOCS[0][1], 'pizza')
+                assert service.stats()['pending'] == 0
+        finally:
+            snippets.highlight_doc = original
+
+    def test_timeout(self):
+        release = threading.Event()
+        original = snippets.highlight_doc
+        def wait(*args):
+            release.wait(5)
+            return original(*args)
+        snippets.highlight_doc = wait
+        try:
+            with snippet_server.SnippetService(self.path,
+                                               workers=1) as service:
+                pending = service.submit('pizza', 'r1')
+                try:
+                    service.result(pending, timeout=0.05)
+                except snippet_server.TimedOut:
+                    pass
+                else:
+                    assert False, 'Expected TimedOut.'
+                # The request no longer counts against max_pending, and a
+                # new identical one is not coalesced with it.
+                assert service.stats()['pending'] == 0
+                again = service.submit('pizza', 'r1')
+                assert again is not pending
+                release.set()
+                assert service.result(again, timeout=5).startswith('I love')
+                assert service.stats()['pending'] == 0
+        finally:
+            snippets.highlight_doc = original
+
+    def test_coalesce_and_overload(self):
+        with snippet_server.SnippetService(self.path, workers=1, max_delay=0.2,
+                                           max_pending=1) as service:
+            first = service.submit('pizza', 'r1')
+            assert service.submit('pizza', 'r1') is first
+            try:
+                service.submit('pizza', 'r2')
+            except snippet_server.Overloaded:
+                pass
+            else:
+                assert False, 'Expected Overloaded.'
+            assert service.result(first).startswith('I love [[HIGHLIGHT]]')
+            stats = service.stats()
+            assert (stats['requests'], stats['coalesced'],
+                    stats['rejected'], stats['batches']) == (3, 1, 1, 1)
+
+    def test_batches_in_workers(self):
+        with snippet_server.SnippetService(self.path, workers=2,
+                                           max_delay=0.05) as service:
+            pendings = [service.submit(word, doc_id)
+                        for word in ('pizza', 'slow', 'dish')
+                        for (doc_id, doc) in self.DOCS]
+            results = [service.result(pending) for pending in pendings]
+        assert results == [snippets.highlight_doc(doc, word)
+                           for word in ('pizza', 'slow', 'dish')
+                           for (doc_id, doc) in self.DOCS]
+
+    def test_http(self):
+        service = snippet_server.SnippetService(self.path, workers=1)
+        server = snippet_server.SnippetHTTPServer(('127.0.0.1', 0), service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+        def post(request):
+            try:
+                response = urllib2.urlopen(url + '/snippet',
+                                           json.dumps(request))
+            except urllib2.HTTPError as error:
+                response = error
+            return response.getcode(), json.load(response)
+
+        try:
+            assert post({'id': 'r2', 'query': 'deep dish'}) == (200, {
+                'snippet': '[[HIGHLIGHT]]Deep dish[[ENDHIGHLIGHT]] pizza!'})
+            assert post({'text': 'Good pizza.', 'query': 'pizza',
+                         'max_sents': 1})[1] == {
+                'snippet': 'Good [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].'}
+            assert post({'id': 'nope', 'query': 'pizza'})[0] == 404
+            assert post({'id': 'r1'})[0] == 400
+            stats = json.load(urllib2.urlopen(url + '/stats'))
+            assert stats['requests'] == 3
+            assert post({'id': 'r1', 'query': 'pizza', 'spans': True}) == (
+                200, {'sentences': [[0, 13]], 'highlights': [[7, 12]]})
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            service.close()
+
+class TestResultCache(object):
+    DOC = 'I love deep dish pizza. The service was slow.'
+
+    def setup(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_canonical_keys(self):
+        cache = snippet_cache.ResultCache()
+        key = cache.key(self.DOC, 'Deep  DISH pizza')
+        assert key == cache.key(self.DOC, 'deep dish pizza', None, float('inf'))
+        assert key == cache.key(unicode(self.DOC),
+                                snippets.compile_query('deep dish pizza'))
+        assert key != cache.key(self.DOC, 'deep dish pizza', 20)
+        assert key != cache.key(self.DOC + ' ', 'deep dish pizza')
+        assert (cache.key('a', 'pizza', doc_id='r1') ==
+                cache.key('b', 'pizza', doc_id='r1'))
+        assert snippet_cache.ResultCache(content_hash=False).key(
+            self.DOC, 'pizza')[0] == 'text:' + self.DOC
+
+    def test_opinion_indicators_in_key(self):
+        doc = 'I ate pizza here. It was fine.'
+        lexicon = snippets.OpinionLexicon({'fine': 5})
+        query = snippets.compile_query('pizza', opinion_indicators=lexicon)
+        cache = snippet_cache.ResultCache()
+        plain = cache.highlight_doc(doc, 'pizza', max_sents=1)
+        assert cache.highlight_doc(doc, query, max_sents=1) == \
+            snippets.highlight_doc(doc, query, max_sents=1) == 'It was fine.'
+        assert cache.highlight_doc(doc, 'pizza', max_sents=1) == plain
+        assert cache.key(doc, query) == cache.key(doc, snippets.compile_query(
+            'pizza', opinion_indicators=snippets.OpinionLexicon({'fine': 5})))
+        assert cache.key(doc, snippets.compile_query(
+            'pizza', opinion_indicators=set(['fine']))) not in (
+            cache.key(doc, query), cache.key(doc, 'pizza'))
+
+    def check_backend(self, backend):
+        cache = snippet_cache.ResultCache(backend)
+        expected = snippets.highlight_doc(self.DOC, 'pizza', 40)
+        assert cache.highlight_doc(self.DOC, 'Pizza', 40) == expected
+        assert cache.highlight_doc(self.DOC, 'pizza', 40) == expected
+        snippet = cache.highlight_doc(u'Caf\xe9 pizza.', 'pizza')
+        assert snippet == u'Caf\xe9 [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].'
+        assert cache.highlight_doc(u'Caf\xe9 pizza.', 'pizza') == snippet
+        assert type(cache.highlight_doc(self.DOC, 'pizza', 40)) is str
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (3, 2, 2)
+        cache.clear()
+        assert cache.stats()['entries'] == 0
+
+    def test_memory_backend(self):
+        self.check_backend(snippet_cache.MemoryBackend())
+
+    def test_sqlite_backend(self):
+        self.check_backend(snippet_cache.SqliteBackend(self.path))
+
+    def check_eviction(self, backend):
+        cache = snippet_cache.ResultCache(backend)
+        for i in xrange(50):
+            cache.highlight_doc('Pizza number %d.' % i, 'pizza')
+        cache.highlight_doc('Pizza number 0.', 'pizza')
+        assert cache.stats()['hits'] == 0
+        assert 0 < cache.stats()['nbytes'] <= backend.max_bytes
+        cache.highlight_doc('Pizza number 49.', 'pizza')
+        assert cache.stats()['hits'] == 1
+
+    def test_memory_eviction(self):
+        self.check_eviction(snippet_cache.MemoryBackend(max_bytes=2000))
+
+    def test_sqlite_eviction(self):
+        self.check_eviction(snippet_cache.SqliteBackend(self.path,
+                                                        max_bytes=2000))
+
+    def test_ttl(self):
+        for backend in (snippet_cache.MemoryBackend(ttl=0),
+                        snippet_cache.SqliteBackend(self.path, ttl=0)):
+            cache = snippet_cache.ResultCache(backend)
+            cache.highlight_doc(self.DOC, 'pizza')
+            cache.highlight_doc(self.DOC, 'pizza')
+            stats = cache.stats()
+            assert (stats['hits'], stats['misses'], stats['entries']) == (0, 2,
+                                                                          1)
+
+    def test_shared_file(self):
+        first = snippet_cache.ResultCache(
+            snippet_cache.SqliteBackend(self.path))
+        second = snippet_cache.ResultCache(
+            snippet_cache.SqliteBackend(self.path))
+        first.highlight_doc(self.DOC, 'pizza', doc_id=7)
+        second.highlight_doc(self.DOC, 'PIZZA', doc_id=7)
+        assert second.hits == 1
+
+class TestReviewIndex(object):
+    REVIEWS = [('a', 'The sushi was fine. Pizza was not bad.'),
+               ('b', 'Deep dish pizza! I love this deep dish pizza.'),
+               ('c', 'Great service. Nice staff.'),
+               ('d', 'Pizza. Pizza.')]
+
+    def make_index(self):
+        index = snippets.ReviewIndex()
+        for (key, doc) in self.REVIEWS:
+            index.add(key, doc)
+        return index
+
+    def test_search(self):
+        index = self.make_index()
+        assert index.search('deep dish pizza') == [('b', 19), ('a', 2),
+                                                   ('d', 2)]
+
+    def test_search_limit(self):
+        index = self.make_index()
+        assert index.search('deep dish pizza', n=1) == [('b', 19)]
+
+    def test_scores_match_rank_sentences(self):
+        index = self.make_index()
+        query = snippets.compile_query('pizza')
+        for (key, score) in index.search(query):
+            ranked = snippets._rank_sentences(index.get(key), query)
+            prepared = index.get(key)
+            assert score == sum(
+                rank[1] for rank in ranked
+                if snippets._sentence_spans(prepared, rank[0], query))
+
+    def test_no_matches(self):
+        index = self.make_index()
+        assert index.search('burgers') == []
+        assert index.highlight('burgers') == []
+
+    def test_highlight(self):
+        index = self.make_index()
+        results = index.highlight('sushi', max_sents=1)
+        assert results == [('a', 1, snippets.highlight_doc(
+            self.REVIEWS[0][1], 'sushi', max_sents=1))]
+
+    def test_duplicate_key(self):
+        index = self.make_index()
+        try:
+            index.add('a', 'Again.')
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError.'
+        assert len(index) == 4 and 'a' in index
+
+class TestBestSnippets(object):
+    DOCS = ['The pizza was fine. I love their pizza.',
+            'Deep dish pizza! The best deep dish pizza ever.',
+            'Sushi only.',
+            'I love their pizza.']
+
+    def test_best_first(self):
+        results = snippets.best_snippets(self.DOCS, 'deep dish pizza', k=3,
+                                         unique=False)
+        assert [(doc, sentence, score) for (doc, sentence, score, text)
+                in results] == [(1, 1, 10), (0, 1, 2), (3, 0, 2)]
+        assert results[0][3] == ('The best [[HIGHLIGHT]]deep dish pizza'
+                                 '[[ENDHIGHLIGHT]] ever.')
+
+    def test_max_per_doc(self):
+        results = snippets.best_snippets(self.DOCS, 'pizza', k=3,
+                                         max_per_doc=None, unique=False)
+        assert [(doc, sentence) for (doc, sentence, score, text)
+                in results] == [(0, 1), (1, 1), (3, 0)]
+
+        results = snippets.best_snippets(self.DOCS, 'pizza', k=5,
+                                         unique=False)
+        assert [doc for (doc, sentence, score, text) in results] == [0, 1, 3]
+
+    def test_unique(self):
+        results = snippets.best_snippets(self.DOCS, 'pizza', k=5)
+        assert [(doc, sentence) for (doc, sentence, score, text)
+                in results] == [(0, 1), (1, 1)]
+        results = snippets.best_snippets(self.DOCS, 'pizza', k=5,
+                                         max_per_doc=None)
+        assert [(doc, sentence) for (doc, sentence, score, text)
+                in results] == [(0, 1), (1, 1), (0, 0), (1, 0)]
+
+    def test_unique_keeps_better_duplicate(self):
+        # Opinion words count as written, so the second copy scores more.
+        results = snippets.best_snippets(['Good pizza.', 'good pizza.'],
+                                         'pizza', k=2)
+        assert [(doc, score) for (doc, sentence, score, text)
+                in results] == [(1, 2)]
+        results = snippets.best_snippets(['good pizza.', 'Good pizza.',
+                                          'Sushi pizza.'], 'pizza', k=1)
+        assert [(doc, score) for (doc, sentence, score, text)
+                in results] == [(0, 2)]
+
+    def test_k_not_positive(self):
+        assert snippets.best_snippets(self.DOCS, 'pizza', k=0) == []
+        assert snippets.best_snippets(self.DOCS, 'pizza', k=-1) == []
+
+    def test_max_chars(self):
+        results = snippets.best_snippets(self.DOCS, 'deep dish pizza', k=3,
+                                         max_chars=100)
+        assert [(doc, sentence) for (doc, sentence, score, text)
+                in results] == [(1, 1), (0, 1)]
+        # The best sentence of a document is the best one that fits.
+        results = snippets.best_snippets(self.DOCS, 'deep dish pizza', k=3,
+                                         max_chars=50)
+        assert [(doc, sentence) for (doc, sentence, score, text)
+                in results] == [(1, 0)]
+
+    def test_generator_of_docs(self):
+        docs = (doc for doc in self.DOCS)
+        results = snippets.best_snippets(docs, 'sushi')
+        assert results == [(2, 0, 1, '[[HIGHLIGHT]]Sushi[[ENDHIGHLIGHT]] only.')]
+
+    def test_no_matches(self):
+        assert snippets.best_snippets(self.DOCS, 'burgers', k=3) == []
+
+
+
+class TestVectorScorer(object):
+    DOCS = ['The pizza was fine. I love their deep dish pizza!',
+            'Pizza pizza pizza. "Good" GOOD good... Dish deep pizza?',
+            u'Caf\xe9 pizza is great. Ugh.',
+            '',
+            'pizza',
+            'Sushi only.']
+
+    def setup(self):
+        try:
+            import snippet_vector
+        except ImportError:
+            raise unittest.SkipTest('NumPy is not installed')
+        self.scorer = snippet_vector.VectorScorer()
+
+    def assert_same_ranks(self, query):
+        expected = [snippets._rank_sentences(snippets.prepare_document(doc),
+                                             query)
+                    for doc in self.DOCS]
+        assert self.scorer.rank(self.DOCS, query) == expected
+
+    def test_same_ranks(self):
+        for query in ('pizza', 'deep dish pizza', 'good pizza', 'sushi', ''):
+            self.assert_same_ranks(snippets.compile_query(query))
+
+    def test_other_lexicon(self):
+        self.assert_same_ranks(snippets.CompiledQuery(
+            ['pizza'], opinion_indicators=set(['good', 'pizza', 'caf\xc3\xa9'])))
+        self.assert_same_ranks(snippets.CompiledQuery(
+            ['pizza'], opinion_indicators=set(['GOOD', 'Good'])))
+
+    def test_weighted_lexicon(self):
+        self.assert_same_ranks(snippets.CompiledQuery(
+            ['pizza'], opinion_indicators=snippets.OpinionLexicon(
+                {'good': 2, 'great': -1, 'GOOD': 5})))
+        self.assert_same_ranks(snippets.CompiledQuery(
+            ['pizza'], opinion_indicators=snippets.OpinionLexicon(
+                {'good': 2, 'pizza is': 4})))
+
+    def test_phrase_matcher_queries(self):
+        self.assert_same_ranks(snippets.compile_query('pizza pizza'))
+        self.assert_same_ranks(snippets.compile_query(
+            'pizza', expansions=['deep dish']))
+
+    def test_same_snippets(self):
+        for max_chars, max_sents in ((snippets.INFINITY, 1), (40, 2)):
+            assert (self.scorer.highlight_many(self.DOCS, 'deep dish pizza',
+                                               max_chars, max_sents) ==
+                    snippets.highlight_many(self.DOCS, 'deep dish pizza',
+                                            max_chars, max_sents))
+
+
+class TestBenchSuite(object):
+    BASELINE = {'short': {
+        'tokenize': {'docs_per_sec': 1000.0, 'peak_bytes': 1 << 20},
+        'select': {'docs_per_sec': 1000.0, 'peak_bytes': None}}}
+
+    def results(self, docs_per_sec, peak_bytes):
+        return {'short': {
+            'tokenize': {'docs_per_sec': docs_per_sec, 'peak_bytes': peak_bytes},
+            'select': {'docs_per_sec': 1000.0, 'peak_bytes': 1 << 30}}}
+
+    def test_compare(self):
+        assert bench_suite.compare(self.results(850.0, 1 << 20),
+                                   self.BASELINE, 0.2, 0.5) == []
+        assert bench_suite.compare(self.results(700.0, 1 << 20),
+                                   self.BASELINE, 0.2, 0.5) == [
+            ('short', 'tokenize', 'docs_per_sec', 1000.0, 700.0)]
+
+    def test_compare_memory(self):
+        # Growth within the threshold and the slack of a page count passes.
+        peak = (1 << 20) * 3 / 2 + bench_suite.MEMORY_SLACK
+        assert bench_suite.compare(self.results(1000.0, peak),
+                                   self.BASELINE, 0.2, 0.5) == []
+        assert bench_suite.compare(self.results(1000.0, peak + 1),
+                                   self.BASELINE, 0.2, 0.5) == [
+            ('short', 'tokenize', 'peak_bytes', 1 << 20, peak + 1)]
+        assert bench_suite.compare(self.results(1000.0, peak + 1),
+                                   self.BASELINE, 0.2) == []
+
+    def test_peak_allocated(self):
+        size = 32 << 20
+        # A higher peak earlier in this process must not hide the growth.
+        data = bytearray(2 * size)
+        del data
+        peak = bench_suite.peak_allocated(lambda: bytearray(size))
+        if peak is not None:
+            assert size * 0.9 < peak < size * 1.5